@@ -0,0 +1,946 @@
+#!/usr/bin/env python3
+"""
+QuantumSurf — benchmarks
+Made by Aryan Giri | giriaryan694-a11y
+
+Imports main.py with QS_NO_BOOT=1 (nothing is installed or started) and
+measures individual components. Every command prints one JSON document.
+
+  python3 bench.py ratelimit [--ips 1000000] [--capacity 100000]
+  python3 bench.py auth [--users 5000] [--logins 400] [--concurrency 32]
+  python3 bench.py suite [--parts stack,bridge,login,novnc] [--save-baseline F]
+                         [--baseline F] [--threshold 0.2]
+  python3 bench.py profile [--profile DIR] [--touch 10]
+  python3 bench.py depth [--depths 24,16,8] [--seconds 20]
+  python3 bench.py chrome [--presets density,balanced,fidelity] [--tabs 4] [--settle 20]
+  python3 bench.py rtc [--loss 0,1,2,3] [--delay 20] [--events 300]
+  python3 bench.py shaping [--host-mbit 40] [--users 3] [--weights 2,1,1] [--seconds 10]
+  python3 bench.py replay TRACE.qst [--mode info|png|client|server]
+                         [--from SECONDS] [--speed 1 (0 = full speed)]
+
+`suite` needs Xvfb, x11vnc and an already-installed Chromium/noVNC for the
+stack and novnc parts (missing pieces are reported as skipped, never
+downloaded); the bridge and login parts only need Python and run against a
+local fake RFB server. It exits 1 when a metric regresses past --threshold
+relative to --baseline.
+
+`rtc` needs aiortc, and root plus the sch_netem module for loss above 0.
+"""
+import os, sys, json, time, argparse, gc, tracemalloc, random, threading, tempfile, logging, contextlib
+import re, shutil, socket, struct, subprocess, zlib, http.cookiejar, urllib.request, urllib.error
+from urllib.parse import urlencode, urljoin, urlparse
+from pathlib import Path
+
+os.environ.setdefault("QS_NO_BOOT", "1")
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import main as qs
+
+def _percentile(samples, pct):
+    s = sorted(samples)
+    return s[min(len(s) - 1, int(len(s) * pct / 100))] if s else 0.0
+
+# ═══════════════════════════════════════════════════════════
+# LOGIN RATE LIMITER
+# ═══════════════════════════════════════════════════════════
+def bench_ratelimit(args):
+    """Credential stuffing from `--ips` distinct addresses: one failed login
+    per address. A first pass under tracemalloc records tracked keys and
+    memory at checkpoints (it must level off at --capacity); a second,
+    untraced pass over fresh addresses measures per-check latency."""
+    qs.RATE_CAPACITY = args.capacity
+    def attack(start, n, timed=False):
+        lat, rnd = [], random.Random(start)
+        for i in range(start, start + n):
+            ip = f"{10 + (i >> 24)}.{(i >> 16) & 255}.{(i >> 8) & 255}.{i & 255}"
+            user = f"user{rnd.randrange(5000)}"
+            t0 = time.perf_counter()
+            if not qs._rate_limited(ip, user): qs._record(ip, user)
+            if timed: lat.append((time.perf_counter() - t0) * 1e6)
+        return lat
+    for lock, buckets in qs._rate_shards: buckets.clear()
+    gc.collect()
+    tracemalloc.start()
+    base = tracemalloc.get_traced_memory()[0]
+    rows, done = [], 0
+    for cp in sorted({c for c in (10_000, 50_000, 100_000, 200_000, 500_000, args.ips) if c <= args.ips}):
+        attack(done, cp - done); done = cp
+        rows.append({"distinct_ips":cp, "tracked_keys":qs._rate_tracked(),
+                     "traced_mb":round((tracemalloc.get_traced_memory()[0] - base) / 1048576, 2)})
+    tracemalloc.stop()
+    lat = attack(done, 200_000, timed=True)
+    # Lock contention: the same workload from several threads at once.
+    threads = [threading.Thread(target=attack, args=(done + 200_000 + t * 50_000, 50_000))
+               for t in range(8)]
+    t0 = time.perf_counter()
+    for t in threads: t.start()
+    for t in threads: t.join()
+    elapsed = time.perf_counter() - t0
+    return {"capacity":args.capacity, "shards":qs.RATE_SHARDS, "memory":rows,
+            "check_us_p50":round(_percentile(lat, 50), 2),
+            "check_us_p99":round(_percentile(lat, 99), 2),
+            "threads":8, "threaded_checks_per_s":round(8 * 50_000 / elapsed)}
+
+# ═══════════════════════════════════════════════════════════
+# PASSWORD VERIFICATION
+# ═══════════════════════════════════════════════════════════
+def bench_auth(args):
+    """Login burst against an auth.txt of --users scrypt users. Reports file
+    (re)load time, verification throughput/latency through the worker
+    pool, 503s from the bounded queue, cached re-logins, and how late a
+    20ms select()-style loop (standing in for a /ws bridge) wakes up while
+    the burst runs."""
+    from concurrent.futures import ThreadPoolExecutor
+    distinct = 64  # unique hashes; users share them round-robin to keep setup fast
+    with ThreadPoolExecutor(os.cpu_count() or 2) as ex:
+        hashes = list(ex.map(lambda i: qs._scrypt_hash(f"pw{i}"), range(distinct)))
+    tmp = Path(tempfile.mkdtemp(prefix="qs_bench_auth_"))
+    qs.AUTH_FILE = tmp / "auth.txt"
+    qs.AUTH_FILE.write_text("".join(f"user{i}:{hashes[i % distinct]}\n" for i in range(args.users)))
+    loads = []
+    for _ in range(5):
+        t0 = time.perf_counter(); qs._reload_auth(); loads.append((time.perf_counter() - t0) * 1000)
+    qs._auth_ok_cache.clear()
+
+    lateness, stop = [], threading.Event()
+    def bridge_like():
+        while not stop.is_set():
+            t0 = time.perf_counter(); time.sleep(0.02)
+            lateness.append((time.perf_counter() - t0 - 0.02) * 1000)
+    def burst(users):
+        lat, busy = [], [0]
+        def one(i):
+            t0 = time.perf_counter()
+            r = qs._verify_login(f"user{i}", f"pw{i % distinct}")
+            if r is None: busy[0] += 1
+            else: lat.append((time.perf_counter() - t0) * 1000)
+        t0 = time.perf_counter()
+        with ThreadPoolExecutor(args.concurrency) as ex: list(ex.map(one, users))
+        return lat, busy[0], time.perf_counter() - t0
+    idle_thread = threading.Thread(target=bridge_like); idle_thread.start()
+    time.sleep(1.0); idle_late = list(lateness); lateness.clear()
+    users = random.Random(2).sample(range(args.users), min(args.logins, args.users))
+    cold_lat, cold_busy, cold_s = burst(users)
+    burst_late = list(lateness)
+    warm_lat, _, warm_s = burst(users)
+    stop.set(); idle_thread.join()
+    return {"users":args.users, "auth_workers":qs.AUTH_WORKERS, "auth_queue":qs.AUTH_QUEUE,
+            "reload_ms_p50":round(_percentile(loads, 50), 2),
+            "cold":{"logins":len(users), "verified":len(cold_lat), "rejected_503":cold_busy,
+                    "per_s":round(len(cold_lat) / cold_s, 1),
+                    "ms_p50":round(_percentile(cold_lat, 50), 1), "ms_p95":round(_percentile(cold_lat, 95), 1)},
+            "cached":{"per_s":round(len(warm_lat) / warm_s, 1),
+                      "ms_p50":round(_percentile(warm_lat, 50), 3)},
+            "bridge_loop_late_ms":{"idle_p99":round(_percentile(idle_late, 99), 2),
+                                   "burst_p99":round(_percentile(burst_late, 99), 2),
+                                   "burst_max":round(max(burst_late or [0]), 2)}}
+
+# ═══════════════════════════════════════════════════════════
+# FAKE RFB SERVER + CLIENT
+# ═══════════════════════════════════════════════════════════
+def _recv_exact(sock, n):
+    buf = bytearray()
+    while len(buf) < n:
+        chunk = sock.recv(n - len(buf))
+        if not chunk: raise ConnectionError("peer closed")
+        buf += chunk
+    return bytes(buf)
+
+class FakeRFB:
+    """Minimal RFB 3.8 server on 127.0.0.1: no authentication, 32bpp
+    true colour, and every FramebufferUpdateRequest is answered at once with
+    one Raw rectangle of about `update_bytes`, or of the requested size if
+    that is smaller. Stands in for x11vnc so the
+    bridge can be measured without X. With `echo`, every key or pointer
+    event is answered by a 1x1 rectangle at (event id, 1) for a pointer
+    event or (event id, 2) for a key, where the id is the pointer's x or the
+    keysym & 0x7fff."""
+    _CLIENT_MSG = {0: 19, 3: 9, 4: 7, 5: 5}   # fixed-size message bodies after the type byte
+
+    def __init__(self, width=1280, height=720, update_bytes=4096, echo=False):
+        self.width, self.height, self.echo = width, height, echo
+        self.set_update_bytes(update_bytes)
+        self.sock = socket.socket(); self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(("127.0.0.1", 0)); self.sock.listen(16)
+        self.port = self.sock.getsockname()[1]
+        self.received = []   # (monotonic time, message type) of client messages
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def set_update_bytes(self, n):
+        rw = min(self.width, max(1, n // 4))
+        rh = max(1, -(-n // (rw * 4)))
+        self.update = struct.pack(">BxH", 0, 1) + struct.pack(">HHHHi", 0, 0, rw, rh, 0) + bytes(rw * rh * 4)
+
+    def _accept(self):
+        while True:
+            try: c, _ = self.sock.accept()
+            except OSError: return
+            c.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            threading.Thread(target=self._serve, args=(c,), daemon=True).start()
+
+    def _serve(self, c):
+        try:
+            c.sendall(b"RFB 003.008\n"); _recv_exact(c, 12)
+            c.sendall(b"\x01\x01"); _recv_exact(c, 1)
+            c.sendall(b"\x00\x00\x00\x00"); _recv_exact(c, 1)
+            pf = struct.pack(">BBBBHHHBBBxxx", 32, 24, 0, 1, 255, 255, 255, 16, 8, 0)
+            c.sendall(struct.pack(">HH", self.width, self.height) + pf + struct.pack(">I", 4) + b"fake")
+            while True:
+                t = _recv_exact(c, 1)[0]
+                self.received.append((time.monotonic(), t))
+                if t == 2: _recv_exact(c, 4 * struct.unpack(">xH", _recv_exact(c, 3))[0])
+                elif t == 6: _recv_exact(c, struct.unpack(">xxxI", _recv_exact(c, 7))[0])
+                elif t in self._CLIENT_MSG: body = _recv_exact(c, self._CLIENT_MSG[t])
+                else: return
+                if t == 3:
+                    _, _, _, rw, rh = struct.unpack(">BHHHH", body)
+                    small = rw * rh * 4 + 16 < len(self.update)   # asked for less than a full update
+                    c.sendall(struct.pack(">BxHHHHHi", 0, 1, 0, 0, rw, rh, 0) + bytes(rw * rh * 4) if small else self.update)
+                elif self.echo and t in (4, 5):
+                    x, y = (struct.unpack(">xH", body[:3])[0], 1) if t == 5 else (struct.unpack(">xxxI", body)[0] & 0x7fff, 2)
+                    c.sendall(struct.pack(">BxHHHHHi", 0, 1, x, y, 1, 1, 0) + bytes(4))
+        except (OSError, ConnectionError): pass
+        finally: c.close()
+
+    def close(self): self.sock.close()
+
+class _Stream:
+    """Exact-length reads over a raw socket or a websocket-client connection."""
+    def __init__(self, send, recv):
+        self.send, self._recv, self.buf = send, recv, bytearray()
+    def read(self, n):
+        while len(self.buf) < n:
+            chunk = self._recv()
+            if not chunk: raise ConnectionError("peer closed")
+            self.buf += chunk
+        out = bytes(self.buf[:n]); del self.buf[:n]
+        return out
+
+def _tcp_stream(port):
+    s = socket.create_connection(("127.0.0.1", port))
+    s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return _Stream(s.sendall, lambda: s.recv(262144)), s.close
+
+def _ws_stream(url, cookie):
+    import websocket  # websocket-client
+    ws = websocket.create_connection(url, cookie=cookie, enable_multithread=True)
+    def recv():
+        m = ws.recv()
+        return m.encode() if isinstance(m, str) else m
+    return _Stream(lambda b: ws.send_binary(b), recv), ws.close
+
+def rfb_handshake(st):
+    """Client side of the RFB 3.8 handshake with no authentication; returns (w, h)."""
+    st.read(12); st.send(b"RFB 003.008\n")
+    n = st.read(1)[0]; st.read(n); st.send(b"\x01")
+    if st.read(4) != b"\x00\x00\x00\x00": raise ConnectionError("security failed")
+    st.send(b"\x01")
+    w, h = struct.unpack(">HH", st.read(4)); st.pixel_format = st.read(16)
+    st.read(struct.unpack(">I", st.read(4))[0])
+    return w, h
+
+def rfb_update(st, w, h, incremental=1, bpp=32, sink=None):
+    """Request one framebuffer update and read it (Raw rectangles only);
+    returns the number of payload bytes received. Pixel data is passed to
+    sink() when given."""
+    st.send(struct.pack(">BBHHHH", 3, incremental, 0, 0, w, h))
+    _, n = struct.unpack(">BxH", st.read(4))
+    total = 4
+    for _ in range(n):
+        _, _, rw, rh, _ = struct.unpack(">HHHHi", st.read(12))
+        px = st.read(rw * rh * bpp // 8); total += 12 + len(px)
+        if sink: sink(px)
+    return total
+
+# ═══════════════════════════════════════════════════════════
+# WEBRTC TRANSPORT
+# ═══════════════════════════════════════════════════════════
+def _rtc_stream(server, timeout=15):
+    """An aiortc peer that negotiates through /api/rtc and splits input the
+    way RTC_SHIM does; returns (_Stream over "rfb", close)."""
+    import asyncio, queue
+    from aiortc import RTCPeerConnection, RTCSessionDescription
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    run = lambda coro: asyncio.run_coroutine_threadsafe(coro, loop).result(timeout)
+    inbox, opened, state = queue.Queue(), threading.Event(), {"seq":0, "mask":-1}
+    async def offer():
+        pc = RTCPeerConnection()
+        chans = {"rfb":pc.createDataChannel("rfb"), "keys":pc.createDataChannel("keys"),
+                 "input":pc.createDataChannel("input", ordered=False, maxRetransmits=0)}
+        chans["rfb"].on("open", opened.set)
+        chans["rfb"].on("message", inbox.put)
+        chans["rfb"].on("close", lambda: inbox.put(b""))
+        await pc.setLocalDescription(await pc.createOffer())
+        return pc, chans
+    pc, chans = run(offer())
+    req = urllib.request.Request(server.base + "/api/rtc", headers={"Content-Type":"application/json"},
+        data=json.dumps({"sdp":pc.localDescription.sdp, "type":pc.localDescription.type}).encode())
+    answer = json.loads(server.opener.open(req, timeout=timeout).read())
+    run(pc.setRemoteDescription(RTCSessionDescription(**answer)))
+    if not opened.wait(timeout): raise ConnectionError("data channel did not open")
+    def send(b):
+        if not (len(b) == 6 and b[0] == 5 or len(b) == 8 and b[0] == 4):
+            return loop.call_soon_threadsafe(chans["rfb"].send, b)
+        state["seq"] += 1
+        move = b[0] == 5 and b[1] == state["mask"]
+        if b[0] == 5: state["mask"] = b[1]
+        loop.call_soon_threadsafe(chans["input" if move else "keys"].send, struct.pack(">I", state["seq"]) + b)
+    def close():
+        run(pc.close()); loop.call_soon_threadsafe(loop.stop)
+    return _Stream(send, inbox.get), close
+
+def _netem(loss, delay_ms):
+    """Apply `loss`% packet loss and `delay_ms` one-way delay to loopback;
+    returns an error string when tc can't."""
+    subprocess.run(["tc", "qdisc", "del", "dev", "lo", "root"], capture_output=True)
+    if not loss and not delay_ms: return None
+    if not shutil.which("tc"): return "tc not installed"
+    r = subprocess.run(["tc", "qdisc", "add", "dev", "lo", "root", "netem", "loss", f"{loss}%",
+                        "delay", f"{delay_ms}ms"], capture_output=True, text=True)
+    return r.stderr.strip() or None if r.returncode else None
+
+def _input_latency(st, args):
+    """Send --events key presses and pointer moves, alternating, every
+    --interval ms while the screen streams --update-kb updates at --fps.
+    Returns ({"key": [ms], "move": [ms]}, moves lost)."""
+    w, h = rfb_handshake(st)
+    sent, got, lock, done = {}, {"key":[], "move":[]}, threading.Lock(), threading.Event()
+    pending = threading.Event(); pending.set()
+    def reader():
+        try:
+            while not done.is_set():
+                _, n = struct.unpack(">BxH", st.read(4))
+                for _ in range(n):
+                    x, y, rw, rh, _ = struct.unpack(">HHHHi", st.read(12)); st.read(rw * rh * 4)
+                    if y == 0: pending.set(); continue
+                    with lock: t0 = sent.pop((x, y), None)
+                    if t0 is not None: got["key" if y == 2 else "move"].append((time.perf_counter() - t0) * 1000)
+        except (ConnectionError, OSError): pass
+    def screen():
+        while not done.wait(1 / args.fps):
+            if pending.is_set(): pending.clear(); st.send(struct.pack(">BBHHHH", 3, 0, 0, 0, w, h))
+    threading.Thread(target=reader, daemon=True).start()
+    threading.Thread(target=screen, daemon=True).start()
+    time.sleep(0.5)
+    for i in range(args.events):
+        eid = 1 + i % 0x7ffe
+        with lock: sent[(eid, 2 if i % 2 else 1)] = time.perf_counter()
+        st.send(struct.pack(">BBxxI", 4, 1, eid) if i % 2 else struct.pack(">BBHH", 5, 0, eid, 1))
+        time.sleep(args.interval / 1000)
+    time.sleep(2)
+    done.set()
+    with lock: lost = sum(1 for _, y in sent if y == 1)
+    return got, lost
+
+def bench_rtc(args):
+    """p95 input latency over /ws and over the WebRTC data channels at each
+    --loss % (netem on loopback), with the screen streaming meanwhile."""
+    try: import aiortc  # noqa: F401
+    except ImportError: return {"skipped":"aiortc not installed (pip install aiortc)"}
+    tmp = Path(tempfile.mkdtemp(prefix="qs_bench_rtc_"))
+    qs.AUTH_FILE = tmp / "auth.txt"
+    qs.AUTH_FILE.write_text(f"bench:{qs._scrypt_hash('bench')}\n")
+    qs._reload_auth()
+    fake = FakeRFB(update_bytes=args.update_kb * 1024, echo=True)
+    qs.VNC_PORT = fake.port
+    server = _Server("bench", "bench")
+    ws_url = server.base.replace("http", "ws", 1) + "/ws"
+    results, skipped = [], {}
+    try:
+        for loss in [float(x) for x in args.loss.split(",")]:
+            err = _netem(loss, args.delay)
+            if err: skipped[f"loss_{loss:g}"] = err; continue
+            try:
+                row = {"loss_pct":loss, "delay_ms":args.delay}
+                for name, open_stream in (("ws", lambda: _ws_stream(ws_url, server.cookie())),
+                                          ("rtc", lambda: _rtc_stream(server))):
+                    st, close = open_stream()
+                    try: got, lost = _input_latency(st, args)
+                    finally: close()
+                    for kind, ms in got.items():
+                        row[f"{name}_{kind}_p50_ms"] = round(_percentile(ms, 50), 2) if ms else None
+                        row[f"{name}_{kind}_p95_ms"] = round(_percentile(ms, 95), 2) if ms else None
+                    row[f"{name}_moves_lost"] = lost
+                results.append(row)
+            finally: _netem(0, 0)
+    finally:
+        server.close(); fake.close()
+    return {"events":args.events, "results":results, "skipped":skipped}
+
+# ═══════════════════════════════════════════════════════════
+# BANDWIDTH SHAPING
+# ═══════════════════════════════════════════════════════════
+def bench_shaping(args):
+    """--users greedy viewers (one /ws each, requesting the next update as
+    soon as the last arrives, like noVNC on a busy page) share a
+    --host-mbit budget with --weights, next to one light viewer asking for
+    a small update every 200 ms. Reports each user's throughput against its
+    weighted fair share, Jain's index over throughput/fair share, and the light
+    viewer's update round trip."""
+    names = [f"user{i}" for i in range(args.users)]
+    weights = [float(w) for w in args.weights.split(",")] if args.weights else []
+    weights = (weights + [1.0] * args.users)[:args.users]
+    tmp = Path(tempfile.mkdtemp(prefix="qs_bench_shaping_"))
+    qs.AUTH_FILE = tmp / "auth.txt"
+    qs.AUTH_FILE.write_text("".join(f"{u}:{qs._scrypt_hash('bench')}\n" for u in names + ["light"]))
+    qs._reload_auth()
+    qs.BW_HOST, qs.BW_SESSION, qs.BW_USER = args.host_mbit * 125_000, args.session_mbit * 125_000, 0
+    qs.BW_WEIGHTS = dict(zip(names, weights))
+    fake = FakeRFB(update_bytes=args.update_kb * 1024)
+    qs.VNC_PORT = fake.port
+    server = _Server("light", "bench")
+    ws_url = server.base.replace("http", "ws", 1) + "/ws"
+    def cookie(user):
+        jar = http.cookiejar.CookieJar()
+        if not server.login(urllib.request.build_opener(urllib.request.HTTPCookieProcessor(jar)), user):
+            raise RuntimeError(f"login failed for {user}")
+        return "; ".join(f"{c.name}={c.value}" for c in jar)
+    stop, got, rtt = threading.Event(), {u: 0 for u in names}, []
+    def greedy(user, c):
+        st, close = _ws_stream(ws_url, c)
+        try:
+            w, h = rfb_handshake(st)
+            while not stop.is_set(): got[user] += rfb_update(st, w, h)
+        except (ConnectionError, OSError): pass
+        finally: close()
+    def light(c):
+        st, close = _ws_stream(ws_url, c)
+        try:
+            w, h = rfb_handshake(st)
+            while not stop.wait(0.2):
+                t0 = time.perf_counter(); rfb_update(st, 1, 1); rtt.append((time.perf_counter() - t0) * 1000)
+        except (ConnectionError, OSError): pass
+        finally: close()
+    cookies = {u: cookie(u) for u in names}
+    threads = [threading.Thread(target=greedy, args=(u, cookies[u]), daemon=True) for u in names]
+    threads.append(threading.Thread(target=light, args=(server.cookie(),), daemon=True))
+    try:
+        for t in threads: t.start()
+        time.sleep(args.warmup)
+        base, t0 = dict(got), time.monotonic()
+        time.sleep(args.seconds)
+        span = time.monotonic() - t0
+        rates = {u: (got[u] - base[u]) * 8 / 1e6 / span for u in names}
+        status = qs._bw_view("admin")
+        stop.set()
+        for t in threads: t.join(5)
+    finally:
+        server.close(); fake.close()
+    fair = _waterfill_share(args.host_mbit, args.session_mbit, weights)
+    x = [rates[u] / f for u, f in zip(names, fair)]
+    return {"host_mbit":args.host_mbit, "session_mbit":args.session_mbit or None, "update_kb":args.update_kb,
+            "users":[{"user":u, "weight":w, "mbit":round(rates[u], 2), "fair_mbit":round(f, 2)}
+                     for u, w, f in zip(names, weights, fair)],
+            "total_mbit":round(sum(rates.values()), 2),
+            "jain_index":round(sum(x) ** 2 / (len(x) * sum(v * v for v in x)), 4) if any(x) else None,
+            "light_rtt_p50_ms":round(_percentile(rtt, 50), 2) if rtt else None,
+            "light_rtt_p95_ms":round(_percentile(rtt, 95), 2) if rtt else None,
+            "merged_requests":sum(c["merged"] for c in status["connections"])}
+
+def _waterfill_share(host_mbit, session_mbit, weights):
+    """Expected Mbit/s per greedy user (the light viewer's use ignored)."""
+    caps = {i: session_mbit or float("inf") for i in range(len(weights))}
+    shares = qs._waterfill(host_mbit, caps, dict(enumerate(weights)))
+    return [shares[i] for i in range(len(weights))]
+
+# ═══════════════════════════════════════════════════════════
+# SESSION TRACE REPLAY
+# ═══════════════════════════════════════════════════════════
+_HANDSHAKE_C2S = 14   # version (12) + security type (1) + ClientInit (1), no-auth x11vnc
+
+def _c2s_messages(data):
+    """Split client->server bytes into whole RFB messages. The bridge records
+    one websocket message per record and noVNC only sends whole messages, so
+    records start on message boundaries."""
+    msgs, i = [], 0
+    while i < len(data):
+        t = data[i]
+        if t == 2 and i + 4 <= len(data): n = 4 + 4 * struct.unpack_from(">H", data, i + 2)[0]
+        elif t == 6 and i + 8 <= len(data): n = 8 + struct.unpack_from(">I", data, i + 4)[0]
+        elif t in FakeRFB._CLIENT_MSG: n = 1 + FakeRFB._CLIENT_MSG[t]
+        else: break
+        msgs.append(data[i:i + n]); i += n
+    return msgs
+
+def _replay_clock(speed):
+    """Returns wait(t_us) that sleeps until a record's scheduled time (never,
+    with speed 0) and reports how late it fired, in ms."""
+    start = {}
+    def wait(t_us):
+        now = time.monotonic()
+        if not speed: return 0.0
+        start.setdefault("wall", now); start.setdefault("t", t_us)
+        due = start["wall"] + (t_us - start["t"]) / 1e6 / speed
+        if due > now: time.sleep(due - now); return 0.0
+        return (now - due) * 1000
+    return wait
+
+def _replay_info(args):
+    idx = qs._trace_index(args.trace)
+    with open(args.trace, "rb") as f: hdr = qs._trace_header(f)
+    keys = [t / 1e6 for t, _, kind in idx if kind == 1]
+    return {"header":hdr, "blocks":len(idx), "keyframes_s":[round(k, 3) for k in keys],
+            "duration_s":round(idx[-1][0] / 1e6, 3) if idx else 0,
+            "file_bytes":os.path.getsize(args.trace)}
+
+def _replay_png(args):
+    t0 = time.perf_counter()
+    for kind, t_us, val in qs._trace_iter(args.trace, args.from_s):
+        if kind == "key":
+            w, h, rows = val
+            Path(args.out).write_bytes(qs._png_encode(w, h, rows))
+            return {"keyframe_s":round(t_us / 1e6, 3), "width":w, "height":h, "out":args.out,
+                    "seek_ms":round((time.perf_counter() - t0) * 1000, 2)}
+    return {"error":"no keyframe in trace", "exit_code":1}
+
+def _replay_client(args):
+    """Fake client: handshake with --target, resend the recorded pixel
+    format/encodings, then the recorded input and update requests from the
+    keyframe at or before --from, draining whatever the server sends."""
+    host, _, port = args.target.rpartition(":")
+    sock = socket.create_connection((host or "127.0.0.1", int(port)))
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    st = _Stream(sock.sendall, lambda: sock.recv(262144))
+    rfb_handshake(st)
+    received = [0]
+    def drain():
+        try:
+            while True:
+                b = sock.recv(262144)
+                if not b: return
+                received[0] += len(b)
+        except OSError: pass
+    threading.Thread(target=drain, daemon=True).start()
+    def c2s(start_s):
+        seen = 0
+        for kind, t_us, (d, data) in ((k, t, v) for k, t, v in qs._trace_iter(args.trace, start_s) if k == "rec"):
+            if d != qs.TRACE_C2S: continue
+            if start_s == 0 and seen < _HANDSHAKE_C2S:
+                cut = min(len(data), _HANDSHAKE_C2S - seen); seen += cut; data = data[cut:]
+            for m in _c2s_messages(data): yield t_us, m
+    keys = [t for t, _, kind in qs._trace_index(args.trace) if kind == 1]
+    seek = args.from_s if len(keys) > 1 and args.from_s * 1e6 >= keys[1] else 0
+    if seek:   # the server must encode the way the recorded one did
+        for _, m in c2s(0):
+            if m[0] == 3: break
+            if m[0] in (0, 2): sock.sendall(m)
+    wait, lags, sent, t_last = _replay_clock(args.speed), [], 0, 0
+    t0 = time.perf_counter()
+    for t_us, m in c2s(seek):
+        if t_us < args.from_s * 1e6: sock.sendall(m); continue
+        lags.append(wait(t_us)); sock.sendall(m); sent += 1; t_last = t_us
+    time.sleep(0.2); sock.close()
+    key_s = max((k for k in keys if k <= seek * 1e6), default=0) / 1e6
+    return {"mode":"client", "from_s":args.from_s, "seek_keyframe_s":round(key_s, 3),
+            "messages_sent":sent, "bytes_received":received[0], "trace_span_s":round(t_last / 1e6, 3),
+            "wall_s":round(time.perf_counter() - t0, 3),
+            "lag_p95_ms":round(_percentile(lags, 95), 2), "lag_max_ms":round(max(lags, default=0), 2)}
+
+def _replay_server(args):
+    """Fake server: accept one viewer on --port and send it the recorded
+    server->client stream. RFB encodings (ZRLE, Tight) carry zlib state
+    across updates, so the stream cannot be entered mid-way: everything
+    before --from is sent at full speed, the rest at --speed."""
+    ls = socket.socket(); ls.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    ls.bind(("127.0.0.1", args.port)); ls.listen(1)
+    print(f"replay server on 127.0.0.1:{ls.getsockname()[1]}", file=sys.stderr, flush=True)
+    c, _ = ls.accept(); ls.close()
+    c.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    def drain():
+        try:
+            while c.recv(65536): pass
+        except OSError: pass
+    threading.Thread(target=drain, daemon=True).start()
+    wait, lags, sent, gaps = _replay_clock(args.speed), [], 0, 0
+    from_us, t0, t_last = args.from_s * 1e6, time.perf_counter(), 0
+    try:
+        for kind, t_us, (d, data) in ((k, t, v) for k, t, v in qs._trace_iter(args.trace) if k == "rec"):
+            if d == qs.TRACE_GAP: gaps += data; continue
+            if d != qs.TRACE_S2C: continue
+            if t_us >= from_us: lags.append(wait(t_us))
+            c.sendall(data); sent += len(data); t_last = t_us
+    except OSError: pass
+    finally: c.close()
+    return {"mode":"server", "from_s":args.from_s, "bytes_sent":sent, "gap_bytes":gaps,
+            "trace_span_s":round(t_last / 1e6, 3), "wall_s":round(time.perf_counter() - t0, 3),
+            "lag_p95_ms":round(_percentile(lags, 95), 2), "lag_max_ms":round(max(lags, default=0), 2)}
+
+def bench_replay(args):
+    """Inspect or replay a QS_TRACE_DIR recording (see README)."""
+    return {"info":_replay_info, "png":_replay_png, "client":_replay_client,
+            "server":_replay_server}[args.mode](args)
+
+# ═══════════════════════════════════════════════════════════
+# PROFILE SNAPSHOTS
+# ═══════════════════════════════════════════════════════════
+def _fake_profile(root, rng):
+    """Roughly the shape of a Chromium profile after some browsing: many
+    small LevelDB/IndexedDB files, a few SQLite databases, and a cache
+    directory that snapshots must skip."""
+    def put(rel, size):
+        p = root / rel; p.parent.mkdir(parents=True, exist_ok=True)
+        half = rng.randbytes(size // 2)
+        p.write_bytes(half + bytes(size - len(half)))   # about 2:1 compressible
+    for name, size in (("History", 2 << 20), ("Cookies", 512 << 10), ("Web Data", 1 << 20),
+                       ("Favicons", 1 << 20), ("Preferences", 64 << 10), ("Sessions/Session_1", 256 << 10)):
+        put(f"Default/{name}", size)
+    for i in range(200): put(f"Default/Local Storage/leveldb/{i:06d}.ldb", 20 << 10)
+    for i in range(50): put(f"Default/IndexedDB/https_app_0.indexeddb.leveldb/{i:06d}.ldb", 100 << 10)
+    for i in range(500): put(f"Default/Cache/Cache_Data/f_{i:06x}", 50 << 10)
+
+def bench_profile(args):
+    """Snapshot a profile cold, again after --touch files change, and
+    restore it. Uses --profile (read only) or a generated one."""
+    tmp = Path(tempfile.mkdtemp(prefix="qs_bench_profile_"))
+    qs.PROFILE_STORE = tmp / "store"
+    rng = random.Random(1)
+    src = Path(args.profile) if args.profile else tmp / "src"
+    if not args.profile: _fake_profile(src, rng)
+    try:
+        total = sum(p.stat().st_size for p in src.rglob("*") if p.is_file())
+        cold = qs._profile_snapshot(str(src), "bench")
+        if not args.profile:
+            files = sorted(p for p in src.rglob("*.ldb"))
+            for p in rng.sample(files, min(args.touch, len(files))): p.write_bytes(rng.randbytes(p.stat().st_size))
+        warm = qs._profile_snapshot(str(src), "bench")
+        dst = tmp / "restored"
+        restore = qs._profile_restore("bench", str(dst))
+        restored = sum(p.stat().st_size for p in dst.rglob("*") if p.is_file())
+        return {"profile_bytes":total, "restored_bytes":restored,
+                "store_bytes":warm["stored_bytes"] if warm else None,
+                "cold_snapshot_s":cold and cold["seconds"], "incremental_snapshot_s":warm and warm["seconds"],
+                "incremental_read_bytes":warm and warm["read_bytes"], "files":restore and restore["files"],
+                "restore_s":restore and restore["seconds"]}
+    finally: shutil.rmtree(tmp, ignore_errors=True)
+
+# ═══════════════════════════════════════════════════════════
+# COLOUR DEPTH
+# ═══════════════════════════════════════════════════════════
+_DEPTH_WORKLOAD = ("data:text/html,<body style='margin:0;font:14px monospace'>"
+    "<div id=b style='position:fixed;right:0;top:0;width:300px;height:300px'></div><pre id=t></pre><script>"
+    "let i=0;setInterval(()=>{t.textContent+='line '+(i++)+' the quick brown fox jumps over the lazy dog\\n';"
+    "scrollTo(0,1e9);b.style.background='linear-gradient('+(i*7%360)+'deg,red,blue)'},50)</script>")
+
+def bench_depth(args):
+    """For each of --depths, start Xvfb + x11vnc at that depth with Chromium
+    scrolling text and animating a gradient, read incremental updates from
+    x11vnc in its native pixel format for --seconds, and report Xvfb RSS,
+    x11vnc CPU and bytes/s (Raw, plus zlib as a stand-in for ZRLE/Tight)."""
+    if not shutil.which("Xvfb") or not shutil.which("x11vnc"): return {"skipped":"Xvfb or x11vnc not installed"}
+    qs.CHROME_BIN = qs.CHROME_BIN or qs._find_chromium()
+    qs.PROFILE_SNAPSHOTS = False
+    out = {}
+    for depth in (int(d) for d in args.depths.split(",")):
+        for name in ("chromium", "x11vnc", "xvfb"): qs._kill_proc(name)
+        qs._profile_save()
+        if not qs._start_xvfb(args.width, args.height, depth): out[f"d{depth}"] = "Xvfb failed"; continue
+        if qs.CHROME_BIN and qs._launch_chromium(args.width, args.height):
+            env = qs._build_lib_env(); env["DISPLAY"] = qs.XVFB_DISPLAY
+            subprocess.Popen([qs.CHROME_BIN, f"--user-data-dir={qs.CHROME_PROFILE}", _DEPTH_WORKLOAD], env=env,
+                             stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        if not qs._start_x11vnc(): out[f"d{depth}"] = "x11vnc failed"; continue
+        time.sleep(2)
+        st, close = _tcp_stream(qs.VNC_PORT)
+        w, h = rfb_handshake(st); bpp = st.pixel_format[0]
+        z = zlib.compressobj(1); counts = {"raw":0, "zlib":0, "updates":0}
+        def sink(px): counts["zlib"] += len(z.compress(px)) + len(z.flush(zlib.Z_SYNC_FLUSH))
+        def pull():
+            try:
+                rfb_update(st, w, h, 0, bpp, sink)
+                while True: counts["raw"] += rfb_update(st, w, h, 1, bpp, sink); counts["updates"] += 1
+            except (OSError, ConnectionError): pass
+        vnc = [p for p in qs._proc_tree(qs.PROCS["x11vnc"].pid)]
+        c0, t0 = qs._proc_cpu_seconds(vnc), time.monotonic()
+        threading.Thread(target=pull, daemon=True).start()
+        time.sleep(args.seconds)
+        el = time.monotonic() - t0
+        m = {"bits_per_pixel":bpp, "xvfb_rss_bytes":qs._proc_rss([qs.PROCS["xvfb"].pid]),
+             "x11vnc_cpu_pct":round((qs._proc_cpu_seconds(vnc) - c0) * 100 / el, 1),
+             "raw_bytes_per_s":int(counts["raw"] / el), "zlib_bytes_per_s":int(counts["zlib"] / el),
+             "updates_per_s":round(counts["updates"] / el, 1)}
+        close()
+        out[f"d{depth}"] = m
+    for name in ("chromium", "x11vnc", "xvfb"): qs._kill_proc(name)
+    qs._profile_save()
+    return {"width":args.width, "height":args.height, "seconds":args.seconds, "depths":out}
+
+# ═══════════════════════════════════════════════════════════
+# CHROMIUM PRESETS
+# ═══════════════════════════════════════════════════════════
+def _pss(pids):
+    """Proportional set size in bytes: shared pages are split between the
+    processes mapping them, so unlike RSS it sums correctly over a tree."""
+    total = 0
+    for p in pids:
+        try:
+            with open(f"/proc/{p}/smaps_rollup") as f:
+                total += next(int(l.split()[1]) for l in f if l.startswith("Pss:")) * 1024
+        except (OSError, StopIteration, ValueError): pass
+    return total
+
+def _evict_chromium():
+    for f in qs._chrome_files():
+        try:
+            fd = os.open(f, os.O_RDONLY)
+            try: os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+            finally: os.close(fd)
+        except (OSError, AttributeError): pass
+
+def bench_chrome(args):
+    """For each of --presets, launch Chromium on a fresh Xvfb and report the
+    time until its window is mapped, then open --tabs copies of the depth
+    workload and report RSS and PSS of the Chromium process tree after
+    --settle seconds. Each preset is launched with Chromium's files evicted
+    from the page cache (cold) and again after prewarming (warm); eviction
+    only drops clean pages nobody else has mapped, so the cold number is a
+    lower bound on a real first boot."""
+    if not shutil.which("Xvfb"): return {"skipped":"Xvfb not installed"}
+    qs.CHROME_BIN = qs.CHROME_BIN or qs._find_chromium()
+    if not qs.CHROME_BIN: return {"skipped":"Chromium not installed"}
+    qs.PROFILE_SNAPSHOTS = False
+    out = {}
+    for preset in args.presets.split(","):
+        m = out[preset] = {}
+        for label in ("cold", "warm"):
+            for name in ("chromium", "xvfb"): qs._kill_proc(name)
+            if not qs._start_xvfb(args.width, args.height): m[label] = "Xvfb failed"; continue
+            if label == "cold": _evict_chromium()
+            else: qs._prewarm_chromium(); time.sleep(1)
+            t0 = time.monotonic()
+            if not qs._launch_chromium(args.width, args.height, preset): m[label] = "Chromium failed"; continue
+            m[f"{label}_window_mapped_s"] = qs.CHROME_LAUNCH.get("mapped_s")
+            m[f"{label}_launch_s"] = round(time.monotonic() - t0, 3)
+        if "chromium" not in qs.PROCS or qs.PROCS["chromium"].poll() is not None: continue
+        env = qs._build_lib_env(); env["DISPLAY"] = qs.XVFB_DISPLAY
+        subprocess.Popen([qs.CHROME_BIN, f"--user-data-dir={qs.CHROME_PROFILE}"] + [_DEPTH_WORKLOAD] * args.tabs,
+                         env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        time.sleep(args.settle)
+        tree = qs._proc_tree(qs.PROCS["chromium"].pid)
+        m.update(processes=len(tree), rss_bytes=qs._proc_rss(tree), pss_bytes=_pss(tree),
+                 flags=qs._chrome_preset_args(preset))
+    for name in ("chromium", "xvfb"): qs._kill_proc(name)
+    return {"width":args.width, "height":args.height, "tabs":args.tabs, "settle_s":args.settle, "presets":out}
+
+# ═══════════════════════════════════════════════════════════
+# END-TO-END SUITE
+# ═══════════════════════════════════════════════════════════
+HIGHER_IS_BETTER = ("_per_s", "_mbps")
+NOISE_FLOOR = {"_ms": 1.0, "_s": 0.05, "_pct": 0.5, "_bytes": 1024}
+
+class _NoRedirect(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, *a, **kw): return None
+
+class _Server:
+    """The real Flask app on a loopback port, with a logged-in cookie jar."""
+    def __init__(self, user, password):
+        from werkzeug.serving import make_server
+        logging.getLogger("werkzeug").setLevel(logging.ERROR)
+        self.srv = make_server("127.0.0.1", 0, qs.app, threaded=True)
+        self.base = f"http://127.0.0.1:{self.srv.server_port}"
+        threading.Thread(target=self.srv.serve_forever, daemon=True).start()
+        self.user, self.password = user, password
+        self.jar = http.cookiejar.CookieJar()
+        self.opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(self.jar))
+        if not self.login(self.opener): raise RuntimeError("bench login failed")
+    def login(self, opener, user=None):
+        page = opener.open(self.base + "/login").read().decode()
+        csrf = re.search(r'name="csrf_token" value="([0-9a-f]+)"', page).group(1)
+        body = urlencode({"csrf_token":csrf, "username":user or self.user, "password":self.password}).encode()
+        try: opener.open(self.base + "/login", data=body)
+        except urllib.error.HTTPError as e: return e.code == 302
+        return True
+    def cookie(self): return "; ".join(f"{c.name}={c.value}" for c in self.jar)
+    def close(self): self.srv.shutdown()
+
+def _part_stack(args, m):
+    qs.CHROME_BIN = qs.CHROME_BIN or qs._find_chromium()
+    if not qs.CHROME_BIN or not shutil.which("Xvfb") or not shutil.which("x11vnc"):
+        return "Chromium, Xvfb or x11vnc not installed"
+    for name in ("chromium", "x11vnc", "xvfb"): qs._kill_proc(name)
+    w, h = args.width, args.height
+    for label in ("cold", "warm"):
+        t0 = time.monotonic()
+        if not qs._restart_stack(w, h): return f"stack failed to start ({label})"
+        m[f"stack_{label}_total_s"] = round(time.monotonic() - t0, 3)
+        for k, v in qs.STACK_TIMINGS.items():
+            if k != "total": m[f"stack_{label}_{k}_s"] = v
+    t0 = time.monotonic(); qs._restart_stack(w, h)
+    m["restart_s"] = round(time.monotonic() - t0, 3)
+    t0 = time.monotonic(); qs._restart_stack(w - 160, h - 90)
+    m["resize_s"] = round(time.monotonic() - t0, 3)
+    time.sleep(3)  # let Chromium settle before measuring idle
+    pids = [p for proc in list(qs.PROCS.values()) for p in qs._proc_tree(proc.pid)]
+    c0 = qs._proc_cpu_seconds(pids); t0 = time.monotonic()
+    time.sleep(args.idle_seconds)
+    m["idle_cpu_pct"] = round((qs._proc_cpu_seconds(pids) - c0) * 100 / (time.monotonic() - t0), 2)
+    m["idle_rss_bytes"] = qs._proc_rss(pids)
+    for name in ("chromium", "x11vnc", "xvfb"): qs._kill_proc(name)
+
+def _part_bridge(args, m, server):
+    fake = FakeRFB(update_bytes=64)
+    old_port, qs.VNC_PORT = qs.VNC_PORT, fake.port
+    try:
+        def run(open_stream):
+            st, close = open_stream()
+            try:
+                w, h = rfb_handshake(st)
+                fake.set_update_bytes(64)
+                rtt = []
+                for _ in range(args.samples):
+                    t0 = time.perf_counter(); rfb_update(st, w, h); rtt.append((time.perf_counter() - t0) * 1000)
+                fake.set_update_bytes(1 << 20)
+                t0 = time.perf_counter(); total = sum(rfb_update(st, w, h) for _ in range(args.updates))
+                return rtt, total * 8 / 1e6 / (time.perf_counter() - t0)
+            finally: close()
+        direct_rtt, direct_mbps = run(lambda: _tcp_stream(fake.port))
+        ws_url = server.base.replace("http", "ws", 1) + "/ws"
+        bridge_rtt, bridge_mbps = run(lambda: _ws_stream(ws_url, server.cookie()))
+        m["bridge_rtt_p50_ms"] = round(_percentile(bridge_rtt, 50), 3)
+        m["bridge_rtt_p95_ms"] = round(_percentile(bridge_rtt, 95), 3)
+        m["bridge_added_p50_ms"] = round(_percentile(bridge_rtt, 50) - _percentile(direct_rtt, 50), 3)
+        m["bridge_throughput_mbps"] = round(bridge_mbps, 1)
+        m["direct_throughput_mbps"] = round(direct_mbps, 1)
+    finally:
+        qs.VNC_PORT = old_port; fake.close()
+
+def _part_login(args, m, server):
+    lat = []
+    t_all = time.perf_counter()
+    for _ in range(args.logins):
+        op = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()), _NoRedirect)
+        t0 = time.perf_counter()
+        if not server.login(op): return "login rejected"
+        lat.append((time.perf_counter() - t0) * 1000)
+    m["login_per_s"] = round(args.logins / (time.perf_counter() - t_all), 1)
+    m["login_p95_ms"] = round(_percentile(lat, 95), 2)
+
+def _part_novnc(args, m, server):
+    qs.NOVNC_WEB_ROOT = qs.NOVNC_WEB_ROOT or qs._find_novnc()
+    if not qs.NOVNC_WEB_ROOT: return "noVNC files not installed"
+    seen, todo, total = set(), ["/novnc/vnc.html"], 0
+    t0 = time.perf_counter()
+    while todo:
+        path = todo.pop(0)
+        if path in seen: continue
+        seen.add(path)
+        try: body = server.opener.open(server.base + path).read()
+        except urllib.error.HTTPError: continue
+        total += len(body)
+        if not path.endswith((".html", ".js")): continue
+        text = body.decode(errors="replace")
+        refs = re.findall(r'(?:src|href)="([^"#?:]+)"', text) + \
+               re.findall(r'(?:\bfrom|\bimport)\s*\(?\s*[\'"]([^\'"]+)[\'"]', text)
+        for ref in refs:
+            u = urlparse(urljoin(path, ref)).path
+            if u.startswith("/novnc/") and u not in seen: todo.append(u)
+    m["novnc_page_bytes"] = total
+    m["novnc_page_files"] = len(seen)
+    m["novnc_page_load_ms"] = round((time.perf_counter() - t0) * 1000, 1)
+
+def compare(metrics, baseline, threshold):
+    """Regressions beyond `threshold` (relative) and the metric's noise floor."""
+    out = []
+    for k, base in baseline.items():
+        cur = metrics.get(k)
+        if not isinstance(cur, (int, float)) or not isinstance(base, (int, float)) or not base: continue
+        worse = (base - cur) if k.endswith(HIGHER_IS_BETTER) else (cur - base)
+        floor = next((v for suf, v in NOISE_FLOOR.items() if k.endswith(suf)), 0)
+        if worse > floor and worse / abs(base) > threshold:
+            out.append({"metric":k, "baseline":base, "current":cur, "change_pct":round(worse * 100 / abs(base), 1)})
+    return out
+
+def bench_suite(args):
+    parts = set(args.parts.split(","))
+    tmp = Path(tempfile.mkdtemp(prefix="qs_bench_suite_"))
+    qs.AUTH_FILE = tmp / "auth.txt"
+    qs.AUTH_FILE.write_text(f"bench:{qs._scrypt_hash('bench')}\n")
+    qs._reload_auth()
+    m, skipped = {}, {}
+    if "stack" in parts: skipped["stack"] = _part_stack(args, m)
+    server = _Server("bench", "bench")
+    try:
+        if "bridge" in parts: skipped["bridge"] = _part_bridge(args, m, server)
+        if "login" in parts: skipped["login"] = _part_login(args, m, server)
+        if "novnc" in parts: skipped["novnc"] = _part_novnc(args, m, server)
+    finally: server.close()
+    result = {"host":{"cpus":os.cpu_count(), "python":sys.version.split()[0]},
+              "metrics":m, "skipped":{k: v for k, v in skipped.items() if v}}
+    if args.save_baseline:
+        Path(args.save_baseline).write_text(json.dumps(m, indent=2))
+    if args.baseline:
+        regressions = compare(m, json.loads(Path(args.baseline).read_text()), args.threshold)
+        result["regressions"] = regressions
+        result["exit_code"] = 1 if regressions else 0
+    return result
+
+COMMANDS = {
+    "ratelimit": (bench_ratelimit, lambda p: (
+        p.add_argument("--ips", type=int, default=1_000_000),
+        p.add_argument("--capacity", type=int, default=qs.RATE_CAPACITY))),
+    "auth": (bench_auth, lambda p: (
+        p.add_argument("--users", type=int, default=5000),
+        p.add_argument("--logins", type=int, default=400),
+        p.add_argument("--concurrency", type=int, default=32))),
+    "suite": (bench_suite, lambda p: (
+        p.add_argument("--parts", default="stack,bridge,login,novnc"),
+        p.add_argument("--width", type=int, default=1280),
+        p.add_argument("--height", type=int, default=720),
+        p.add_argument("--idle-seconds", type=float, default=10),
+        p.add_argument("--samples", type=int, default=200),
+        p.add_argument("--updates", type=int, default=50),
+        p.add_argument("--logins", type=int, default=50),
+        p.add_argument("--baseline"), p.add_argument("--save-baseline"),
+        p.add_argument("--threshold", type=float, default=0.2))),
+    "profile": (bench_profile, lambda p: (
+        p.add_argument("--profile", help="existing Chromium user-data-dir (read only)"),
+        p.add_argument("--touch", type=int, default=10))),
+    "depth": (bench_depth, lambda p: (
+        p.add_argument("--depths", default="24,16,8"),
+        p.add_argument("--width", type=int, default=1920),
+        p.add_argument("--height", type=int, default=1080),
+        p.add_argument("--seconds", type=float, default=20))),
+    "chrome": (bench_chrome, lambda p: (
+        p.add_argument("--presets", default=",".join(qs.CHROME_PRESETS)),
+        p.add_argument("--tabs", type=int, default=4),
+        p.add_argument("--settle", type=float, default=20),
+        p.add_argument("--width", type=int, default=1280),
+        p.add_argument("--height", type=int, default=720))),
+    "rtc": (bench_rtc, lambda p: (
+        p.add_argument("--loss", default="0,1,2,3", help="comma-separated packet loss %% levels"),
+        p.add_argument("--delay", type=int, default=20, help="one-way delay added with the loss, ms"),
+        p.add_argument("--events", type=int, default=300),
+        p.add_argument("--interval", type=float, default=20, help="ms between input events"),
+        p.add_argument("--fps", type=float, default=30),
+        p.add_argument("--update-kb", type=int, default=64))),
+    "shaping": (bench_shaping, lambda p: (
+        p.add_argument("--host-mbit", type=float, default=40),
+        p.add_argument("--session-mbit", type=float, default=0),
+        p.add_argument("--users", type=int, default=3),
+        p.add_argument("--weights", default="2,1,1", help="comma-separated, one per user"),
+        p.add_argument("--update-kb", type=int, default=128),
+        p.add_argument("--warmup", type=float, default=2),
+        p.add_argument("--seconds", type=float, default=10))),
+    "replay": (bench_replay, lambda p: (
+        p.add_argument("trace"),
+        p.add_argument("--mode", choices=("info", "png", "client", "server"), default="info"),
+        p.add_argument("--from", dest="from_s", type=float, default=0.0),
+        p.add_argument("--speed", type=float, default=1.0),
+        p.add_argument("--target", default="127.0.0.1:5900"),
+        p.add_argument("--port", type=int, default=5901),
+        p.add_argument("--out", default="keyframe.png"))),
+}
+
+def main():
+    ap = argparse.ArgumentParser(description="QuantumSurf benchmarks")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    for name, (_, setup) in COMMANDS.items(): setup(sub.add_parser(name))
+    args = ap.parse_args()
+    # Stack log lines go to stderr so stdout stays a single JSON document.
+    with contextlib.redirect_stdout(sys.stderr):
+        result = COMMANDS[args.cmd][0](args)
+        qs._log_flush()
+    print(json.dumps({"benchmark":args.cmd, **result}, indent=2))
+    sys.exit(result.get("exit_code", 0))
+
+if __name__ == "__main__":
+    main()
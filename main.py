@@ -13,13 +13,18 @@ Architecture:
 FIXED: Stale Xvfb lock file /tmp/.X99-lock cleanup before start
 FIXED: -listen tcp for Xvfb 21.1+ compatibility
 """
-import os, re, json, time, html, hmac, hashlib, secrets, base64, tempfile, sys
-import threading, shutil, subprocess, multiprocessing, signal, io, tarfile, socket
-import urllib.request, zipfile, platform, ctypes.util
+import os, re, json, time, html, hmac, hashlib, secrets, base64, tempfile, sys, math
+import threading, shutil, subprocess, multiprocessing, signal, io, tarfile, socket, queue, itertools
+import contextlib, fcntl, asyncio
+import urllib.request, zipfile, platform, ctypes.util, mmap, struct, zlib
+from array import array
+import http.server, http.client, email.utils, select, stat, bisect
 from pathlib import Path
 from functools import wraps
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import timedelta
-from urllib.parse import urlparse, urlencode
+from urllib.parse import urlparse, urlencode, quote
 from flask import (Flask, request, Response, jsonify, session, redirect,
                    url_for, render_template_string, abort, make_response,
                    send_from_directory)
@@ -28,8 +33,21 @@ from termcolor import colored
 from colorama import init as colorama_init
 colorama_init(autoreset=True)
 
+try:
+    from PIL import Image  # optional — only needed for WebP thumbnails
+except ImportError:
+    Image = None
+
+try:
+    # optional — only needed for the WebRTC transport
+    from aiortc import RTCPeerConnection, RTCSessionDescription, RTCConfiguration, RTCIceServer
+    from aiortc.exceptions import InvalidStateError
+except ImportError:
+    RTCPeerConnection = None
+
 try:
     from flask_sock import Sock
+    from simple_websocket import ConnectionClosed
 except ImportError:
     print(colored("[!] flask-sock is required for the secure VNC bridge.", "red"))
     print(colored("    Install it with:  pip install flask-sock", "yellow"))
@@ -45,46 +63,256 @@ SESSION_LIFE = timedelta(hours=4)
 MAX_BODY = 32_768
 MAX_ATTEMPTS = 5
 ATTEMPT_WINDOW = 60
+USER_MAX_ATTEMPTS = int(os.environ.get("QS_USER_MAX_ATTEMPTS", "20"))  # per username per window
+RATE_CAPACITY = int(os.environ.get("QS_RATE_CAPACITY", "100000"))     # tracked IPs + usernames
+RATE_SHARDS = 16
+AUTH_WORKERS = int(os.environ.get("QS_AUTH_WORKERS", "2"))       # concurrent password hashes
+AUTH_QUEUE = int(os.environ.get("QS_AUTH_QUEUE", "32"))          # waiting checks before 503
+AUTH_CACHE_TTL = int(os.environ.get("QS_AUTH_CACHE_TTL", "300"))  # reuse of a verified password (s)
 DEBUG = os.environ.get("QS_DEBUG", "0") == "1"
+LOG_CAPACITY = max(64, int(os.environ.get("QS_LOG_CAPACITY", "2048")))  # ring-buffer log entries
 
 CHROME_DIR = BASE / ".chromium"
 LIBS_DIR = CHROME_DIR / "libs"
 NOVNC_DIR = BASE / ".novnc"
 
-XVFB_DISPLAY = ":99"
-XVFB_DISPLAY_NUM = 99  # Numeric part for lock file paths
-VNC_PORT = 5901       # x11vnc — 127.0.0.1 ONLY, never exposed
+XVFB_DISPLAY_NUM = int(os.environ.get("QS_DISPLAY", "99"))  # Numeric part for lock file paths
+XVFB_DISPLAY = f":{XVFB_DISPLAY_NUM}"
+VNC_PORT = int(os.environ.get("QS_VNC_PORT", "5901"))   # x11vnc — 127.0.0.1 ONLY, never exposed
 NOVNC_PORT = 6080     # kept as a constant for reference only; nothing binds to it anymore
-FLASK_PORT = 8000     # the only port that listens on 0.0.0.0
+FLASK_PORT = int(os.environ.get("QS_PORT", "8000"))     # the only port that listens on 0.0.0.0
 
 CURRENT_W = 1920
 CURRENT_H = 1080
 MIN_W, MIN_H = 800, 600
 MAX_W, MAX_H = 3840, 2160
+# Colour depth of the virtual screen. 16 (RGB565) halves framebuffer memory
+# and x11vnc's scan work; 8 (RGB332 TrueColor) quarters it for text work.
+DEPTHS = (24, 16, 8)
+CURRENT_DEPTH = int(os.environ.get("QS_DEPTH", "24"))
+if CURRENT_DEPTH not in DEPTHS: CURRENT_DEPTH = 24
+# noVNC always asks x11vnc for 32bpp true colour (its low-colour mode is
+# reserved for Intel AMT), so reduced depths pair with matching JPEG
+# quality / zlib level on the noVNC URL instead of a client pixel format.
+NOVNC_DEPTH_ARGS = {24:{}, 16:{"quality":"4", "compression":"6"}, 8:{"quality":"1", "compression":"9"}}
+
+FB_DIR = Path(tempfile.gettempdir()) / f"qs_fb{XVFB_DISPLAY_NUM}"  # Xvfb -fbdir
+CHILD_LOG_DIR = BASE / ".logs"   # stderr of Xvfb, x11vnc and Chromium
+STATE_FILE = BASE / f".stack-{XVFB_DISPLAY_NUM}.json"   # running stack, for the next server to adopt
+SNAPSHOT_TTL = float(os.environ.get("QS_SNAPSHOT_TTL", "2.0"))     # thumbnail refresh (s)
+SNAPSHOT_MAX_W = 640
+
+PROXY_ENABLED = os.environ.get("QS_PROXY", "0") == "1"     # shared caching proxy for Chromium
+PROXY_PORT = int(os.environ.get("QS_PROXY_PORT", "3128"))  # 127.0.0.1 only
+PROXY_CACHE_DIR = Path(os.environ.get("QS_PROXY_CACHE_DIR", Path(tempfile.gettempdir()) / "qs_proxy_cache"))
+PROXY_CACHE_BYTES = int(os.environ.get("QS_PROXY_CACHE_MB", "1024")) * 1024 * 1024
+PROXY_MAX_OBJECT = int(os.environ.get("QS_PROXY_MAX_OBJECT_MB", "64")) * 1024 * 1024
+DNS_TTL = int(os.environ.get("QS_DNS_TTL", "300"))
+
+TRACE_DIR = Path(os.environ["QS_TRACE_DIR"]) if os.environ.get("QS_TRACE_DIR") else None  # RFB session traces
+TRACE_KEYFRAME_S = int(os.environ.get("QS_TRACE_KEYFRAME_S", "60"))
+TRACE_QUEUE_BYTES = int(os.environ.get("QS_TRACE_QUEUE_MB", "16")) * 1024 * 1024
+
+ADMIN_USERS = {u.strip() for u in os.environ.get("QS_ADMINS", "admin").split(",") if u.strip()}
+PROFILE_MAX_S, PROFILE_MAX_HZ = 60, 1000
+LATENCY_SESSIONS = 256   # sessions with latency histograms kept (LRU)
+
+# Multi-node: "router" authenticates and proxies each session to a "node",
+# which runs the stack and reports capacity. "standalone" is the classic mode.
+MODE = os.environ.get("QS_MODE", "standalone")
+NODE_SECRET = os.environ.get("QS_NODE_SECRET", "")          # shared by router and nodes
+ROUTER_URL = os.environ.get("QS_ROUTER_URL", "").rstrip("/")  # node: where to report
+NODE_URL = os.environ.get("QS_NODE_URL", f"http://127.0.0.1:{FLASK_PORT}").rstrip("/")  # node: as the router sees it
+NODE_ID = os.environ.get("QS_NODE_ID", f"{socket.gethostname()}:{FLASK_PORT}")
+NODE_SLOTS = int(os.environ.get("QS_NODE_SLOTS", "1"))      # concurrent sessions per node
+NODE_HEARTBEAT = 5          # s between capacity reports; a node is dead after 3 missed
+PLACEMENT_IDLE = 900        # s an idle session keeps its node slot
+
+# Admission control: new stacks wait while the host is over any limit (0 = off).
+ADMIT_MEM_PCT = float(os.environ.get("QS_ADMIT_MEM_PCT", "90"))   # used RAM %
+ADMIT_CPU_PCT = float(os.environ.get("QS_ADMIT_CPU_PCT", "95"))   # busy CPU %
+ADMIT_PSI_MEM = float(os.environ.get("QS_ADMIT_PSI_MEM", "10"))   # PSI memory "some" avg10 %
+ADMIT_PSI_CPU = float(os.environ.get("QS_ADMIT_PSI_CPU", "0"))    # PSI cpu "some" avg10 %
+MAX_STACKS = int(os.environ.get("QS_MAX_STACKS", "0"))            # Xvfb stacks on this host
+ADMIT_QUEUE = int(os.environ.get("QS_ADMIT_QUEUE", "16"))         # router: sessions waiting for a node
+ADMIT_INTERVAL = 2
+
+PROFILE_SNAPSHOTS = os.environ.get("QS_PROFILE_SNAPSHOTS", "1") == "1"  # keep browser state across restarts
+PROFILE_STORE = Path(os.environ.get("QS_PROFILE_STORE", BASE / ".profiles"))
+PROFILE_MAX_BYTES = int(os.environ.get("QS_PROFILE_MAX_MB", "256")) * 1024 * 1024  # per user, compressed
+PROFILE_MAX_FILE = 64 * 1024 * 1024
+# Chromium launch presets (QS_CHROME_PRESET). density fits the most sessions
+# on a host, fidelity behaves most like a desktop browser. gl "none" turns off
+# WebGL and software GL; "swiftshader" renders GL on the CPU as before, and
+# "webgl" also lets pages use WebGL on it.
+# site_isolation False puts cross-site frames in shared renderers, which saves
+# memory but removes Spectre-style isolation between sites.
+_CHROME_BACKGROUND = ("Translate","MediaRouter","DialMediaRouteProvider","OptimizationHints",
+                      "AutofillServerCommunication","CertificateTransparencyComponentUpdater",
+                      "InterestFeedContentSuggestions")
+CHROME_PRESETS = {
+    "density":  {"renderers":2, "disk_cache_mb":16, "media_cache_mb":4, "gl":"none", "site_isolation":False,
+                 "disable_features":_CHROME_BACKGROUND + ("BackForwardCache","SpareRendererForSitePerProcess")},
+    "balanced": {"renderers":6, "disk_cache_mb":64, "media_cache_mb":16, "gl":"swiftshader", "site_isolation":True,
+                 "disable_features":_CHROME_BACKGROUND},
+    "fidelity": {"renderers":0, "disk_cache_mb":256, "media_cache_mb":64, "gl":"webgl", "site_isolation":True,
+                 "disable_features":("Translate",)},
+}
+CHROME_PRESET = os.environ.get("QS_CHROME_PRESET", "balanced").lower()
+CHROME_PREWARM = os.environ.get("QS_CHROME_PREWARM", "1") == "1"   # read Chromium into the page cache at boot
+CHROME_MAP_TIMEOUT = 30   # seconds to wait for Chromium's first window
+TRANSFER_ROOT = Path(os.environ.get("QS_TRANSFER_DIR", BASE / ".transfers"))
+TRANSFER_MAX_BYTES = int(os.environ.get("QS_TRANSFER_MAX_MB", "4096")) * 1024 * 1024  # per profile
+UPLOAD_CHUNK_MAX = 64 * 1024 * 1024   # largest single upload request
+# CPU placement: each stack is pinned to its own CPUs on one NUMA node.
+# The set size follows the Chromium preset unless QS_STACK_CPUS is given.
+# On by default for nodes, which share a host; a lone stack keeps every core.
+PLACEMENT = os.environ.get("QS_PLACEMENT", "1" if MODE == "node" else "0") == "1"
+STACK_CPUS = int(os.environ.get("QS_STACK_CPUS", "0"))
+CPU_PLANS = {"density":1, "balanced":2, "fidelity":4}
+# Adoption: on exit, leave the stack running and record it in STATE_FILE;
+# on boot, take over a healthy one instead of starting afresh.
+ADOPT = os.environ.get("QS_ADOPT", "1" if MODE == "node" else "0") == "1"
+# Video mode (QS_VIDEO): "auto" switches per screen change rate, "on" always
+# recommends video, "off" keeps RFB only.
+VIDEO_MODE = os.environ.get("QS_VIDEO", "auto").lower()
+VIDEO_FPS = int(os.environ.get("QS_VIDEO_FPS", "30"))
+VIDEO_BITRATE = os.environ.get("QS_VIDEO_BITRATE", "4M")
+VIDEO_ON_PCT, VIDEO_OFF_PCT = 30, 5   # % of screen rows changing per sample
+# WebRTC transport (needs aiortc): noVNC's stream over data channels, with
+# /ws as the fallback. QS_RTC_ICE: comma-separated STUN/TURN URLs; empty
+# means host candidates only, which is enough on a LAN or localhost.
+WEBRTC = os.environ.get("QS_WEBRTC", "1") == "1"
+RTC_ICE = [u.strip() for u in os.environ.get("QS_RTC_ICE", "").split(",") if u.strip()]
+RTC_CONNECT_TIMEOUT = 30   # s for ICE + DTLS before an answered offer is dropped
+# /ws bandwidth shaping in Mbit/s, 0 = unlimited: per connection, per user
+# across their connections, and for the whole host. QS_BW_WEIGHTS gives
+# users a larger share of a contended budget, e.g. "alice=2,kiosk=0.5".
+BW_SESSION = float(os.environ.get("QS_BW_SESSION_MBIT", "0")) * 125_000   # bytes/s
+BW_USER = float(os.environ.get("QS_BW_USER_MBIT", "0")) * 125_000
+BW_HOST = float(os.environ.get("QS_BW_HOST_MBIT", "0")) * 125_000
+BW_WEIGHTS = {u.strip(): max(float(w), 0.01) for u, _, w in (x.partition("=") for x in
+              os.environ.get("QS_BW_WEIGHTS", "").split(",")) if u.strip() and w}
+BW_REFRESH = 0.25             # s between share recomputations
+BW_MIN_BURST = 512 * 1024     # bytes a connection may send before it waits
+BW_IDLE_FLOOR = 64 * 1024     # bytes/s kept for a connection that isn't busy
+# Metrics history: a 1 Hz sampler keeps the last hour per second, the last
+# day per minute and the last 30 days per hour, in fixed-size rings for the
+# stack and for the METRICS_SESSIONS most recently active sessions.
+METRICS = os.environ.get("QS_METRICS", "1") == "1"
+METRIC_LEVELS = (("1s", 1, 3600), ("1m", 60, 1440), ("1h", 3600, 720))   # (name, step s, slots)
+METRICS_SESSIONS = int(os.environ.get("QS_METRICS_SESSIONS", "16"))
+PLACEMENT_FILE = Path(os.environ.get("QS_PLACEMENT_FILE",
+                      "/dev/shm/quantumsurf-placement.json" if os.path.isdir("/dev/shm") else
+                      os.path.join(tempfile.gettempdir(), "quantumsurf-placement.json")))
+PLACEMENT_INTERVAL = 10
 
-_login_attempts = {}
-_attempts_lock = threading.Lock()
-_auth_cache = {}
-_auth_cache_ts = 0.0
 
 PROCS = {}
 NOVNC_WEB_ROOT = None
 NOVNC_ENTRY = "vnc.html"
 _resizer_running = False
 _stack_lock = threading.Lock()
+STACK_TIMINGS = {}   # per-step seconds of the last _start_full_stack
+CHROME_LAUNCH = {}   # preset and time-to-window of the last Chromium launch
+
+# Structured stack log: a fixed-size ring of (seq, ts, level, component,
+# session, msg) tuples. Writers claim a sequence number from an
+# itertools.count (atomic under the GIL) and store into slot seq % capacity;
+# only the compare-and-raise of the head takes a small lock, so it never
+# moves backward. Readers page with a seq cursor.
+_log_ring = [None] * LOG_CAPACITY
+_log_seq = itertools.count(1)
+_log_head = 0
+_log_head_lock = threading.Lock()
+_LOG_LEVELS = {"DEBUG":0, "INFO":1, "WARN":2, "ERROR":3}
+_console_q = queue.Queue(maxsize=10_000)  # console/SSE backlog; the ring keeps everything
+
+# Server-Sent Events fan-out: one bounded queue per /api/events client.
+_subscribers = set()
+_subscribers_lock = threading.Lock()
 
-_stack_log = []
-_stack_log_lock = threading.Lock()
+class _Subscriber:
+    __slots__ = ("q", "dropped")
+    def __init__(self): self.q = queue.Queue(maxsize=256); self.dropped = False
 
-def _log(msg, level="INFO"):
-    ts = time.strftime("%H:%M:%S")
-    entry = f"[{ts}] [{level}] {msg}"
-    with _stack_log_lock:
-        _stack_log.append(entry)
-        if len(_stack_log) > 100: _stack_log.pop(0)
-    if level == "ERROR": print(colored(f"  {entry}", "red"))
-    elif level == "WARN": print(colored(f"  {entry}", "yellow"))
-    else: print(colored(f"  {entry}", "green"))
+def _sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, separators=(',',':'))}\n\n"
+
+def _publish(event, data):
+    """Push an event to every connected EventSource. A client that falls
+    256 events behind is cut loose and resyncs from a fresh snapshot on
+    reconnect instead of holding memory or blocking the publisher."""
+    if not _subscribers: return
+    msg = _sse(event, data)
+    with _subscribers_lock: subs = list(_subscribers)
+    for s in subs:
+        try: s.q.put_nowait(msg)
+        except queue.Full:
+            s.dropped = True
+            with _subscribers_lock: _subscribers.discard(s)
+
+def _log(msg, level="INFO", component="stack", session=None):
+    global _log_head
+    seq = next(_log_seq)
+    rec = (seq, time.time(), level, component, session, msg)
+    _log_ring[seq % LOG_CAPACITY] = rec
+    with _log_head_lock:
+        if seq > _log_head: _log_head = seq
+    try: _console_q.put_nowait(rec)
+    except queue.Full: pass
+
+def _log_line(rec):
+    _, ts, level, component, sess, msg = rec
+    tag = component if not sess else f"{component}:{sess}"
+    return f"[{time.strftime('%H:%M:%S', time.localtime(ts))}] [{level}] [{tag}] {msg}"
+
+def _log_dict(rec):
+    seq, ts, level, component, sess, msg = rec
+    return {"seq":seq, "ts":round(ts, 3), "level":level, "component":component,
+            "session":sess, "msg":msg, "line":_log_line(rec)}
+
+def _log_read(since=None, limit=30, min_level=None, component=None, session=None):
+    """Records with seq > since (or the newest `limit` when since is None),
+    oldest first, plus the cursor to pass as `since` next time. Slots that
+    were overwritten mid-read are skipped; a slot not yet filled by a
+    concurrent writer ends the page so the next read picks it up."""
+    head = _log_head
+    oldest = max(1, head - LOG_CAPACITY + 1)
+    filtered = bool(min_level or component or session)
+    if since is not None: start = max(oldest, since + 1)
+    else: start = oldest if filtered else max(oldest, head - limit + 1)
+    min_rank = _LOG_LEVELS.get(min_level, 0)
+    out, cursor = [], start - 1
+    for seq in range(start, head + 1):
+        rec = _log_ring[seq % LOG_CAPACITY]
+        if rec is None or rec[0] < seq: break
+        cursor = seq
+        if rec[0] > seq: continue
+        if _LOG_LEVELS.get(rec[2], 1) < min_rank: continue
+        if component and rec[3] != component: continue
+        if session and rec[4] != session: continue
+        out.append(rec)
+        if since is not None and len(out) >= limit: break
+    if since is not None and cursor < since: cursor = since
+    return out[-limit:], cursor
+
+def _console_loop():
+    """Colour printing and SSE fan-out happen here, off the caller's path."""
+    while True:
+        rec = _console_q.get()
+        try:
+            line = _log_line(rec)
+            color = {"ERROR":"red", "WARN":"yellow"}.get(rec[2], "green")
+            print(colored(f"  {line}", color))
+            _publish("log", _log_dict(rec))
+        except Exception: pass
+        finally: _console_q.task_done()
+
+threading.Thread(target=_console_loop, daemon=True, name="log-console").start()
+
+def _log_flush():
+    _console_q.join()
 
 # ═══════════════════════════════════════════════════════════
 # SYSTEM DETECTION
@@ -396,6 +624,20 @@ def _wait_for_display(display, timeout=10):
         time.sleep(0.3)
     return False
 
+def _spawn(name, cmd, env=None):
+    """Start a stack process detached from the server: in its own session, so
+    Ctrl-C and the server's exit do not reach it, and with stderr in a log
+    file rather than a pipe that would break once the server is gone."""
+    CHILD_LOG_DIR.mkdir(exist_ok=True)
+    with open(CHILD_LOG_DIR / f"{name}-{XVFB_DISPLAY_NUM}.log", "wb") as err:
+        return subprocess.Popen(_placement_prefix() + cmd, env=env, stdin=subprocess.DEVNULL,
+                                stdout=subprocess.DEVNULL, stderr=err, start_new_session=True)
+
+def _spawn_err(name, limit):
+    """Start of the stderr log of the last `name` started."""
+    try: return (CHILD_LOG_DIR / f"{name}-{XVFB_DISPLAY_NUM}.log").read_bytes()[:limit].decode(errors="replace")
+    except OSError: return ""
+
 def _kill_proc(name):
     p = PROCS.pop(name, None)
     if p and p.poll() is None:
@@ -470,7 +712,7 @@ def _set_root_background():
         try: subprocess.run(["xsetroot","-solid","black"], env=env, capture_output=True, timeout=3)
         except: pass
 
-def _start_xvfb(w, h):
+def _start_xvfb(w, h, depth=None):
     """Start Xvfb with proper stale file cleanup.
 
     FIX: Removes /tmp/.X99-lock and /tmp/.X11-unix/X99 before starting.
@@ -496,25 +738,28 @@ def _start_xvfb(w, h):
     # CRITICAL FIX: Remove stale lock file and socket
     _cleanup_x_stale_files()
 
-    res = f"{w}x{h}x24"
+    depth = depth or CURRENT_DEPTH
+    res = f"{w}x{h}x{depth}"
+    depth_args = ["-cc", "4"] if depth == 8 else []  # 8-bit TrueColor, not PseudoColor
+    # -fbdir: keep the framebuffer in an XWD file we can mmap for snapshots
+    FB_DIR.mkdir(parents=True, exist_ok=True)
     try:
         # -listen tcp: Override Xvfb 21.1+ default -nolisten tcp
         # -listen local: Ensure Unix socket works
         # Ref: https://github.com/moby/moby/issues/40939#issuecomment-663175763
-        p = subprocess.Popen(
-            ["Xvfb", XVFB_DISPLAY, "-screen", "0", res,
+        p = _spawn("xvfb",
+            ["Xvfb", XVFB_DISPLAY, "-screen", "0", res, *depth_args,
              "-ac",
              "-listen", "tcp",
              "-listen", "local",
              "+extension", "GLX",
              "+extension", "MIT-SHM",
              "+render",
-             "-noreset"],
-            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+             "-noreset",
+             "-fbdir", str(FB_DIR)])
         time.sleep(1.5)
         if p.poll() is not None:
-            _, err = p.communicate(timeout=3)
-            err_text = err.decode(errors='replace')[:400]
+            err_text = _spawn_err("xvfb", 400)
             _log(f"Xvfb exited (code {p.returncode}): {err_text}", "ERROR")
             # If it's STILL a lock file error, try harder
             if "lock file" in err_text.lower():
@@ -526,16 +771,14 @@ def _start_xvfb(w, h):
                 subprocess.run(["fuser","-k",f"/tmp/.X11-unix/X{XVFB_DISPLAY_NUM}"],
                               capture_output=True, timeout=3)
                 time.sleep(1)
-                p = subprocess.Popen(
-                    ["Xvfb", XVFB_DISPLAY, "-screen", "0", res,
+                p = _spawn("xvfb",
+                    ["Xvfb", XVFB_DISPLAY, "-screen", "0", res, *depth_args,
                      "-ac", "-listen", "tcp", "-listen", "local",
                      "+extension", "GLX", "+extension", "MIT-SHM",
-                     "+render", "-noreset"],
-                    stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+                     "+render", "-noreset", "-fbdir", str(FB_DIR)])
                 time.sleep(1.5)
                 if p.poll() is not None:
-                    _, err2 = p.communicate(timeout=3)
-                    _log(f"Xvfb retry failed: {err2.decode(errors='replace')[:300]}", "ERROR")
+                    _log(f"Xvfb retry failed: {_spawn_err('xvfb', 300)}", "ERROR")
                     return False
             else:
                 return False
@@ -559,7 +802,7 @@ def _start_x11vnc():
     if not shutil.which("x11vnc"):
         _log("x11vnc not available after install attempt", "ERROR")
         return False
-    subprocess.run(["pkill","-f","x11vnc"], capture_output=True, timeout=3)
+    subprocess.run(["pkill","-f",f"x11vnc -display {XVFB_DISPLAY} "], capture_output=True, timeout=3)
     time.sleep(0.5)
     if not _wait_for_display(XVFB_DISPLAY, timeout=5):
         _log("X display not ready for x11vnc", "ERROR")
@@ -576,20 +819,29 @@ def _start_x11vnc():
     ]
     for i, cmd in enumerate(attempts):
         try:
-            p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            p = _spawn("x11vnc", cmd)
             time.sleep(2.0)
             if p.poll() is None:
                 PROCS["x11vnc"] = p
                 _log(f"x11vnc on 127.0.0.1:{VNC_PORT} (attempt {i+1})")
                 return True
             else:
-                _, err = p.communicate(timeout=3)
-                _log(f"x11vnc attempt {i+1} failed: {err.decode(errors='replace')[:300]}", "WARN")
+                _log(f"x11vnc attempt {i+1} failed: {_spawn_err('x11vnc', 300)}", "WARN")
         except Exception as e:
             _log(f"x11vnc attempt {i+1} exception: {e}", "WARN")
     _log("x11vnc failed all attempts", "ERROR")
     return False
 
+def _find_novnc():
+    """Already-installed noVNC web root (system package or .novnc/), or None."""
+    for p in ["/usr/share/novnc","/usr/share/noVNC","/opt/novnc"]:
+        if Path(p).is_dir() and (Path(p)/"vnc.html").exists(): return p
+    if NOVNC_DIR.is_dir():
+        for d in NOVNC_DIR.iterdir():
+            if d.is_dir() and (d/"vnc.html").exists(): return str(d)
+        if (NOVNC_DIR/"vnc.html").exists(): return str(NOVNC_DIR)
+    return None
+
 def _start_novnc():
     """Locate (or download) the noVNC static web assets only.
 
@@ -600,13 +852,7 @@ def _start_novnc():
     guarded by @login_required, and it connects only to 127.0.0.1:5901.
     """
     global NOVNC_WEB_ROOT, NOVNC_ENTRY
-    novnc_web = None
-    for p in ["/usr/share/novnc","/usr/share/noVNC","/opt/novnc"]:
-        if Path(p).is_dir() and (Path(p)/"vnc.html").exists(): novnc_web = p; break
-    if not novnc_web and NOVNC_DIR.is_dir():
-        for d in NOVNC_DIR.iterdir():
-            if d.is_dir() and (d/"vnc.html").exists(): novnc_web = str(d); break
-        if not novnc_web and (NOVNC_DIR/"vnc.html").exists(): novnc_web = str(NOVNC_DIR)
+    novnc_web = _find_novnc()
     if not novnc_web:
         _log("Downloading noVNC from GitHub...", "WARN")
         try:
@@ -627,45 +873,119 @@ def _start_novnc():
     _log(f"noVNC static files ready at {novnc_web} (served via Flask /novnc/, no network listener)")
     return True
 
-def _launch_chromium(w, h):
+def _chrome_preset_args(name):
+    """Chromium flags for one of CHROME_PRESETS."""
+    p = CHROME_PRESETS[name]
+    args = [f"--disk-cache-size={p['disk_cache_mb'] << 20}", f"--media-cache-size={p['media_cache_mb'] << 20}"]
+    if p["renderers"]: args.append(f"--renderer-process-limit={p['renderers']}")
+    if p["gl"] in ("swiftshader", "webgl"): args += ["--use-gl=angle", "--use-angle=swiftshader"]
+    if p["gl"] == "webgl": args.append("--enable-unsafe-swiftshader")
+    elif p["gl"] == "none": args += ["--disable-3d-apis", "--disable-software-rasterizer"]
+    features = list(p["disable_features"])
+    if not p["site_isolation"]:
+        args.append("--disable-site-isolation-trials"); features += ["IsolateOrigins", "site-per-process"]
+    if features: args.append("--disable-features=" + ",".join(features))  # Chromium honours only the last one
+    return args
+
+def _chrome_files():
+    """Chromium's binary and the resources it maps at startup."""
+    real = Path(CHROME_BIN).resolve()
+    d = real.parent
+    if str(d) in ("/usr/bin", "/bin", "/usr/local/bin"):   # distro wrapper script
+        d = next((p for p in (Path("/usr/lib/chromium"), Path("/usr/lib/chromium-browser"),
+                              Path("/opt/google/chrome")) if p.is_dir()), None)
+    files = [real]
+    for top in ([d] if d else []) + ([LIBS_DIR] if LIBS_DIR.is_dir() else []):
+        files += [f for f in top.iterdir() if f.is_file() and f != real]
+        if (top / "locales").is_dir(): files += list((top / "locales").glob("en-US*.pak"))
+    return files
+
+def _prewarm_chromium():
+    """Ask the kernel to read Chromium into the page cache (readahead runs in
+    the background), so the first launch does not wait on the disk."""
+    t0 = time.monotonic(); n = size = 0
+    for f in _chrome_files():
+        try:
+            fd = os.open(f, os.O_RDONLY)
+            try:
+                size += os.fstat(fd).st_size; n += 1
+                if hasattr(os, "posix_fadvise"): os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+                else:
+                    while os.read(fd, 1 << 20): pass
+            finally: os.close(fd)
+        except OSError: pass
+    _log(f"prewarmed {n} Chromium files ({size >> 20} MB) in {(time.monotonic() - t0) * 1000:.0f}ms", component="chromium")
+
+def _wait_chromium_window(p, timeout=CHROME_MAP_TIMEOUT):
+    """Seconds until Chromium has a visible window on our display, or None if
+    it exited or timed out. Without xdotool this is the old fixed 3 s wait."""
+    t0 = time.monotonic()
+    if not _ensure_xdotool():
+        time.sleep(3.0)
+        return None if p.poll() is not None else time.monotonic() - t0
+    env = os.environ.copy(); env["DISPLAY"] = XVFB_DISPLAY
+    while time.monotonic() - t0 < timeout and p.poll() is None:
+        try:
+            r = subprocess.run(["xdotool","search","--onlyvisible","--class","chrom"],
+                               capture_output=True, text=True, timeout=3, env=env)
+            if r.stdout.strip(): return time.monotonic() - t0
+        except (OSError, subprocess.SubprocessError): pass
+        time.sleep(0.05)
+    return None
+
+def _launch_chromium(w, h, preset=None):
     if not CHROME_BIN:
         _log("No Chromium binary", "ERROR")
         return False
+    global CHROME_PROFILE, _profile_loaded_for, CHROME_LAUNCH
+    preset = preset or CHROME_PRESET
     env = _build_lib_env(); env["DISPLAY"] = XVFB_DISPLAY
-    ud = tempfile.mkdtemp(prefix="qs_profile_")
+    _profile_save()  # a previous Chromium that died on its own
+    ud = CHROME_PROFILE = tempfile.mkdtemp(prefix="qs_profile_")
+    _profile_loaded_for = _profile_owner
+    restored = None
+    if PROFILE_SNAPSHOTS:
+        try: restored = _profile_restore(_profile_owner, ud)
+        except OSError as e: _log(f"profile restore failed: {e}", "WARN", "profile")
+        if restored: _log(f"profile restored: {restored['files']} files in {restored['seconds'] * 1000:.0f}ms", component="profile")
+    try: _transfer_prefs(ud)
+    except OSError as e: _log(f"cannot set download directory: {e}", "WARN", "transfer")
     args = [CHROME_BIN, f"--user-data-dir={ud}",
         "--no-sandbox","--disable-setuid-sandbox","--disable-dev-shm-usage",
         "--no-first-run","--no-default-browser-check",
         "--disable-background-networking","--disable-sync","--disable-extensions",
+        "--disable-component-update","--disable-breakpad","--disable-domain-reliability",
         "--mute-audio","--disable-default-apps","--password-store=basic",
         "--disable-gpu","--disable-gpu-compositing",
-        "--use-gl=angle","--use-angle=swiftshader",
         "--force-color-profile=srgb","--force-device-scale-factor=1",
-        f"--window-size={w},{h}","--window-position=0,0",
-        "about:blank"]
+        f"--window-size={w},{h}","--window-position=0,0"] + _chrome_preset_args(preset)
+    if _proxy_url: args.append(f"--proxy-server={_proxy_url}")
+    args.append("--restore-last-session" if restored else "about:blank")
     try:
-        p = subprocess.Popen(args, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        time.sleep(3.0)
+        p = _spawn("chromium", args, env)
+        mapped = _wait_chromium_window(p)
         if p.poll() is not None:
-            _, err = p.communicate(timeout=3)
-            err_text = err.decode(errors='replace')[:500]
+            err_text = _spawn_err("chromium", 500)
             _log(f"Chromium exited (code {p.returncode}): {err_text}", "ERROR")
             if "error while loading shared libraries" in err_text:
                 m = re.search(r'error while loading shared libraries:\s+(\S+?):', err_text)
                 if m:
                     _log(f"Missing runtime lib: {m.group(1)} — installing...", "WARN")
                     _check_and_install_libs(CHROME_BIN)
-                    p2 = subprocess.Popen(args, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-                    time.sleep(3.0)
+                    p2 = _spawn("chromium", args, env)
+                    mapped = _wait_chromium_window(p2)
                     if p2.poll() is None:
                         PROCS["chromium"] = p2
+                        CHROME_LAUNCH = {"preset":preset, "mapped_s":mapped and round(mapped, 3)}
                         _log(f"Chromium {w}x{h} (PID {p2.pid}) — retry OK")
-                        time.sleep(1.0); _force_resize_window(w, h)
+                        _force_resize_window(w, h)
                         return True
             return False
         PROCS["chromium"] = p
-        _log(f"Chromium {w}x{h} (PID {p.pid})")
-        time.sleep(1.0); _force_resize_window(w, h)
+        CHROME_LAUNCH = {"preset":preset, "mapped_s":mapped and round(mapped, 3)}
+        if mapped is None: _log(f"Chromium has no window after {CHROME_MAP_TIMEOUT}s", "WARN")
+        _log(f"Chromium {w}x{h} (PID {p.pid}, {preset}" + (f", window in {mapped:.2f}s)" if mapped else ")"))
+        _force_resize_window(w, h)
         return True
     except Exception as e:
         _log(f"Chromium launch exception: {e}", "ERROR")
@@ -714,75 +1034,2696 @@ def _start_resizer_thread():
             _force_resize_window(CURRENT_W, CURRENT_H)
     threading.Thread(target=_loop, daemon=True, name="resizer").start()
 
-def _start_full_stack(w=None, h=None):
-    global CURRENT_W, CURRENT_H, _resizer_running, STACK_OK
+def _start_full_stack(w=None, h=None, depth=None):
+    global CURRENT_W, CURRENT_H, CURRENT_DEPTH, _resizer_running, STACK_OK, STACK_TIMINGS
     if w is None: w = CURRENT_W
     if h is None: h = CURRENT_H
+    if depth not in DEPTHS: depth = CURRENT_DEPTH
     with _stack_lock:
         _log(f"Starting stack at {w}x{h}...")
+        t0 = time.monotonic(); timings = {}
+        def step(name, fn, *a):
+            _publish("progress", {"step":name,"width":w,"height":h})
+            ts = time.monotonic(); r = fn(*a)
+            timings[name] = round(time.monotonic() - ts, 3)
+            return r
         _resizer_running = False
         time.sleep(0.3)
         CURRENT_W, CURRENT_H = w, h
-        xvfb_ok = _start_xvfb(w, h)
+        try: _place_stack()
+        except OSError as e: _log(f"placement: {e}", "WARN", "placement")
+        xvfb_ok = step("xvfb", _start_xvfb, w, h, depth)
         if not xvfb_ok:
             _log("Stack FAILED: Xvfb could not start", "ERROR")
             STACK_OK = False
+            STACK_TIMINGS = dict(timings, total=round(time.monotonic() - t0, 3))
+            _publish("progress", {"step":"failed","width":w,"height":h})
             return False
-        _launch_chromium(w, h)
-        vnc_ok = _start_x11vnc()
-        novnc_ok = _start_novnc()
+        CURRENT_DEPTH = depth   # only once the screen really has it
+        if not step("chromium", _launch_chromium, w, h) and depth == 8:
+            _log("Chromium failed on the 8-bit screen — falling back to 16-bit", "WARN")
+            # Both attempts stay in the timings, under their own names.
+            timings["xvfb@8"], timings["chromium@8"] = timings.pop("xvfb"), timings.pop("chromium")
+            _kill_proc("xvfb")
+            if step("xvfb@16", _start_xvfb, w, h, 16):
+                CURRENT_DEPTH = 16
+                step("chromium@16", _launch_chromium, w, h)
+        vnc_ok = step("x11vnc", _start_x11vnc)
+        novnc_ok = step("novnc", _start_novnc)
         _start_resizer_thread()
+        _apply_affinity()
         STACK_OK = vnc_ok and novnc_ok
-        if STACK_OK: _log(f"Stack OK at {w}x{h}")
+        STACK_TIMINGS = dict(timings, total=round(time.monotonic() - t0, 3))
+        _save_stack_state()
+        if STACK_OK: _log(f"Stack OK at {w}x{h}x{CURRENT_DEPTH} ({STACK_TIMINGS['total']:.1f}s)")
         else:
             if not vnc_ok: _log("Stack partial: x11vnc failed", "ERROR")
             if not novnc_ok: _log("Stack partial: noVNC files unavailable", "ERROR")
+        _publish("progress", {"step":"done" if STACK_OK else "failed","width":w,"height":h})
         return STACK_OK
 
-def _restart_stack(w, h):
+def _stack_state():
+    return {"stack_ok":STACK_OK, "processes":{k: (v.poll() is None) for k, v in list(PROCS.items())},
+            "width":CURRENT_W, "height":CURRENT_H, "depth":CURRENT_DEPTH, "chrome":CHROME_LAUNCH}
+
+_watcher_running = False
+def _start_stack_watcher():
+    """One poller for all EventSource clients: poll() the stack once a
+    second and publish only the fields that changed."""
+    global _watcher_running
+    if _watcher_running: return
+    _watcher_running = True
+    def _loop():
+        last = _stack_state()
+        while True:
+            time.sleep(1)
+            if not _subscribers: continue
+            cur = _stack_state()
+            delta = {k: v for k, v in cur.items() if last.get(k) != v}
+            if delta: _publish("stack", delta)
+            last = cur
+    threading.Thread(target=_loop, daemon=True, name="stack-watcher").start()
+
+def _restart_stack(w, h, depth=None):
     global _resizer_running
     w = max(MIN_W, min(int(w), MAX_W))
     h = max(MIN_H, min(int(h), MAX_H))
+    _publish("progress", {"step":"stopping","width":w,"height":h})
     _kill_proc("chromium")
+    _profile_save()
     _kill_proc("x11vnc")
     _kill_proc("xvfb")
     time.sleep(0.5)
-    return _start_full_stack(w, h)
+    return _start_full_stack(w, h, depth)
+
+# ═══════════════════════════════════════════════════════════
+# STACK ADOPTION
+# ═══════════════════════════════════════════════════════════
+# With QS_ADOPT=1 the stack outlives the server: on exit, the server writes
+# STATE_FILE and leaves Xvfb, x11vnc and Chromium running, and the next
+# server takes them over. Only the /ws connections drop, and noVNC
+# reconnects by itself. PIDs are checked together with their start time,
+# so a reused PID is never adopted.
+def _proc_start(pid):
+    """Start time (clock ticks since boot) of a live process, else None."""
+    try:
+        with open(f"/proc/{pid}/stat", "rb") as f: st = f.read()
+        fields = st[st.rindex(b")") + 2:].split()
+        return None if fields[0] in (b"Z", b"X") else int(fields[19])
+    except (OSError, ValueError, IndexError): return None
+
+class _AdoptedProc:
+    """Popen stand-in for a stack process started by an earlier server."""
+    def __init__(self, pid, start):
+        self.pid, self.start, self.returncode = pid, start, None
+    def poll(self):
+        if self.returncode is None and _proc_start(self.pid) != self.start: self.returncode = -1
+        return self.returncode
+    def send_signal(self, sig):
+        if self.poll() is None:
+            try: os.kill(self.pid, sig)
+            except ProcessLookupError: pass
+    def terminate(self): self.send_signal(signal.SIGTERM)
+    def kill(self): self.send_signal(signal.SIGKILL)
+    def wait(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.poll() is None:
+            if deadline and time.monotonic() > deadline: raise subprocess.TimeoutExpired(str(self.pid), timeout)
+            time.sleep(0.05)
+        return self.returncode
+
+def _save_stack_state():
+    if not ADOPT: return
+    procs = {}
+    for name, p in list(PROCS.items()):
+        start = _proc_start(p.pid) if p.poll() is None else None
+        if start: procs[name] = {"pid":p.pid, "start":start}
+    state = {"display":XVFB_DISPLAY, "vnc_port":VNC_PORT, "width":CURRENT_W, "height":CURRENT_H,
+             "depth":CURRENT_DEPTH, "chrome":CHROME_LAUNCH, "chrome_profile":CHROME_PROFILE,
+             "profile_owner":_profile_owner, "profile_loaded_for":_profile_loaded_for,
+             "procs":procs, "saved":time.time()}
+    try:
+        tmp = STATE_FILE.with_suffix(".tmp")
+        tmp.write_text(json.dumps(state)); tmp.chmod(0o600); os.replace(tmp, STATE_FILE)
+    except OSError as e: _log(f"cannot write {STATE_FILE.name}: {e}", "WARN", "adopt")
+
+def _rfb_answers(port):
+    try:
+        with socket.create_connection(("127.0.0.1", port), timeout=2) as s:
+            return s.recv(12).startswith(b"RFB ")
+    except OSError: return False
+
+def _adopt_stack():
+    """Take over the stack a previous server left on our display. Returns
+    True when Xvfb, x11vnc and Chromium are all alive and answering;
+    otherwise whatever survived is stopped and the caller starts afresh."""
+    global CURRENT_W, CURRENT_H, CURRENT_DEPTH, CHROME_PROFILE, CHROME_LAUNCH, STACK_OK, STACK_TIMINGS
+    global _profile_owner, _profile_loaded_for
+    if not ADOPT: return False
+    try: state = json.loads(STATE_FILE.read_text())
+    except (OSError, ValueError): return False
+    t0 = time.monotonic()
+    procs = {name: _AdoptedProc(info["pid"], info["start"]) for name, info in state.get("procs", {}).items()
+             if _proc_start(info["pid"]) == info["start"]}
+    missing = {"xvfb", "x11vnc", "chromium"} - set(procs)
+    if state.get("display") != XVFB_DISPLAY or state.get("vnc_port") != VNC_PORT: problem = "display or VNC port changed"
+    elif missing: problem = f"{', '.join(sorted(missing))} not running"
+    elif not _wait_for_display(XVFB_DISPLAY, timeout=2): problem = "X display not answering"
+    elif not _rfb_answers(VNC_PORT): problem = "x11vnc not answering"
+    else: problem = None
+    STATE_FILE.unlink(missing_ok=True)
+    if problem:
+        _log(f"not adopting the previous stack: {problem}", "WARN", "adopt")
+        PROCS.update(procs)
+        for name in ("chromium", "x11vnc", "xvfb"): _kill_proc(name)
+        return False
+    PROCS.update(procs)
+    CURRENT_W, CURRENT_H, CURRENT_DEPTH = state["width"], state["height"], state["depth"]
+    CHROME_PROFILE, CHROME_LAUNCH = state.get("chrome_profile"), dict(state.get("chrome") or {}, adopted=True)
+    _profile_owner, _profile_loaded_for = state.get("profile_owner"), state.get("profile_loaded_for")
+    try: _place_stack(); _apply_affinity()
+    except OSError as e: _log(f"placement: {e}", "WARN", "placement")
+    STACK_OK = _start_novnc()
+    _start_resizer_thread()
+    STACK_TIMINGS = {"adopt":round(time.monotonic() - t0, 3), "total":round(time.monotonic() - t0, 3)}
+    _log(f"adopted running stack {CURRENT_W}x{CURRENT_H}x{CURRENT_DEPTH}: " +
+         ", ".join(f"{n} {p.pid}" for n, p in procs.items()), component="adopt")
+    _save_stack_state()
+    return True
+
+# ═══════════════════════════════════════════════════════════
+# PROCESS STATS
+# ═══════════════════════════════════════════════════════════
+_CLK_TCK = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+_PAGE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+def _proc_tree(pid):
+    """pid plus all its descendants, from /proc/*/stat parent links."""
+    children = {}
+    for d in os.listdir("/proc"):
+        if not d.isdigit(): continue
+        try:
+            with open(f"/proc/{d}/stat", "rb") as f: st = f.read()
+            ppid = int(st[st.rindex(b")") + 2:].split()[1])
+            children.setdefault(ppid, []).append(int(d))
+        except (OSError, ValueError): pass
+    out, todo = [], [pid]
+    while todo:
+        p = todo.pop(); out.append(p); todo.extend(children.get(p, ()))
+    return out
+
+def _proc_cpu_seconds(pids):
+    """utime + stime of the given processes, in seconds."""
+    total = 0
+    for p in pids:
+        try:
+            with open(f"/proc/{p}/stat", "rb") as f: st = f.read()
+            fields = st[st.rindex(b")") + 2:].split()
+            total += int(fields[11]) + int(fields[12])
+        except (OSError, ValueError, IndexError): pass
+    return total / _CLK_TCK
+
+def _meminfo():
+    """/proc/meminfo as {field: bytes}."""
+    mem = {}
+    try:
+        for line in Path("/proc/meminfo").read_text().splitlines():
+            k, v = line.split(":", 1); mem[k] = int(v.split()[0]) * 1024
+    except (OSError, ValueError, IndexError): pass
+    return mem
+
+def _proc_rss(pids):
+    """Resident set size in bytes, summed over the given processes."""
+    total = 0
+    for p in pids:
+        try:
+            with open(f"/proc/{p}/statm", "rb") as f: total += int(f.read().split()[1]) * _PAGE
+        except (OSError, ValueError, IndexError): pass
+    return total
+
+# ═══════════════════════════════════════════════════════════
+# SHARED CACHING PROXY
+# ═══════════════════════════════════════════════════════════
+# Optional (QS_PROXY=1) forward proxy that every Chromium on the host is
+# pointed at with --proxy-server. Plain-HTTP GETs are served from a shared,
+# size-bounded LRU disk cache that follows HTTP caching rules (RFC 9111,
+# shared-cache subset); HTTPS goes through CONNECT tunnels, which cannot be
+# cached without TLS interception but still share the host-wide DNS cache.
+_HOP_HEADERS = {"connection","keep-alive","proxy-authorization","proxy-authenticate",
+                "proxy-connection","te","trailer","transfer-encoding","upgrade"}
+_CACHEABLE_STATUS = {200, 203, 300, 301, 410}
+_dns_cache = OrderedDict()   # (host, port) -> (expires, [(family, sockaddr), ...])
+_dns_lock = threading.Lock()
+_proxy_index = OrderedDict() # cache key -> stored size in bytes, LRU order
+_proxy_lock = threading.Lock()
+_proxy_bytes = 0
+_proxy_stats = {"hits":0, "revalidated":0, "misses":0, "uncacheable":0, "tunnels":0,
+                "bytes_from_cache":0, "bytes_from_origin":0, "dns_hits":0, "dns_misses":0}
+_proxy_url = None
+
+def _proxy_count(name, n=1):
+    """Bump a proxy counter; request threads share them."""
+    with _proxy_lock: _proxy_stats[name] += n
+
+def _proxy_view():
+    with _proxy_lock: return dict(_proxy_stats, cached_bytes=_proxy_bytes)
+
+def _dns_resolve(host, port):
+    """getaddrinfo with a host-wide TTL cache (QS_DNS_TTL seconds)."""
+    key = (host.lower(), port)
+    now = time.monotonic()
+    with _dns_lock:
+        hit = _dns_cache.get(key)
+        if hit and hit[0] > now:
+            _dns_cache.move_to_end(key); _proxy_count("dns_hits")
+            return hit[1]
+    infos = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+    addrs = [(fam, sa) for fam, _, _, _, sa in infos]
+    with _dns_lock:
+        _proxy_count("dns_misses")
+        _dns_cache[key] = (now + DNS_TTL, addrs)
+        while len(_dns_cache) > 4096: _dns_cache.popitem(last=False)
+    return addrs
+
+def _dns_connect(host, port, timeout=15):
+    err = None
+    for fam, sa in _dns_resolve(host, port):
+        s = socket.socket(fam, socket.SOCK_STREAM)
+        s.settimeout(timeout)
+        try: s.connect(sa); return s
+        except OSError as e: err = e; s.close()
+    raise err or OSError(f"cannot connect to {host}:{port}")
+
+def _cc(headers):
+    """Parse Cache-Control into {directive: value-or-True}."""
+    out = {}
+    for part in ",".join(headers.get_all("Cache-Control") or []).split(","):
+        k, _, v = part.strip().partition("=")
+        if k: out[k.lower()] = v.strip('"') if v else True
+    return out
+
+def _freshness(headers, now):
+    """Freshness lifetime in seconds for a response, per RFC 9111 §4.2.1."""
+    cc = _cc(headers)
+    for d in ("s-maxage", "max-age"):
+        if d in cc:
+            try: return max(0, int(cc[d]))
+            except ValueError: return 0
+    date = _http_date(headers.get("Date")) or now
+    exp = headers.get("Expires")
+    if exp is not None:
+        e = _http_date(exp)
+        return max(0, e - date) if e else 0
+    lm = _http_date(headers.get("Last-Modified"))
+    if lm and date > lm: return min((date - lm) / 10, 86400)  # heuristic
+    return 0
+
+def _http_date(v):
+    if not v: return None
+    try: return email.utils.parsedate_to_datetime(v).timestamp()
+    except (TypeError, ValueError, IndexError): return None
+
+def _cache_key(url, headers):
+    # Chromium's Accept-Encoding is stable, so it is the only Vary we honour.
+    return hashlib.sha256(f"{url}\n{headers.get('Accept-Encoding','')}".encode()).hexdigest()
+
+def _cache_path(key): return PROXY_CACHE_DIR / key[:2] / key
+
+def _cache_load_index():
+    global _proxy_bytes
+    entries = []
+    for f in PROXY_CACHE_DIR.glob("??/*"):
+        if f.name.endswith(".tmp"): f.unlink(missing_ok=True); continue
+        try: st = f.stat(); entries.append((st.st_atime, f.name, st.st_size))
+        except OSError: pass
+    with _proxy_lock:
+        for _, key, size in sorted(entries):
+            _proxy_index[key] = size; _proxy_bytes += size
+    _cache_evict()
+
+def _cache_evict():
+    global _proxy_bytes
+    victims = []
+    with _proxy_lock:
+        while _proxy_bytes > PROXY_CACHE_BYTES and _proxy_index:
+            key, size = _proxy_index.popitem(last=False)
+            _proxy_bytes -= size; victims.append(key)
+    for key in victims: _cache_path(key).unlink(missing_ok=True)
+
+def _cache_get(key):
+    """Return (meta, body file positioned at 0) for a cached object, or None.
+    Entries are the raw body followed by a JSON metadata trailer and its
+    8-byte length, so storing a response never needs a second copy."""
+    with _proxy_lock:
+        if key not in _proxy_index: return None
+        _proxy_index.move_to_end(key)
+    try:
+        f = open(_cache_path(key), "rb")
+    except OSError:
+        _cache_drop(key); return None
+    try:
+        f.seek(-8, os.SEEK_END)
+        n = struct.unpack(">Q", f.read(8))[0]
+        f.seek(-8 - n, os.SEEK_END)
+        meta = json.loads(f.read(n))
+        f.seek(0)
+        return meta, f
+    except (OSError, ValueError, struct.error):
+        f.close(); _cache_drop(key); return None
+
+def _cache_drop(key):
+    global _proxy_bytes
+    with _proxy_lock:
+        size = _proxy_index.pop(key, None)
+        if size is not None: _proxy_bytes -= size
+    _cache_path(key).unlink(missing_ok=True)
+
+def _cache_tmp(key):
+    path = _cache_path(key); path.parent.mkdir(parents=True, exist_ok=True)
+    return path.with_name(f"{path.name}.{threading.get_ident()}.tmp")
+
+def _cache_finish(key, tmp, out, meta):
+    """Append the metadata trailer and atomically publish the entry."""
+    global _proxy_bytes
+    m = json.dumps(meta).encode()
+    out.write(m + struct.pack(">Q", len(m)))
+    out.close()
+    size = tmp.stat().st_size
+    os.replace(tmp, _cache_path(key))
+    with _proxy_lock:
+        _proxy_bytes += size - _proxy_index.pop(key, 0)
+        _proxy_index[key] = size
+    _cache_evict()
+
+class _ProxyHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_version = "QuantumSurfProxy"
+
+    def log_message(self, fmt, *args):
+        if DEBUG: _log(fmt % args, "DEBUG", "proxy")
+
+    def do_CONNECT(self):
+        host, _, port = self.path.rpartition(":")
+        try: upstream = _dns_connect(host.strip("[]"), int(port or 443))
+        except Exception as e:
+            self.send_error(502, f"CONNECT failed: {e}"); return
+        _proxy_count("tunnels")
+        self.send_response(200, "Connection Established"); self.end_headers()
+        client = self.connection
+        upstream.settimeout(None); client.settimeout(None)
+        socks = [client, upstream]
+        try:
+            while True:
+                r, _, x = select.select(socks, [], socks, 300)
+                if x or not r: break
+                for s in r:
+                    data = s.recv(65536)
+                    if not data: return
+                    (upstream if s is client else client).sendall(data)
+        except OSError: pass
+        finally:
+            upstream.close(); self.close_connection = True
+
+    def _request_body(self):
+        if "chunked" in self.headers.get("Transfer-Encoding", "").lower():
+            parts = []
+            while True:
+                size = int(self.rfile.readline().split(b";")[0].strip() or b"0", 16)
+                if not size: break
+                parts.append(self.rfile.read(size)); self.rfile.readline()
+            while self.rfile.readline() not in (b"\r\n", b"\n", b""): pass
+            return b"".join(parts)
+        n = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(n) if n else None
+
+    def _origin(self, method, url, extra=None, body=None):
+        u = urlparse(url)
+        if u.scheme != "http" or not u.hostname: raise ValueError(f"unsupported URL {url}")
+        port = u.port or 80
+        conn = http.client.HTTPConnection(u.hostname, port, timeout=30)
+        conn.sock = _dns_connect(u.hostname, port)
+        path = (u.path or "/") + (f"?{u.query}" if u.query else "")
+        conn.putrequest(method, path, skip_host=True, skip_accept_encoding=True)
+        extra = extra or {}
+        drop = (_HOP_HEADERS | {"content-length"} | {k.lower() for k in extra}
+                | {h.strip().lower() for h in self.headers.get("Connection","").split(",")})
+        for k, v in self.headers.items():
+            if k.lower() not in drop: conn.putheader(k, v)
+        for k, v in extra.items(): conn.putheader(k, v)
+        if body is not None: conn.putheader("Content-Length", str(len(body)))
+        conn.endheaders(body)
+        return conn, conn.getresponse()
+
+    def _send_head(self, resp_or_meta, headers, age=None):
+        """Send status + headers; returns True if the body must be chunked."""
+        status, reason, length = resp_or_meta
+        self.send_response(status, reason)
+        for k, v in headers:
+            if k.lower() not in _HOP_HEADERS and k.lower() != "content-length": self.send_header(k, v)
+        if age is not None: self.send_header("Age", str(int(age)))
+        if length is None: self.send_header("Transfer-Encoding", "chunked")
+        else: self.send_header("Content-Length", str(length))
+        self.end_headers()
+        return length is None
+
+    def _status_line(self, resp):
+        cl = resp.getheader("Content-Length")
+        if cl is not None and cl.isdigit(): length = int(cl)
+        elif self.command == "HEAD" or resp.status in (204, 304): length = 0
+        else: length = None
+        return resp.status, resp.reason, length
+
+    def _relay(self, resp, chunked, sink=None):
+        """Stream an origin body to the client and optionally to a cache file."""
+        total = 0
+        while self.command != "HEAD":
+            buf = resp.read(65536)
+            if not buf: break
+            total += len(buf)
+            if sink is not None: sink(buf)
+            self.wfile.write(b"%x\r\n%s\r\n" % (len(buf), buf) if chunked else buf)
+        if chunked: self.wfile.write(b"0\r\n\r\n")
+        _proxy_count("bytes_from_origin", total)
+        return total
+
+    def _serve_cached(self, meta, f):
+        age = max(0, time.time() - meta["stored"]) + meta.get("age", 0)
+        self._send_head((meta["status"], meta["reason"], meta["size"]), meta["headers"], age)
+        if self.command == "HEAD": return
+        left = meta["size"]
+        while left > 0:
+            buf = f.read(min(262144, left))
+            if not buf: break
+            self.wfile.write(buf); left -= len(buf)
+        _proxy_count("bytes_from_cache", meta["size"] - left)
+
+    def _pass_through(self, body=None):
+        conn, resp = self._origin(self.command, self.path, body=body)
+        try: self._relay(resp, self._send_head(self._status_line(resp), resp.getheaders()))
+        finally: conn.close()
+
+    def _handle(self):
+        try:
+            body = self._request_body()
+            if self.command not in ("GET", "HEAD"):
+                # Unsafe methods invalidate what we hold for the URL (RFC 9111 §4.4).
+                _cache_drop(_cache_key(self.path, self.headers))
+                return self._pass_through(body)
+            req_cc = _cc(self.headers)
+            if "no-store" in req_cc or "Authorization" in self.headers or self.command == "HEAD":
+                _proxy_count("uncacheable")
+                return self._pass_through()
+            key = _cache_key(self.path, self.headers)
+            revalidate = ("no-cache" in req_cc or req_cc.get("max-age") == "0"
+                          or "no-cache" in self.headers.get("Pragma", ""))
+            hit = _cache_get(key)
+            if hit:
+                meta, f = hit
+                with f:
+                    age = time.time() - meta["stored"] + meta.get("age", 0)
+                    if not revalidate and not meta["no_cache"] and age < meta["fresh"]:
+                        _proxy_count("hits")
+                        return self._serve_cached(meta, f)
+                    cond = {}
+                    if meta.get("etag"): cond["If-None-Match"] = meta["etag"]
+                    if meta.get("last_modified"): cond["If-Modified-Since"] = meta["last_modified"]
+                    if cond:
+                        conn, resp = self._origin("GET", self.path, cond)
+                        try:
+                            if resp.status != 304: return self._store_and_relay(key, resp)
+                            resp.read()
+                            _proxy_count("revalidated")
+                            self._refresh(key, meta, f, resp)
+                            return
+                        finally: conn.close()
+            _proxy_count("misses")
+            conn, resp = self._origin("GET", self.path)
+            try: self._store_and_relay(key, resp)
+            finally: conn.close()
+        except (BrokenPipeError, ConnectionResetError): self.close_connection = True
+        except Exception as e:
+            try: self.send_error(502, f"Proxy error: {e}")
+            except Exception: pass
+            self.close_connection = True
+
+    def _refresh(self, key, meta, f, resp):
+        """304 from origin: merge its headers, serve the stored body, and
+        rewrite the entry with the new freshness."""
+        now = time.time()
+        upd = {k.lower(): (k, v) for k, v in resp.getheaders()
+               if k.lower() not in _HOP_HEADERS and k.lower() != "content-length"}
+        meta["headers"] = [h for h in meta["headers"] if h[0].lower() not in upd] + list(upd.values())
+        meta.update(stored=now, age=0, fresh=_freshness(resp.msg, now) or meta["fresh"])
+        self._serve_cached(meta, f)
+        f.seek(0)
+        tmp = _cache_tmp(key)
+        out = open(tmp, "wb")
+        left = meta["size"]
+        while left > 0:
+            buf = f.read(min(262144, left))
+            if not buf: break
+            out.write(buf); left -= len(buf)
+        _cache_finish(key, tmp, out, meta)
+
+    def _store_and_relay(self, key, resp):
+        now = time.time()
+        cc = _cc(resp.msg)
+        vary = {v.strip().lower() for v in (resp.getheader("Vary") or "").split(",") if v.strip()}
+        fresh = _freshness(resp.msg, now)
+        status = self._status_line(resp)
+        cacheable = (resp.status in _CACHEABLE_STATUS and "no-store" not in cc
+                     and "private" not in cc and not resp.getheader("Set-Cookie")
+                     and vary <= {"accept-encoding"}
+                     and (status[2] is None or status[2] <= PROXY_MAX_OBJECT)
+                     and (fresh > 0 or resp.getheader("ETag") or resp.getheader("Last-Modified")))
+        headers = [(k, v) for k, v in resp.getheaders()
+                   if k.lower() not in _HOP_HEADERS and k.lower() != "content-length"]
+        chunked = self._send_head(status, headers)
+        if not cacheable:
+            _cache_drop(key); _proxy_count("uncacheable")
+            self._relay(resp, chunked); return
+        tmp = _cache_tmp(key)
+        out = open(tmp, "wb")
+        size = 0
+        def sink(buf):
+            nonlocal size
+            if size is None: return
+            size += len(buf)
+            if size > PROXY_MAX_OBJECT: size = None
+            else: out.write(buf)
+        try: self._relay(resp, chunked, sink)
+        except Exception:
+            out.close(); tmp.unlink(missing_ok=True); raise
+        if size is None or (status[2] is not None and size != status[2]):
+            out.close(); tmp.unlink(missing_ok=True); return
+        try: age = int(resp.getheader("Age") or 0)
+        except ValueError: age = 0
+        _cache_finish(key, tmp, out, {
+            "status":resp.status, "reason":resp.reason, "headers":headers,
+            "stored":now, "age":age, "fresh":fresh, "size":size,
+            "no_cache":"no-cache" in cc, "etag":resp.getheader("ETag"),
+            "last_modified":resp.getheader("Last-Modified")})
+
+    do_GET = do_HEAD = do_POST = do_PUT = do_DELETE = do_PATCH = do_OPTIONS = _handle
+
+def _start_cache_proxy():
+    """Start the shared proxy on 127.0.0.1:PROXY_PORT. If the port is taken
+    we assume another QuantumSurf on this host already runs it and share it."""
+    global _proxy_url
+    if not PROXY_ENABLED: return None
+    PROXY_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    try:
+        srv = http.server.ThreadingHTTPServer(("127.0.0.1", PROXY_PORT), _ProxyHandler)
+    except OSError:
+        _log(f"Proxy port {PROXY_PORT} busy — sharing the existing host proxy", "WARN", "proxy")
+        _proxy_url = f"http://127.0.0.1:{PROXY_PORT}"
+        return _proxy_url
+    srv.daemon_threads = True
+    _cache_load_index()
+    threading.Thread(target=srv.serve_forever, daemon=True, name="cache-proxy").start()
+    _proxy_url = f"http://127.0.0.1:{PROXY_PORT}"
+    _log(f"Caching proxy on {_proxy_url} ({_proxy_bytes//(1024*1024)}MB cached, "
+         f"limit {PROXY_CACHE_BYTES//(1024*1024)}MB)", component="proxy")
+    return _proxy_url
+
+# ═══════════════════════════════════════════════════════════
+# PROFILE SNAPSHOTS
+# ═══════════════════════════════════════════════════════════
+# When Chromium stops, its profile is saved to a per-user content-addressed
+# store:  <store>/<sha256(user)[:16]>/objects/<sha256 of file>  (zlib -1)
+#                                    /manifest.json  {path: [sha, size, mtime_ns, mode]}
+# Files whose size and mtime match the previous manifest are not even read,
+# identical files share one object, caches are never copied, and objects
+# the new manifest no longer references are deleted, so each user holds
+# exactly one compressed profile. Restore writes the files back with their
+# recorded mtimes, keeping the next snapshot incremental.
+_PROFILE_SKIP_DIRS = {"Cache", "Code Cache", "GPUCache", "GrShaderCache", "ShaderCache",
+    "DawnCache", "DawnGraphiteCache", "DawnWebGPUCache", "GraphiteDawnCache", "CacheStorage",
+    "ScriptCache", "component_crx_cache", "extensions_crx_cache", "Crashpad", "Crash Reports",
+    "BrowserMetrics", "Safe Browsing", "optimization_guide_model_store",
+    "OnDeviceHeadSuggestModel", "segmentation_platform"}
+_profile_owner = None      # user whose browser state the next launch restores
+_profile_loaded_for = None
+CHROME_PROFILE = None      # user-data-dir of the running Chromium
+
+def _profile_key(user):
+    return hashlib.sha256((user or "default").encode()).hexdigest()[:16]
+
+def _profile_manifest(d):
+    try: return json.loads((d / "manifest.json").read_text())
+    except (OSError, ValueError): return {"files":{}}
+
+def _profile_snapshot(src, user):
+    """Save profile dir `src` for `user`. Returns stats, or None if skipped."""
+    t0 = time.monotonic()
+    d = PROFILE_STORE / _profile_key(user)
+    objs = d / "objects"; objs.mkdir(parents=True, exist_ok=True)
+    prev = _profile_manifest(d)["files"]
+    files, read = {}, 0
+    for root, dirs, names in os.walk(src):
+        dirs[:] = [x for x in dirs if x not in _PROFILE_SKIP_DIRS]
+        for n in names:
+            if n.startswith("Singleton") or n.endswith(".pma"): continue
+            p = os.path.join(root, n)
+            try: st = os.lstat(p)
+            except OSError: continue
+            if not stat.S_ISREG(st.st_mode) or st.st_size > PROFILE_MAX_FILE: continue
+            rel = os.path.relpath(p, src)
+            old = prev.get(rel)
+            if old and old[1] == st.st_size and old[2] == st.st_mtime_ns and (objs / old[0]).exists():
+                files[rel] = old; continue
+            try:
+                with open(p, "rb") as f: data = f.read()
+            except OSError: continue
+            sha = hashlib.sha256(data).hexdigest()
+            obj = objs / sha
+            if not obj.exists():
+                tmp = obj.with_suffix(".tmp")
+                tmp.write_bytes(zlib.compress(data, 1)); os.replace(tmp, obj)
+            read += len(data)
+            files[rel] = [sha, st.st_size, st.st_mtime_ns, st.st_mode & 0o777]
+    keep = {v[0] for v in files.values()}
+    stored = sum((objs / s).stat().st_size for s in keep)
+    if stored > PROFILE_MAX_BYTES:
+        _log(f"profile snapshot {stored >> 20} MB over QS_PROFILE_MAX_MB — keeping the previous one", "WARN", "profile")
+        keep, files = {v[0] for v in prev.values()}, None
+    else:
+        tmp = d / "manifest.tmp"
+        tmp.write_text(json.dumps({"created":time.time(), "bytes":stored, "files":files}))
+        os.replace(tmp, d / "manifest.json")
+    for o in objs.iterdir():
+        if o.name not in keep:
+            try: o.unlink()
+            except OSError: pass
+    if files is None: return None
+    return {"files":len(files), "read_bytes":read, "stored_bytes":stored,
+            "seconds":round(time.monotonic() - t0, 3)}
+
+def _profile_restore(user, dst):
+    """Write `user`'s last snapshot into dst. Returns stats, or None."""
+    t0 = time.monotonic()
+    d = PROFILE_STORE / _profile_key(user)
+    files = _profile_manifest(d)["files"]
+    if not files: return None
+    made = set()
+    for rel, (sha, size, mtime, mode) in files.items():
+        p = os.path.join(dst, rel)
+        parent = os.path.dirname(p)
+        if parent not in made: os.makedirs(parent, exist_ok=True); made.add(parent)
+        try:
+            with open(d / "objects" / sha, "rb") as f: data = zlib.decompress(f.read())
+        except (OSError, zlib.error): continue
+        with open(p, "wb") as f: f.write(data)
+        os.chmod(p, mode); os.utime(p, ns=(mtime, mtime))
+    return {"files":len(files), "seconds":round(time.monotonic() - t0, 3)}
+
+def _profile_save():
+    """Snapshot and remove the profile of a Chromium that has just stopped."""
+    global CHROME_PROFILE
+    ud, CHROME_PROFILE = CHROME_PROFILE, None
+    if not ud: return
+    if PROFILE_SNAPSHOTS:
+        try:
+            s = _profile_snapshot(ud, _profile_loaded_for)
+            if s: _log(f"profile saved: {s['files']} files, {s['read_bytes'] >> 10} KB changed, "
+                       f"{s['stored_bytes'] >> 10} KB stored ({s['seconds'] * 1000:.0f}ms)", component="profile")
+        except OSError as e:
+            _log(f"profile snapshot failed: {e}", "WARN", "profile")
+    shutil.rmtree(ud, ignore_errors=True)
+
+# ═══════════════════════════════════════════════════════════
+# FILE TRANSFER
+# ═══════════════════════════════════════════════════════════
+# Each browser profile gets Downloads/ and Uploads/ under TRANSFER_ROOT.
+# Chromium saves into Downloads/ without prompting and its file picker opens
+# in Uploads/. Downloads are sent with socket.sendfile, so file data goes
+# from the page cache to the socket without passing through Python. Uploads
+# arrive in chunks (Content-Range) and are written straight to a partial
+# file, 1 MB at a time. Memory stays flat whatever the file size, and an
+# interrupted transfer resumes from the last byte received.
+_transfer_watched = set()
+_transfer_lock = threading.Lock()
+
+def _transfer_dirs(user=None):
+    """(downloads, uploads) of the running Chromium's profile, or `user`'s."""
+    base = TRANSFER_ROOT / _profile_key(user or _profile_loaded_for)
+    dl, up = base / "Downloads", base / "Uploads"
+    for d in (dl, up): d.mkdir(parents=True, exist_ok=True, mode=0o700)
+    with _transfer_lock:
+        if dl in _transfer_watched: return dl, up
+        _transfer_watched.add(dl)
+    _watch_dir(dl, lambda name, d=dl: _download_seen(d, name), "downloads", poll=1.0)
+    return dl, up
+
+def _download_seen(d, name):
+    if name.startswith(".") or name.endswith(".crdownload"): return
+    try: st = (d / name).stat()
+    except OSError: return
+    if stat.S_ISREG(st.st_mode) and d == _transfer_dirs()[0]:
+        _publish("download", {"name":name, "size":st.st_size})
+
+def _transfer_prefs(ud):
+    """Point a fresh Chromium profile at the transfer directories."""
+    dl, up = _transfer_dirs()
+    f = Path(ud) / "Default" / "Preferences"
+    try: prefs = json.loads(f.read_text())
+    except (OSError, ValueError): prefs = {}
+    prefs.setdefault("download", {}).update(default_directory=str(dl), prompt_for_download=False,
+                                            directory_upgrade=True)
+    prefs.setdefault("savefile", {})["default_directory"] = str(dl)
+    prefs.setdefault("selectfile", {})["last_directory"] = str(up)
+    f.parent.mkdir(parents=True, exist_ok=True)
+    f.write_text(json.dumps(prefs))
+
+def _transfer_name(name):
+    """A plain file name, or None: no paths, no hidden or partial files."""
+    name = name.strip()
+    if not name or name != os.path.basename(name) or name.startswith(".") or "\0" in name \
+            or len(name.encode()) > 255 or name.endswith(".crdownload"):
+        return None
+    return name
+
+def _transfer_list(d):
+    out = []
+    try:
+        for e in os.scandir(d):
+            if e.name.startswith(".") or e.name.endswith(".crdownload") or not e.is_file(): continue
+            st = e.stat(); out.append({"name":e.name, "size":st.st_size, "mtime":int(st.st_mtime)})
+    except OSError: pass
+    return sorted(out, key=lambda x: -x["mtime"])
+
+def _transfer_usage():
+    total = 0
+    for d in _transfer_dirs():
+        try: total += sum(e.stat().st_size for e in os.scandir(d) if e.is_file())
+        except OSError: pass
+    return total
+
+def _file_response(path):
+    """Send a file with Range / If-Range support. Under the werkzeug server the
+    body goes out with socket.sendfile; elsewhere it is streamed in 1 MB reads."""
+    st = os.stat(path); size = st.st_size
+    etag = f"{st.st_ino:x}-{size:x}-{st.st_mtime_ns:x}"
+    start, stop, status = 0, size, 200
+    rng = request.range
+    if rng and len(rng.ranges) == 1 and (not request.headers.get("If-Range") or request.if_range.etag == etag):
+        r = rng.range_for_length(size)
+        if r is None:
+            return Response(status=416, headers={"Content-Range":f"bytes */{size}"})
+        (start, stop), status = r, 206
+    name = os.path.basename(path)
+    headers = {"Content-Length":str(stop - start), "Accept-Ranges":"bytes", "ETag":f'"{etag}"',
+               "Last-Modified":email.utils.formatdate(st.st_mtime, usegmt=True),
+               "Content-Disposition":f"attachment; filename*=UTF-8''{quote(name)}",
+               "Cache-Control":"private, no-cache"}
+    if status == 206: headers["Content-Range"] = f"bytes {start}-{stop - 1}/{size}"
+    sock = request.environ.get("werkzeug.socket")
+    def body():
+        with open(path, "rb") as f:
+            if sock is not None:
+                yield b""   # werkzeug writes the status line and headers on the first chunk
+                sock.sendfile(f, start, stop - start)
+                return
+            f.seek(start); left = stop - start
+            while left > 0:
+                chunk = f.read(min(left, 1 << 20))
+                if not chunk: break
+                left -= len(chunk); yield chunk
+    return Response(body(), status=status, headers=headers,
+                    mimetype="application/octet-stream", direct_passthrough=True)
+
+# ═══════════════════════════════════════════════════════════
+# ADMISSION CONTROL
+# ═══════════════════════════════════════════════════════════
+# One sampler thread reads host CPU (/proc/stat), memory (/proc/meminfo),
+# PSI (/proc/pressure/*, Linux 4.20+; skipped when absent) and the number of
+# Xvfb stacks on the host every ADMIT_INTERVAL. New stack starts wait in the
+# op queue while any limit is exceeded, so users already running keep their
+# headroom; the HTTP layer answers 503 + Retry-After meanwhile.
+_pressure = {}
+_admission_started = False
+
+def _host_pressure(prev):
+    """Fresh pressure sample; `prev` carries the last /proc/stat totals."""
+    out = {}
+    try:
+        with open("/proc/stat") as f: v = [int(x) for x in f.readline().split()[1:9]]
+        total, idle = sum(v), v[3] + v[4]
+        if prev.get("cpu_total"):
+            dt = total - prev["cpu_total"]
+            out["cpu_pct"] = round(100 * (dt - (idle - prev["cpu_idle"])) / dt, 1) if dt else 0.0
+        out["cpu_total"], out["cpu_idle"] = total, idle
+    except (OSError, ValueError): pass
+    mem = _meminfo()
+    if mem.get("MemTotal"):
+        out["mem_pct"] = round(100 * (1 - mem.get("MemAvailable", 0) / mem["MemTotal"]), 1)
+    for res in ("cpu", "memory", "io"):
+        try:
+            with open(f"/proc/pressure/{res}") as f: some = f.readline()
+            out[f"psi_{res}"] = float(some.split("avg10=")[1].split()[0])
+        except (OSError, ValueError, IndexError): pass
+    stacks = 0
+    for d in os.listdir("/proc"):
+        if not d.isdigit(): continue
+        try:
+            with open(f"/proc/{d}/comm") as f: stacks += f.read().strip() == "Xvfb"
+        except OSError: pass
+    out["stacks"] = stacks
+    return out
+
+def _start_admission():
+    global _admission_started, _pressure
+    if _admission_started: return
+    _admission_started = True
+    _pressure = _host_pressure({})
+    def _loop():
+        global _pressure
+        was = None
+        while True:
+            time.sleep(ADMIT_INTERVAL)
+            _pressure = _host_pressure(_pressure)
+            now = _admit_reason()
+            if now != was:
+                if now: _log(f"admission closed: {now}", "WARN", "admission")
+                else: _log("admission open", component="admission")
+                with _ops_cond: _ops_cond.notify_all()
+                was = now
+    threading.Thread(target=_loop, daemon=True, name="admission").start()
+
+def _admit_reason():
+    """Why a new stack must not start right now, or None."""
+    p = _pressure
+    own = 1 if (PROCS.get("xvfb") and PROCS["xvfb"].poll() is None) else 0
+    checks = (("memory", p.get("mem_pct"), ADMIT_MEM_PCT, "%"),
+              ("CPU", p.get("cpu_pct"), ADMIT_CPU_PCT, "%"),
+              ("memory pressure", p.get("psi_memory"), ADMIT_PSI_MEM, "% stalled"),
+              ("CPU pressure", p.get("psi_cpu"), ADMIT_PSI_CPU, "% stalled"))
+    for name, val, limit, unit in checks:
+        if val is not None and limit and val >= limit: return f"{name} {val:g}{unit} ≥ {limit:g}{unit}"
+    if MAX_STACKS and p.get("stacks", 0) - own >= MAX_STACKS:
+        return f"{p['stacks'] - own} other stacks running (limit {MAX_STACKS})"
+    return None
+
+def _admission_view():
+    return {"reason":_admit_reason(), "retry_after":ADMIT_INTERVAL * 2,
+            "pressure":{k: v for k, v in _pressure.items() if not k.startswith("cpu_t") and k != "cpu_idle"},
+            "limits":{"mem_pct":ADMIT_MEM_PCT, "cpu_pct":ADMIT_CPU_PCT, "psi_memory":ADMIT_PSI_MEM,
+                      "psi_cpu":ADMIT_PSI_CPU, "stacks":MAX_STACKS}}
+
+# ═══════════════════════════════════════════════════════════
+# CPU PLACEMENT
+# ═══════════════════════════════════════════════════════════
+# Every stack on the host (one per QuantumSurf instance, keyed by display)
+# gets its own set of CPUs from one NUMA node. Claims are kept in a shared
+# JSON file under flock, so separate instances see each other. A claim
+# whose server has exited is dropped. Stacks are launched through numactl
+# or taskset, so Chromium's children inherit the set from the start. The
+# placement thread re-applies the set to new processes every
+# PLACEMENT_INTERVAL and moves the stack when a less loaded set has come
+# free. When numactl is available, memory is preferred from the node's
+# local RAM and migrated with migratepages on a move.
+_placement = {}      # this stack's claim: cpus, node, want
+_core_busy = {}      # cpu -> busy % over the last interval
+_placement_started = False
+
+def _cpulist(s):
+    out = []
+    for part in s.strip().split(","):
+        if not part: continue
+        a, _, b = part.partition("-")
+        out += range(int(a), int(b or a) + 1)
+    return out
+
+def _numa_topology():
+    """{node: [cpu, ...]} limited to the CPUs this process may use."""
+    allowed = os.sched_getaffinity(0) if hasattr(os, "sched_getaffinity") else set(range(CPU_CORES))
+    topo = {}
+    for d in Path("/sys/devices/system/node").glob("node[0-9]*"):
+        try: cpus = [c for c in _cpulist((d / "cpulist").read_text()) if c in allowed]
+        except (OSError, ValueError): continue
+        if cpus: topo[int(d.name[4:])] = cpus
+    return topo or {0: sorted(allowed)}
+
+NUMA_TOPOLOGY = _numa_topology()   # read once, like CPU_CORES
+
+def _stack_cpus_wanted():
+    return STACK_CPUS or CPU_PLANS.get(CHROME_PRESET, 2)
+
+def _pick_cpus(topo, others, want):
+    """Least-shared `want` CPUs from a single node (all of the emptiest node
+    if it is smaller). Returns (node, cpus)."""
+    use = {}
+    for claim in others:
+        for c in claim["cpus"]: use[c] = use.get(c, 0) + 1
+    best = None
+    for node, cpus in topo.items():
+        pick = sorted(sorted(cpus, key=lambda c: (use.get(c, 0), _core_busy.get(c, 0), c))[:want])
+        score = (sum(use.get(c, 0) for c in pick), -len(pick), sum(use.get(c, 0) for c in cpus))
+        if best is None or score < best[0]: best = (score, node, pick)
+    return best[1], best[2]
+
+@contextlib.contextmanager
+def _placement_claims():
+    """Host-wide claims, locked for the duration; prunes dead servers."""
+    PLACEMENT_FILE.parent.mkdir(parents=True, exist_ok=True)
+    with open(PLACEMENT_FILE, "a+") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            f.seek(0)
+            try: claims = json.loads(f.read() or "{}")
+            except ValueError: claims = {}
+            claims = {k: v for k, v in claims.items() if os.path.exists(f"/proc/{v.get('pid')}")}
+            yield claims
+            f.seek(0); f.truncate(); f.write(json.dumps(claims))
+        finally: fcntl.flock(f, fcntl.LOCK_UN)
+
+def _place_stack(rebalance=False):
+    """Claim (or, with rebalance, improve) this stack's CPU set. Returns True
+    when the set changed."""
+    global _placement
+    if not PLACEMENT: return False
+    topo, want = NUMA_TOPOLOGY, _stack_cpus_wanted()
+    with _placement_claims() as claims:
+        others = [v for k, v in claims.items() if k != XVFB_DISPLAY]
+        node, cpus = _pick_cpus(topo, others, want)
+        mine = claims.get(XVFB_DISPLAY)
+        if mine and mine.get("want") == want and set(mine["cpus"]) <= {c for cs in topo.values() for c in cs}:
+            shared = lambda s: sum(c in o["cpus"] for o in others for c in s)
+            if not rebalance or shared(cpus) >= shared(mine["cpus"]):
+                _placement = claims[XVFB_DISPLAY] = dict(mine, pid=os.getpid())
+                return False
+        old = _placement.get("node")
+        _placement = claims[XVFB_DISPLAY] = {"pid":os.getpid(), "cpus":cpus, "node":node, "want":want}
+    _log(f"CPUs {','.join(map(str, cpus))} on node {node}" + (" (rebalanced)" if rebalance else ""), component="placement")
+    if rebalance and old is not None and old != node and len(topo) > 1 and shutil.which("migratepages"):
+        for pid in _stack_pids():
+            subprocess.run(["migratepages", str(pid), str(old), str(node)], capture_output=True, timeout=10)
+    return True
+
+def _release_placement():
+    global _placement
+    if not PLACEMENT: return
+    try:
+        with _placement_claims() as claims: claims.pop(XVFB_DISPLAY, None)
+    except OSError: pass
+    _placement = {}
+
+def _placement_prefix():
+    """Command prefix that starts a stack process on its CPU set."""
+    if not _placement: return []
+    cpus = ",".join(map(str, _placement["cpus"]))
+    if shutil.which("numactl"):
+        numa = [f"--preferred={_placement['node']}"] if len(NUMA_TOPOLOGY) > 1 else []
+        return ["numactl", f"--physcpubind={cpus}", *numa]
+    return ["taskset", "-c", cpus] if shutil.which("taskset") else []
+
+def _stack_pids():
+    pids = []
+    for name in ("xvfb", "x11vnc", "chromium"):
+        p = PROCS.get(name)
+        if p and p.poll() is None: pids += _proc_tree(p.pid)
+    return pids
+
+def _apply_affinity():
+    """Pin every thread of every stack process; returns threads moved."""
+    if not _placement or not hasattr(os, "sched_setaffinity"): return 0
+    cpus, moved = set(_placement["cpus"]), 0
+    for pid in _stack_pids():
+        try: tids = [int(t) for t in os.listdir(f"/proc/{pid}/task")]
+        except OSError: continue
+        for tid in tids:
+            try:
+                if os.sched_getaffinity(tid) != cpus: os.sched_setaffinity(tid, cpus); moved += 1
+            except OSError: pass
+    return moved
+
+def _core_times():
+    out = {}
+    try:
+        with open("/proc/stat") as f:
+            for line in f:
+                if not line.startswith("cpu") or line[3] == " ": continue
+                v = [int(x) for x in line.split()[1:9]]
+                out[int(line[3:line.index(" ")])] = (sum(v), v[3] + v[4])
+    except (OSError, ValueError): pass
+    return out
+
+def _start_placement():
+    global _placement_started
+    if _placement_started or not PLACEMENT: return
+    _placement_started = True
+    def _loop():
+        global _core_busy
+        prev = _core_times()
+        while True:
+            time.sleep(PLACEMENT_INTERVAL)
+            cur = _core_times()
+            _core_busy = {c: round(100 * (1 - (cur[c][1] - prev[c][1]) / max(1, cur[c][0] - prev[c][0])), 1)
+                          for c in cur if c in prev}
+            prev = cur
+            try:
+                if PROCS.get("xvfb") and PROCS["xvfb"].poll() is None:
+                    _place_stack(rebalance=True)
+                    _apply_affinity()
+            except OSError as e: _log(f"placement: {e}", "WARN", "placement")
+    threading.Thread(target=_loop, daemon=True, name="placement").start()
+
+def _placement_view():
+    topo = NUMA_TOPOLOGY
+    try:
+        with _placement_claims() as claims: claims = dict(claims)
+    except OSError: claims = {}
+    owners = {}
+    for display, claim in claims.items():
+        for c in claim["cpus"]: owners.setdefault(c, []).append(display)
+    return {"enabled":PLACEMENT, "stack":_placement or None, "display":XVFB_DISPLAY,
+            "cores":[{"cpu":c, "node":n, "busy_pct":_core_busy.get(c), "stacks":owners.get(c, [])}
+                     for n, cpus in sorted(topo.items()) for c in cpus]}
+
+# ═══════════════════════════════════════════════════════════
+# STACK OPERATION QUEUE
+# ═══════════════════════════════════════════════════════════
+# Restarts and resizes go through one worker with single-flight semantics:
+# at most one operation runs and at most one waits. A newer request replaces
+# the waiting one, so a burst of resizes during a window drag costs one
+# kill/boot cycle for the final size instead of one per request.
+_ops = OrderedDict()     # op id -> op dict (bounded history)
+_ops_cond = threading.Condition()
+_pending_op = None
+_running_op = None
+_ops_worker_started = False
+OPS_HISTORY = 64
+
+def _op_view(op):
+    return {k: op[k] for k in ("id","kind","width","height","depth","status","submitted",
+                               "started","finished","superseded_by","reason")}
+
+def _op_target():
+    """(width, height, depth) the stack is heading to once queued work finishes."""
+    with _ops_cond:
+        for op in (_pending_op, _running_op):
+            if op and op["width"]: return op["width"], op["height"], op["depth"] or CURRENT_DEPTH
+    return CURRENT_W, CURRENT_H, CURRENT_DEPTH
+
+def _op_position(op):
+    """1-based place of an op in the queue (the running op, then the waiting
+    one), or None once it is neither. Requests coalesced into one op share it."""
+    with _ops_cond:
+        line = [o for o in (_running_op, _pending_op) if o]
+    return next((i + 1 for i, o in enumerate(line) if o is op), None)
+
+def _submit_stack_op(kind, w=None, h=None, depth=None):
+    """Queue a "restart" (current size) or "resize" (w x h, optionally a new
+    colour depth). Returns the op
+    dict whose id the caller can poll at /api/stack_op/<id> or follow as
+    `op` events on /api/events."""
+    global _pending_op
+    superseded = None
+    with _ops_cond:
+        p, r = _pending_op, _running_op
+        if p and kind == "restart":
+            return p  # the waiting op restarts the stack anyway
+        if not p and kind == "resize" and r and (r["width"], r["height"], r["depth"]) == (w, h, depth):
+            return r  # already heading there
+        op = {"id":secrets.token_hex(6), "kind":kind, "width":w, "height":h, "depth":depth,
+              "status":"queued", "submitted":time.time(), "started":None,
+              "finished":None, "superseded_by":None, "reason":None}
+        if p:
+            p.update(status="superseded", superseded_by=op["id"], finished=time.time())
+            superseded = p
+        _pending_op = op
+        _ops[op["id"]] = op
+        while len(_ops) > OPS_HISTORY: _ops.popitem(last=False)
+        _ops_cond.notify()
+    if superseded:
+        _log(f"Stack op {superseded['id']} superseded by {op['id']}", component="ops")
+        _publish("op", _op_view(superseded))
+    _publish("op", _op_view(op))
+    _start_ops_worker()
+    return op
+
+def _start_ops_worker():
+    global _ops_worker_started
+    with _ops_cond:
+        if _ops_worker_started: return
+        _ops_worker_started = True
+    def _loop():
+        global _pending_op, _running_op
+        while True:
+            with _ops_cond:
+                while _pending_op is None: _ops_cond.wait()
+                reason = _admit_reason()
+                if reason:
+                    # Stay pending so a newer request can still supersede it.
+                    op, changed = _pending_op, _pending_op.get("reason") != reason
+                    op.update(status="waiting", reason=reason)
+                    _ops_cond.wait(ADMIT_INTERVAL)
+                else:
+                    op, _pending_op, changed = _pending_op, None, None
+                    _running_op = op
+                    op.update(status="running", started=time.time(), reason=None)
+            if changed is not None:
+                if changed: _publish("op", _op_view(op))
+                continue
+            _publish("op", _op_view(op))
+            try:
+                ok = _restart_stack(op["width"] or CURRENT_W, op["height"] or CURRENT_H, op["depth"])
+            except Exception as e:
+                _log(f"Stack op {op['id']} crashed: {e}", "ERROR", "ops"); ok = False
+            with _ops_cond:
+                op.update(status="done" if ok else "failed", finished=time.time())
+                _running_op = None
+            _publish("op", _op_view(op))
+    threading.Thread(target=_loop, daemon=True, name="stack-ops").start()
+
+# ═══════════════════════════════════════════════════════════
+# FRAMEBUFFER SNAPSHOTS
+# ═══════════════════════════════════════════════════════════
+_XWD_FIELDS = ("header_size","file_version","pixmap_format","pixmap_depth",
+    "pixmap_width","pixmap_height","xoffset","byte_order","bitmap_unit",
+    "bitmap_bit_order","bitmap_pad","bits_per_pixel","bytes_per_line",
+    "visual_class","red_mask","green_mask","blue_mask","bits_per_rgb",
+    "colormap_entries","ncolors","window_width","window_height",
+    "window_x","window_y","border_width")
+_fb_map = None          # (inode, size, header bytes) key, mmap, parsed XWD header
+_fb_lock = threading.Lock()
+_snap_cache = {}        # (width, fmt) -> {"ts","digest","etag","body","mime"}
+_snap_lock = threading.Lock()
+
+def _fb_parse(raw):
+    hdr = dict(zip(_XWD_FIELDS, struct.unpack(">25I", raw)))  # XWD header is MSB-first
+    hdr["data_offset"] = hdr["header_size"] + hdr["ncolors"] * 12
+    return hdr
+
+def _fb_open():
+    """Map Xvfb's -fbdir XWD file read-only.
+
+    The file IS the X server's framebuffer, so reading the mapping sees the
+    live screen with no socket round-trip and no full-frame copy. The map is
+    re-opened whenever Xvfb is restarted (new inode or size), and the 100-byte
+    header is re-read on every call because Xvfb rewrites the file in place."""
+    global _fb_map
+    path = FB_DIR / "Xvfb_screen0"
+    try: st = path.stat()
+    except OSError: return None
+    with _fb_lock:
+        if _fb_map and _fb_map[0][:2] == (st.st_ino, st.st_size):
+            mm = _fb_map[1]
+            raw = mm[:100]
+            if raw == _fb_map[0][2]: return _fb_map
+            _fb_map = ((st.st_ino, st.st_size, raw), mm, _fb_parse(raw))
+            return _fb_map
+        if _fb_map:
+            try: _fb_map[1].close()
+            except: pass
+            _fb_map = None
+        try:
+            with open(path, "rb") as f:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError): return None
+        if len(mm) < 100: mm.close(); return None
+        raw = mm[:100]
+        _fb_map = ((st.st_ino, st.st_size, raw), mm, _fb_parse(raw))
+        return _fb_map
+
+def _fb_thumbnail(max_w):
+    """Nearest-neighbour downscale of the live framebuffer to RGB24.
+
+    Each output channel of a row is one strided slice of the mmap
+    (mm[start:stop:step]) assigned into a strided slice of the output, so the
+    per-pixel work runs in C and only sampled pixels are ever touched.
+    Returns (width, height, rgb_bytes) or None."""
+    fb = _fb_open()
+    if not fb: return None
+    _, mm, hdr = fb
+    w, h, bpl = hdr["pixmap_width"], hdr["pixmap_height"], hdr["bytes_per_line"]
+    bpp = hdr["bits_per_pixel"]
+    if bpp not in (8, 16, 32) or not w or not h: return None
+    nb = bpp // 8
+    step = max(1, -(-w // max(16, max_w)))
+    tw, th = len(range(0, w, step)), len(range(0, h, step))
+    off = hdr["data_offset"]
+    if off + (h - 1) * bpl + w * nb > len(mm): return None  # Xvfb mid-restart
+    lsb = hdr["byte_order"] == 0
+    out = bytearray(th * (tw * 3 + 1))  # +1: PNG filter byte per row (0 = None)
+    stride = nb * step
+    if bpp == 32:
+        chans = []
+        for mask in (hdr["red_mask"], hdr["green_mask"], hdr["blue_mask"]):
+            b = (mask.bit_length() - 8) // 8
+            chans.append(b if lsb else 3 - b)
+        for i, y in enumerate(range(0, h, step)):
+            row = off + y * bpl
+            o = i * (tw * 3 + 1) + 1
+            for c, b in enumerate(chans):
+                out[o + c:o + tw * 3:3] = mm[row + b:row + w * 4:stride]
+        return tw, th, out
+    # 16/8 bpp (RGB565, RGB332): a channel's bits sit in one or two bytes of
+    # the pixel. Per byte, a 256-entry table maps it to that byte's share of
+    # the 8-bit channel value (bit-replicated); shares from two bytes are
+    # disjoint, so OR-ing them gives the channel. translate() keeps it in C.
+    chans = []
+    for mask in (hdr["red_mask"], hdr["green_mask"], hdr["blue_mask"]):
+        shift, bits = (mask & -mask).bit_length() - 1, bin(mask).count("1")
+        top = (1 << bits) - 1
+        pos = [p for p in ((8 * k if lsb else 8 * (nb - 1 - k)) for k in range(nb)) if (mask >> p) & 0xFF]
+        def share(x, p):
+            v = ((x << p) & mask) >> shift
+            if len(pos) == 1: return v * 255 // top
+            return ((v << (8 - bits)) | (v >> (2 * bits - 8))) & 0xFF  # 5/6-bit fields only
+        parts = []
+        for k in range(nb):
+            p = 8 * k if lsb else 8 * (nb - 1 - k)
+            if p in pos: parts.append((k, bytes(share(x, p) for x in range(256))))
+        chans.append(parts)
+    for i, y in enumerate(range(0, h, step)):
+        row = off + y * bpl
+        o = i * (tw * 3 + 1) + 1
+        for c, parts in enumerate(chans):
+            vals = [mm[row + k:row + w * nb:stride].translate(t) for k, t in parts]
+            if len(vals) == 2:
+                vals[0] = (int.from_bytes(vals[0], "big") | int.from_bytes(vals[1], "big")).to_bytes(tw, "big")
+            out[o + c:o + tw * 3:3] = vals[0]
+    return tw, th, out
+
+def _png_encode(w, h, filtered_rows):
+    def chunk(tag, data):
+        return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data) & 0xffffffff)
+    return (b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", struct.pack(">IIBBBBB", w, h, 8, 2, 0, 0, 0))
+            + chunk(b"IDAT", zlib.compress(bytes(filtered_rows), 6)) + chunk(b"IEND", b""))
+
+def _webp_encode(w, h, filtered_rows):
+    # Strip the PNG filter bytes back out for Pillow's raw RGB decoder.
+    raw = bytearray(w * h * 3)
+    for i in range(h): raw[i*w*3:(i+1)*w*3] = filtered_rows[i*(w*3+1)+1:(i+1)*(w*3+1)]
+    buf = io.BytesIO()
+    Image.frombytes("RGB", (w, h), bytes(raw)).save(buf, "WEBP", quality=70, method=0)
+    return buf.getvalue()
+
+def _get_snapshot(max_w, fmt):
+    """Cached thumbnail for (max_w, fmt). Re-reads the framebuffer at most
+    once per SNAPSHOT_TTL and only re-encodes (new ETag) when pixels changed."""
+    if fmt == "webp" and Image is None: fmt = "png"
+    key = (max_w, fmt)
+    with _snap_lock:
+        c = _snap_cache.get(key)
+        now = time.monotonic()
+        if c and now - c["ts"] < SNAPSHOT_TTL: return c
+        thumb = _fb_thumbnail(max_w)
+        if not thumb: return c
+        tw, th, rows = thumb
+        digest = hashlib.blake2b(rows, digest_size=12).hexdigest()
+        if c and c["digest"] == digest:
+            c["ts"] = now; return c
+        body = _webp_encode(tw, th, rows) if fmt == "webp" else _png_encode(tw, th, rows)
+        c = {"ts":now, "digest":digest, "etag":f"{digest}-{fmt}", "body":body,
+             "mime":f"image/{fmt}", "width":tw, "height":th}
+        _snap_cache[key] = c
+        return c
+
+# ═══════════════════════════════════════════════════════════
+# SESSION TRACES
+# ═══════════════════════════════════════════════════════════
+# With QS_TRACE_DIR set, every /ws bridge connection is recorded to
+#   <dir>/<started>-<session>.qst   header + independently zlib'd blocks
+#   <dir>/<started>-<session>.qsi   fixed-size index: (t_us, offset, kind)
+# Blocks hold (t_us, direction, len, bytes) records; every TRACE_KEYFRAME_S a
+# KEY block with the full framebuffer (PNG-filtered RGB24 rows from the
+# -fbdir mmap) goes first, so a reader can seek to any keyframe via the
+# index without decompressing what came before. One writer thread does all
+# compression and I/O; the bridge only enqueues, and past TRACE_QUEUE_BYTES
+# of backlog records are dropped and a GAP record notes how many bytes.
+_TRACE_MAGIC = b"QSTRACE1"
+_TRACE_REC = struct.Struct(">QBI")       # t_us, direction, length
+_TRACE_IDX = struct.Struct(">QQB")       # t_us, block offset, kind
+_TRACE_BLK = struct.Struct(">4sII")      # tag, compressed len, raw len
+TRACE_C2S, TRACE_S2C, TRACE_GAP = 0, 1, 2
+_trace_q = queue.SimpleQueue()
+_trace_pending = 0
+_trace_writer_started = False
+_trace_lock = threading.Lock()
+
+class _Trace:
+    __slots__ = ("path", "f", "idx", "t0", "buf", "buf_t", "last_key", "dropped")
+
+def _trace_open(sess, user):
+    """Start recording a bridge connection; None when tracing is off."""
+    global _trace_writer_started
+    if not TRACE_DIR: return None
+    try:
+        TRACE_DIR.mkdir(parents=True, exist_ok=True)
+        base = TRACE_DIR / f"{time.strftime('%Y%m%d-%H%M%S')}-{sess or 'anon'}"
+        tr = _Trace()
+        tr.path = base.with_suffix(".qst")
+        tr.f = open(tr.path, "wb"); tr.idx = open(base.with_suffix(".qsi"), "wb")
+        hdr = json.dumps({"version":1, "started":time.time(), "session":sess, "user":user,
+                          "width":CURRENT_W, "height":CURRENT_H}).encode()
+        tr.f.write(_TRACE_MAGIC + struct.pack(">I", len(hdr)) + hdr)
+        tr.t0 = time.monotonic(); tr.buf = bytearray(); tr.buf_t = None
+        tr.last_key = None; tr.dropped = 0
+    except OSError as e:
+        _log(f"trace disabled for this connection: {e}", "WARN", "trace", sess); return None
+    with _trace_lock:
+        if not _trace_writer_started:
+            _trace_writer_started = True
+            threading.Thread(target=_trace_writer, daemon=True, name="trace-writer").start()
+    return tr
+
+def _trace_rec(tr, direction, data):
+    global _trace_pending
+    if tr is None: return
+    t_us = int((time.monotonic() - tr.t0) * 1e6)
+    if _trace_pending + len(data) > TRACE_QUEUE_BYTES:
+        tr.dropped += len(data); return
+    _trace_pending += len(data)   # approximate under races; only a soft cap
+    _trace_q.put((tr, t_us, direction, data))
+
+def _trace_close(tr):
+    if tr is not None: _trace_q.put((tr, None, None, None))
+
+def _trace_flush(tr, kind=b"BLK0"):
+    if not tr.buf: return
+    comp = zlib.compress(bytes(tr.buf), 3)
+    off = tr.f.tell()
+    tr.f.write(_TRACE_BLK.pack(kind, len(comp), len(tr.buf)) + comp)
+    tr.idx.write(_TRACE_IDX.pack(tr.buf_t, off, 1 if kind == b"KEY0" else 0))
+    tr.buf = bytearray(); tr.buf_t = None
+
+def _trace_keyframe(tr, t_us):
+    """Flush pending data, then write a KEY block of the current screen."""
+    _trace_flush(tr)
+    tr.last_key = t_us
+    thumb = _fb_thumbnail(MAX_W)
+    if not thumb: return
+    w, h, rows = thumb
+    tr.buf = bytearray(struct.pack(">QHH", t_us, w, h)) + rows
+    tr.buf_t = t_us
+    _trace_flush(tr, b"KEY0")
+
+def _trace_writer():
+    global _trace_pending
+    open_traces = set()
+    while True:
+        try: item = _trace_q.get(timeout=1.0)
+        except queue.Empty: item = None
+        now_us = None
+        if item:
+            tr, t_us, direction, data = item
+            try:
+                if t_us is None:
+                    _trace_flush(tr); tr.f.close(); tr.idx.close(); open_traces.discard(tr)
+                    continue
+                open_traces.add(tr)
+                _trace_pending -= len(data)
+                if tr.last_key is None or t_us - tr.last_key >= TRACE_KEYFRAME_S * 1e6:
+                    _trace_keyframe(tr, t_us)
+                if tr.dropped:
+                    tr.buf += _TRACE_REC.pack(t_us, TRACE_GAP, tr.dropped); tr.dropped = 0
+                if tr.buf_t is None: tr.buf_t = t_us
+                tr.buf += _TRACE_REC.pack(t_us, direction, len(data)); tr.buf += data
+                if len(tr.buf) >= 262144: _trace_flush(tr)
+            except (OSError, ValueError) as e:
+                _log(f"trace write failed: {e}", "WARN", "trace"); open_traces.discard(tr)
+            continue
+        # Idle second: push out partial blocks so a crash loses little.
+        for tr in list(open_traces):
+            try:
+                _trace_flush(tr); tr.f.flush(); tr.idx.flush()
+            except (OSError, ValueError): open_traces.discard(tr)
+
+def _trace_index(path):
+    """[(t_us, offset, kind)] for a .qst file, from its .qsi index."""
+    try: raw = Path(path).with_suffix(".qsi").read_bytes()
+    except OSError: return []
+    n = len(raw) // _TRACE_IDX.size
+    return [_TRACE_IDX.unpack_from(raw, i * _TRACE_IDX.size) for i in range(n)]
+
+def _trace_header(f):
+    if f.read(8) != _TRACE_MAGIC: raise ValueError("not a QuantumSurf trace")
+    return json.loads(f.read(struct.unpack(">I", f.read(4))[0]))
+
+def _trace_iter(path, start_s=0.0):
+    """Yield ("key", t_us, (w, h, rgb_rows)) and ("rec", t_us, (dir, bytes))
+    starting at the last keyframe at or before start_s, found through the
+    index; nothing before that block is read or decompressed."""
+    idx = _trace_index(path)
+    start_us = int(start_s * 1e6)
+    offset = None
+    for t_us, off, kind in idx:
+        if kind == 1 and t_us <= start_us: offset = off
+    with open(path, "rb") as f:
+        _trace_header(f)
+        if offset is not None: f.seek(offset)
+        while True:
+            head = f.read(_TRACE_BLK.size)
+            if len(head) < _TRACE_BLK.size: return
+            tag, clen, _ = _TRACE_BLK.unpack(head)
+            comp = f.read(clen)
+            if len(comp) < clen: return
+            raw = zlib.decompress(comp)
+            if tag == b"KEY0":
+                t_us, w, h = struct.unpack_from(">QHH", raw)
+                yield "key", t_us, (w, h, memoryview(raw)[12:])
+                continue
+            i = 0
+            while i < len(raw):
+                t_us, d, n = _TRACE_REC.unpack_from(raw, i); i += _TRACE_REC.size
+                if d == TRACE_GAP: yield "rec", t_us, (d, n); continue
+                yield "rec", t_us, (d, raw[i:i + n]); i += n
+
+# ═══════════════════════════════════════════════════════════
+# DIAGNOSTICS
+# ═══════════════════════════════════════════════════════════
+# Thread dumps and a wall-clock sampling profiler built on
+# sys._current_frames(). Each sample is a dict lookup per frame (code object
+# -> "file:function", cached), so 100 Hz against live traffic costs a few
+# percent of one core at most; the response reports the sampler's own CPU.
+_thread_sessions = {}   # thread ident -> session id while serving that session
+_code_labels = {}
+_profile_lock = threading.Lock()
+
+def _code_label(code):
+    s = _code_labels.get(code)
+    if s is None:
+        s = _code_labels[code] = f"{os.path.basename(code.co_filename)}:{code.co_name}"
+    return s
+
+def _thread_label(t, ident):
+    sess = _thread_sessions.get(ident)
+    return f"{t.name if t else ident}" + (f"[{sess}]" if sess else "")
+
+def _thread_dump():
+    """Text dump of every live thread: name, session and current stack."""
+    import traceback
+    threads = {t.ident: t for t in threading.enumerate()}
+    out = []
+    for ident, frame in sys._current_frames().items():
+        t = threads.get(ident)
+        flags = " daemon" if t and t.daemon else ""
+        out.append(f'Thread "{_thread_label(t, ident)}" ident={ident}{flags}\n')
+        out.extend(traceback.format_stack(frame))
+        out.append("\n")
+    return "".join(out)
+
+def _profile(seconds, hz):
+    """Sample every thread's stack `hz` times a second for `seconds`.
+    Returns ({"thread;file:func;...": count}, samples, sampler_cpu_s)."""
+    me = threading.get_ident()
+    counts, samples = {}, 0
+    interval = 1.0 / hz
+    cpu0 = time.thread_time()
+    deadline = time.monotonic() + seconds
+    next_t = time.monotonic()
+    while next_t < deadline:
+        names = {t.ident: t for t in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == me: continue
+            stack = []
+            while frame is not None:
+                stack.append(_code_label(frame.f_code)); frame = frame.f_back
+            stack.append(_thread_label(names.get(ident), ident))
+            key = ";".join(reversed(stack))
+            counts[key] = counts.get(key, 0) + 1
+        samples += 1
+        next_t += interval
+        time.sleep(max(0.0, next_t - time.monotonic()))
+    return counts, samples, time.thread_time() - cpu0
+
+# ═══════════════════════════════════════════════════════════
+# RFB CLIENT STREAM
+# ═══════════════════════════════════════════════════════════
+# noVNC usually sends one client message per websocket frame but may batch
+# several (a FramebufferUpdateRequest behind a KeyEvent) or, in principle,
+# split one, so the bridge cuts the byte stream at RFB message boundaries
+# rather than trusting frames. Past the 3.8 handshake every client message
+# has a length readable from its first few bytes; an unknown type leaves
+# the rest of the connection unparsed (passed through untouched).
+_RFB_C2S_SIZE = {0:20, 3:10, 4:8, 5:6, 150:10, 250:4, 255:12}   # fixed-size messages, as noVNC sends them
+
+def _rfb_c2s_size(buf, i):
+    """Length of the client message at buf[i], None until enough of it has
+    arrived to tell, -1 for a type we can't size."""
+    t, have = buf[i], len(buf) - i
+    if t in _RFB_C2S_SIZE: return _RFB_C2S_SIZE[t]
+    if t == 2: return 4 + 4 * struct.unpack_from(">H", buf, i + 2)[0] if have >= 4 else None     # SetEncodings
+    if t == 6: return 8 + abs(struct.unpack_from(">i", buf, i + 4)[0]) if have >= 8 else None    # ClientCutText (<0: extended)
+    if t == 248: return 9 + buf[i + 8] if have >= 9 else None                                   # ClientFence
+    if t == 251: return 8 + 16 * buf[i + 6] if have >= 7 else None                              # SetDesktopSize
+    return -1
+
+class _RfbClientStream:
+    """Cuts client->server bytes into whole messages. feed() returns
+    [(type, bytes)] for what it could complete; handshake bytes and anything
+    after an unknown type come back as (None, bytes), and an incomplete
+    tail waits for the next feed."""
+    __slots__ = ("buf", "stage", "unknown")
+
+    def __init__(self):
+        self.buf, self.stage, self.unknown = b"", "version", None
+
+    def feed(self, data):
+        if self.stage == "raw": return [(None, data)] if data else []
+        buf, i, out = self.buf + data, 0, []
+        while i < len(buf):
+            if self.stage == "raw":
+                out.append((None, buf[i:])); i = len(buf); break
+            if self.stage == "messages":
+                n = _rfb_c2s_size(buf, i)
+                if n is not None and n < 0:
+                    self.stage, self.unknown = "raw", buf[i]; continue
+                if n is None or i + n > len(buf): break
+                out.append((buf[i], buf[i:i + n])); i += n
+                continue
+            n = {"version":12, "security":1, "auth":16, "init":1}[self.stage]
+            if i + n > len(buf): break
+            part = buf[i:i + n]; i += n
+            out.append((None, part))
+            if self.stage == "version":   # 3.3 has no security-type reply to follow
+                self.stage = "security" if part[:11] >= b"RFB 003.007" else "raw"
+            elif self.stage == "security": self.stage = "auth" if part == b"\x02" else "init"
+            else: self.stage = "init" if self.stage == "auth" else "messages"
+        self.buf = buf[i:]
+        return out
+
+# ═══════════════════════════════════════════════════════════
+# LATENCY PROBE
+# ═══════════════════════════════════════════════════════════
+# Input-to-photon latency per session, split into stages:
+#   input      client event -> noVNC sends it            (browser, APP_HTML)
+#   bridge_in  message reaches /ws -> written to x11vnc  (bridge)
+#   vnc        written to x11vnc -> first update bytes back: Chromium
+#              rendering + x11vnc polling/encoding       (bridge)
+#   bridge_out update bytes from x11vnc -> sent on /ws   (bridge)
+#   network    client round trip minus the bridge's share of it
+#   paint      update received -> next animation frame   (browser)
+#   total      client event -> paint
+# The bridge counts websocket messages per connection and the page counts
+# its sends, so a client sample names message n and the two halves join
+# exactly. Histograms use fixed log-spaced buckets (25% wide), so memory
+# per session is constant.
+_LAT_STAGES = ("input", "bridge_in", "vnc", "bridge_out", "network", "paint", "total")
+_LAT_BOUNDS = [0.05 * 1.25 ** i for i in range(60)]   # ms, 0.05 ms .. ~26 s
+_latency = OrderedDict()   # session id -> {"hist": {stage: counts}, "conn": OrderedDict n -> server times}
+_latency_lock = threading.Lock()
+
+def _lat_session(sid):
+    with _latency_lock:
+        s = _latency.get(sid)
+        if s is None:
+            s = _latency[sid] = {"hist":{k: [0] * (len(_LAT_BOUNDS) + 1) for k in _LAT_STAGES},
+                                 "conn":OrderedDict()}
+            while len(_latency) > LATENCY_SESSIONS: _latency.popitem(last=False)
+        _latency.move_to_end(sid)
+        return s
+
+def _lat_add(s, stage, ms):
+    if ms >= 0: s["hist"][stage][bisect.bisect_left(_LAT_BOUNDS, ms)] += 1
+
+def _lat_bridge(s, n, t_in, t_sent, t_vnc, t_out):
+    """Bridge side of one input message: all times monotonic seconds."""
+    _lat_add(s, "bridge_in", (t_sent - t_in) * 1000)
+    _lat_add(s, "vnc", (t_vnc - t_sent) * 1000)
+    _lat_add(s, "bridge_out", (t_out - t_vnc) * 1000)
+    conn = s["conn"]
+    conn[n] = t_out - t_in
+    while len(conn) > 512: conn.popitem(last=False)
+
+def _lat_client(s, sample):
+    """Browser side: {"n", "input", "rtt", "paint"} in ms."""
+    try:
+        n, inp, rtt, paint = int(sample["n"]), float(sample["input"]), float(sample["rtt"]), float(sample["paint"])
+    except (KeyError, TypeError, ValueError): return
+    if not all(0 <= v < 60_000 for v in (inp, rtt, paint)): return
+    _lat_add(s, "input", inp); _lat_add(s, "paint", paint)
+    _lat_add(s, "total", inp + rtt + paint)
+    span = s["conn"].get(n)
+    if span is not None: _lat_add(s, "network", rtt - span * 1000)
+
+def _lat_view(s):
+    out = {}
+    for stage, counts in s["hist"].items():
+        total = sum(counts)
+        if not total: continue
+        def pct(q):
+            need, acc = q * total, 0
+            for i, c in enumerate(counts):
+                acc += c
+                if acc >= need: return round(_LAT_BOUNDS[min(i, len(_LAT_BOUNDS) - 1)], 2)
+        out[stage] = {"count":total, "p50":pct(0.50), "p95":pct(0.95), "p99":pct(0.99)}
+    return out
+
+# ═══════════════════════════════════════════════════════════
+# VIDEO STREAM
+# ═══════════════════════════════════════════════════════════
+# RFB sends changed rectangles, which is the wrong tool for video, canvas
+# animation and smooth scrolling: x11vnc pegs a core and the frame rate
+# drops. In video mode ffmpeg captures the display (x11grab) and encodes it
+# on the CPU with no B-frames and no lookahead. The frames go over /ws/video
+# to a WebCodecs decoder in APP_HTML. Input travels the other way as small
+# JSON messages, which the server replays to x11vnc as RFB pointer and key
+# events on a connection that never asks for screen updates.
+#
+# A monitor hashes every 4th framebuffer row four times a second. When at
+# least VIDEO_ON_PCT of the rows change in 3 of every 4 samples over 3 s,
+# it recommends video. After 5 s below VIDEO_OFF_PCT it recommends RFB
+# again. Sessions follow the recommendation unless they chose a mode.
+VIDEO_CODECS = {
+    "h264":{"codec":"avc1.42E033", "args":["-c:v","libx264","-preset","ultrafast","-tune","zerolatency",
+            "-profile:v","baseline","-pix_fmt","yuv420p","-bf","0","-x264-params","aud=1:repeat-headers=1",
+            "-avioflags","direct","-f","h264"]},
+    "vp8": {"codec":"vp8", "args":["-c:v","libvpx","-deadline","realtime","-cpu-used","8","-lag-in-frames","0",
+            "-error-resilient","1","-f","ivf"]},
+}
+_VIDEO_PREFS = ("auto", "rfb", "video")
+_video_state = {"mode":"rfb", "change_pct":0.0}
+_video_viewers = {}   # thread ident -> {"sid", "codec", "frames", "bytes", "since"}
+_video_started = False
+
+def _video_available():
+    return VIDEO_MODE != "off" and shutil.which("ffmpeg") is not None
+
+def _video_cmd(codec, w, h):
+    rate = str(VIDEO_BITRATE)
+    return _placement_prefix() + ["ffmpeg", "-hide_banner", "-loglevel", "error", "-nostdin",
+        "-fflags", "nobuffer", "-probesize", "32", "-analyzeduration", "0",
+        "-f", "x11grab", "-framerate", str(VIDEO_FPS), "-video_size", f"{w}x{h}", "-i", XVFB_DISPLAY,
+        "-g", str(VIDEO_FPS * 2), "-b:v", rate, "-maxrate", rate, "-bufsize", rate,
+        *VIDEO_CODECS[codec]["args"], "-flush_packets", "1", "pipe:1"]
+
+_H264_AUD = re.compile(b"\x00\x00\x00\x01\x09")   # access unit delimiter, emitted with aud=1
+
+def _h264_frames(f):
+    """Access units from x264's Annex B output on a pipe (see _h264_split)."""
+    fd = f.fileno()
+    return _h264_split(iter(lambda: os.read(fd, 1 << 20), b""))
+
+def _h264_split(chunks):
+    """(key, access unit) from Annex B bytes arriving in arbitrary pieces.
+
+    A pipe read can stop part-way through a frame (a large key frame is
+    copied a page at a time) or hold several frames when the reader falls
+    behind, so bytes carry over between reads and are cut only at access
+    unit delimiters. The last unit is held until the next delimiter (or the
+    end of the stream) shows it is complete."""
+    buf, scan = b"", 1
+    for chunk in chunks:
+        buf += chunk
+        start = 0
+        for m in _H264_AUD.finditer(buf, scan):
+            au, start = buf[start:m.start()], m.start()
+            yield _h264_key(au), au
+        buf = buf[start:]
+        scan = max(1, len(buf) - 4)   # a delimiter may straddle two reads
+    if buf: yield _h264_key(buf), buf
+
+def _h264_key(au):
+    """Whether an access unit holds an IDR slice (NAL type 5)."""
+    return any(m.group(1)[0] & 0x1f == 5 for m in re.finditer(b"\x00\x00\x01(.)", au, re.S))
+
+def _ivf_frames(f):
+    """VP8 frames from an IVF stream: 32-byte file header, then a 12-byte
+    header (size, pts) per frame."""
+    if len(f.read(32)) < 32: return
+    while True:
+        hdr = f.read(12)
+        if len(hdr) < 12: return
+        data = f.read(struct.unpack("<I", hdr[:4])[0])
+        if not data: return
+        yield not data[0] & 1, data   # VP8 frame tag: bit 0 clear = key frame
+
+def _rfb_input():
+    """RFB connection to x11vnc for input only: handshake, then never request
+    updates, so x11vnc does no encoding for it."""
+    s = socket.create_connection(("127.0.0.1", VNC_PORT), timeout=5)
+    s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    def need(n):
+        b = b""
+        while len(b) < n:
+            c = s.recv(n - len(b))
+            if not c: raise ConnectionError("x11vnc closed during handshake")
+            b += c
+        return b
+    need(12); s.sendall(b"RFB 003.008\n")
+    types = need(need(1)[0])
+    if 1 not in types: raise ConnectionError("x11vnc wants authentication")
+    s.sendall(b"\x01")
+    if need(4) != b"\0\0\0\0": raise ConnectionError("x11vnc refused the connection")
+    s.sendall(b"\x01")   # shared
+    name_len = struct.unpack(">I", need(24)[20:24])[0]; need(name_len)
+    s.settimeout(None)
+    return s
+
+def _fb_rows(prev):
+    """(% of sampled rows changed since `prev`, new row hashes)."""
+    fb = _fb_open()
+    if not fb: return None, prev
+    _, mm, hdr = fb
+    bpl, rows, off = hdr["bytes_per_line"], hdr["pixmap_height"], hdr["data_offset"]
+    if not rows or off + rows * bpl > len(mm): return None, prev
+    cur = [zlib.crc32(mm[off + y * bpl:off + (y + 1) * bpl]) for y in range(0, rows, 4)]
+    if len(prev) != len(cur): return 0.0, cur
+    return 100 * sum(a != b for a, b in zip(cur, prev)) / len(cur), cur
+
+def _start_video_monitor():
+    global _video_started
+    if _video_started or VIDEO_MODE == "off": return
+    _video_started = True
+    if VIDEO_MODE == "on": _video_state["mode"] = "video"; return
+    def _loop():
+        rows, recent = [], deque(maxlen=20)   # 5 s of samples
+        while True:
+            time.sleep(0.25)
+            if not (_open_bridges or _video_viewers): recent.clear(); continue
+            pct, rows = _fb_rows(rows)
+            if pct is None: continue
+            recent.append(pct)
+            _video_state["change_pct"] = round(sum(recent) / len(recent), 1)
+            window = list(recent)[-12:]   # 3 s
+            mode = _video_state["mode"]
+            if mode == "rfb" and len(window) == 12 and sum(p >= VIDEO_ON_PCT for p in window) >= 9: mode = "video"
+            elif mode == "video" and len(recent) == 20 and max(recent) < VIDEO_OFF_PCT: mode = "rfb"
+            if mode != _video_state["mode"]:
+                _video_state["mode"] = mode
+                _log(f"screen change {_video_state['change_pct']}% of rows — recommending {mode}", component="video")
+                _publish("video", _video_view())
+    threading.Thread(target=_loop, daemon=True, name="video-monitor").start()
+
+def _video_view():
+    return {"recommended":_video_state["mode"], "change_pct":_video_state["change_pct"],
+            "available":_video_available(), "codecs":list(VIDEO_CODECS), "fps":VIDEO_FPS,
+            "viewers":[dict(v, since=round(time.monotonic() - v["since"], 1)) for v in list(_video_viewers.values())]}
+
+# ═══════════════════════════════════════════════════════════
+# WEBRTC TRANSPORT
+# ═══════════════════════════════════════════════════════════
+# On /ws one lost TCP segment holds back everything behind it, input and
+# screen updates alike. Here each data channel is its own SCTP stream over
+# UDP, so a loss only delays the channel it happened on:
+#   "rfb"    ordered, reliable      the RFB stream both ways, as on /ws
+#   "keys"   ordered, reliable      key events and button presses/releases
+#   "input"  unordered, no resends  pointer moves; a lost one is superseded
+# Input messages start with a 4-byte sequence number shared by both input
+# channels. A move older than the newest pointer event already applied is
+# dropped, so a late move can't undo a press.
+#
+# noVNC doesn't know any of this: its entry page is served with RTC_SHIM,
+# which replaces window.WebSocket for the /ws URL and falls back to the
+# real one when the offer, ICE or the channel fails. Signalling is a single
+# POST of the complete offer; the answer carries all candidates.
+_rtc_loop = None
+_rtc_lock = threading.Lock()
+_rtc_peers = {}   # id(pc) -> {"sid", "since", "state", "c2s", "s2c", "moves", "stale"}
+
+def _rtc_available():
+    return WEBRTC and RTCPeerConnection is not None
+
+def _rtc_run(coro, timeout=20):
+    """Run `coro` on the aiortc event loop thread and wait for its result."""
+    global _rtc_loop
+    with _rtc_lock:
+        if _rtc_loop is None:
+            _rtc_loop = asyncio.new_event_loop()
+            threading.Thread(target=_rtc_loop.run_forever, daemon=True, name="webrtc").start()
+    return asyncio.run_coroutine_threadsafe(coro, _rtc_loop).result(timeout)
+
+async def _rtc_answer(offer, sid):
+    pc = RTCPeerConnection(RTCConfiguration(iceServers=[RTCIceServer(urls=u) for u in RTC_ICE]))
+    peer = _rtc_peers[id(pc)] = {"sid":sid, "since":time.monotonic(), "state":"new",
+                                 "c2s":0, "s2c":0, "moves":0, "stale":0}
+    vnc = {"writer":None, "seq":-1}
+    async def close(why):
+        if _rtc_peers.pop(id(pc), None) is None: return
+        if vnc["writer"]: vnc["writer"].close()
+        await pc.close()
+        _log(f"webrtc closed ({why}): {peer['s2c']} bytes down, {peer['moves']} moves, "
+             f"{peer['stale']} stale", component="webrtc", session=sid)
+    async def give_up():
+        await asyncio.sleep(RTC_CONNECT_TIMEOUT)
+        if pc.connectionState != "connected": await close("connect timeout")
+    @pc.on("connectionstatechange")
+    async def _state():
+        peer["state"] = pc.connectionState
+        if pc.connectionState in ("failed", "closed"): await close(pc.connectionState)
+    @pc.on("datachannel")
+    def _channel(ch):
+        if ch.label == "rfb": asyncio.ensure_future(_rtc_rfb(ch, vnc, peer, close))
+        elif ch.label in ("keys", "input"):
+            unreliable = ch.label == "input"
+            ch.on("message", lambda msg: _rtc_input(msg, unreliable, vnc, peer))
+    await pc.setRemoteDescription(RTCSessionDescription(sdp=offer["sdp"], type=offer["type"]))
+    await pc.setLocalDescription(await pc.createAnswer())   # returns once ICE gathering is done
+    asyncio.ensure_future(give_up())
+    return {"sdp":pc.localDescription.sdp, "type":pc.localDescription.type}
+
+async def _rtc_rfb(ch, vnc, peer, close):
+    """Pump bytes between the "rfb" channel and a new x11vnc connection,
+    pausing reads from x11vnc while the channel has 4 MB queued."""
+    try: reader, writer = await asyncio.open_connection("127.0.0.1", VNC_PORT)
+    except OSError as e:
+        _log(f"webrtc: VNC connect failed: {e}", "ERROR", "webrtc", peer["sid"])
+        await close("vnc unreachable"); return
+    writer.get_extra_info("socket").setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    vnc["writer"] = writer
+    def up(msg):
+        if isinstance(msg, str): return
+        writer.write(msg); peer["c2s"] += len(msg)
+    ch.on("message", up)
+    ch.on("close", lambda: asyncio.ensure_future(close("channel closed")))
+    drained = asyncio.Event()
+    ch.bufferedAmountLowThreshold = 1 << 20
+    ch.on("bufferedamountlow", drained.set)
+    try:
+        while True:
+            data = await reader.read(65536)
+            if not data: break
+            ch.send(data); peer["s2c"] += len(data)
+            while ch.bufferedAmount > 4 << 20:
+                drained.clear(); await drained.wait()
+    except (OSError, InvalidStateError): pass
+    await close("vnc closed")
+
+def _rtc_input(msg, unreliable, vnc, peer):
+    """One sequenced KeyEvent or PointerEvent from the "keys"/"input" channel."""
+    if isinstance(msg, str) or len(msg) < 5 or not vnc["writer"]: return
+    seq, ev = struct.unpack(">I", msg[:4])[0], msg[4:]
+    if ev[0] == 5 and len(ev) == 6:
+        if unreliable:
+            if seq < vnc["seq"]: peer["stale"] += 1; return
+            peer["moves"] += 1
+        vnc["seq"] = max(vnc["seq"], seq)
+    elif unreliable or ev[0] != 4 or len(ev) != 8: return
+    vnc["writer"].write(ev); peer["c2s"] += len(ev)
+
+def _rtc_view(sid=None):
+    now = time.monotonic()
+    return {"available":_rtc_available(), "ice_servers":RTC_ICE,
+            "peers":[dict(p, since=round(now - p["since"], 1)) for p in list(_rtc_peers.values())
+                     if sid is None or p["sid"] == sid]}
+
+# Inserted at the top of noVNC's entry page; see the section comment above.
+RTC_SHIM = r"""<script>
+(function(){
+  var WS=window.WebSocket,ICE=%s,failed=false;if(!window.RTCPeerConnection)return;
+  function RtcSocket(url,protocols){
+    if(failed||!/\/ws$/.test(url))return new WS(url,protocols);
+    var self=this,pc=this._pc=new RTCPeerConnection({iceServers:ICE}),timer=setTimeout(fallback,8000);
+    this.url=url;this.protocol='';this.extensions='';this.binaryType='arraybuffer';this._state=0;
+    this._seq=0;this._mask=-1;this._real=null;this._on={};
+    this.onopen=this.onmessage=this.onclose=this.onerror=null;
+    this._rfb=pc.createDataChannel('rfb');this._keys=pc.createDataChannel('keys');
+    this._input=pc.createDataChannel('input',{ordered:false,maxRetransmits:0});
+    [this._rfb,this._keys,this._input].forEach(function(c){c.binaryType='arraybuffer';});
+    this._rfb.onopen=function(){clearTimeout(timer);self._state=1;self._fire('open');};
+    this._rfb.onmessage=function(e){self._fire('message',{data:e.data});};
+    this._rfb.onclose=function(){if(self._real||self._state===3)return;var was=self._state;self._state=3;pc.close();
+      if(was===0)fallback();else self._fire('close',{code:1006,reason:'',wasClean:false});};
+    function fallback(){
+      if(self._real||self._state===3)return;clearTimeout(timer);failed=true;self._state=3;pc.close();
+      var ws=self._real=new WS(url,protocols);ws.binaryType='arraybuffer';
+      ['open','message','close','error'].forEach(function(t){ws.addEventListener(t,function(e){self._fire(t,e);});});}
+    pc.createOffer().then(function(o){return pc.setLocalDescription(o);}).then(function(){
+      return new Promise(function(ok){setTimeout(ok,2000);
+        if(pc.iceGatheringState==='complete')ok();
+        pc.addEventListener('icegatheringstatechange',function(){if(pc.iceGatheringState==='complete')ok();});});
+    }).then(function(){return fetch('/api/rtc',{method:'POST',credentials:'same-origin',headers:{'Content-Type':'application/json'},
+        body:JSON.stringify({sdp:pc.localDescription.sdp,type:pc.localDescription.type})});
+    }).then(function(r){if(!r.ok)throw new Error(r.status);return r.json();
+    }).then(function(a){return pc.setRemoteDescription(a);}).catch(fallback);}
+  RtcSocket.CONNECTING=0;RtcSocket.OPEN=1;RtcSocket.CLOSING=2;RtcSocket.CLOSED=3;
+  Object.defineProperty(RtcSocket.prototype,'readyState',{get:function(){return this._real?this._real.readyState:this._state;}});
+  Object.defineProperty(RtcSocket.prototype,'bufferedAmount',{get:function(){
+    return this._real?this._real.bufferedAmount:this._rfb.bufferedAmount;}});
+  RtcSocket.prototype._fire=function(t,e){var self=this;e=e||{type:t};if(this['on'+t])this['on'+t](e);
+    (this._on[t]||[]).forEach(function(f){f.call(self,e);});};
+  RtcSocket.prototype.addEventListener=function(t,f){(this._on[t]=this._on[t]||[]).push(f);};
+  RtcSocket.prototype.removeEventListener=function(t,f){this._on[t]=(this._on[t]||[]).filter(function(g){return g!==f;});};
+  RtcSocket.prototype.send=function(d){
+    if(this._real)return this._real.send(d);
+    var u=d instanceof ArrayBuffer?new Uint8Array(d):new Uint8Array(d.buffer,d.byteOffset,d.byteLength);
+    if(!(u.length===6&&u[0]===5||u.length===8&&u[0]===4))return this._rfb.send(u);
+    var m=new Uint8Array(u.length+4);new DataView(m.buffer).setUint32(0,++this._seq);m.set(u,4);
+    var move=u[0]===5&&u[1]===this._mask;if(u[0]===5)this._mask=u[1];
+    (move?this._input:this._keys).send(m);};
+  RtcSocket.prototype.close=function(){if(this._real)return this._real.close();if(this._state===3)return;
+    this._state=3;this._pc.close();this._fire('close',{code:1000,reason:'',wasClean:true});};
+  window.WebSocket=RtcSocket;
+})();
+</script>"""
+
+# ═══════════════════════════════════════════════════════════
+# BANDWIDTH SHAPING
+# ═══════════════════════════════════════════════════════════
+# Every /ws bridge has a token bucket filled at its share of the budget.
+# Every BW_REFRESH s the shares are recomputed by weighted max-min fair
+# splitting ("water-filling"): BW_USER among each user's connections,
+# then BW_HOST among all of them, each capped by BW_SESSION and by what
+# the connection is using. A connection that has had to wait counts as
+# wanting more. Bandwidth a light connection leaves unused goes to the
+# busy ones.
+#
+# Updates are paid for when they go out, and a bucket may go into debt.
+# RFB only sends an update in reply to a FramebufferUpdateRequest, so
+# while a connection is in debt its next request is held. Newer requests
+# are merged into it. x11vnc meanwhile gathers all damage and sends one
+# up-to-date update when the debt is paid. A throttled viewer sees fewer,
+# fresher frames instead of a growing queue of old ones. Input is never
+# held.
+_bw_cond = threading.Condition()
+_bw_conns = {}   # bridge thread ident -> state, see _bw_open
+_bw_started = False
+
+def _bw_on():
+    return bool(BW_SESSION or BW_USER or BW_HOST)
+
+def _waterfill(budget, caps, weights):
+    """Weighted max-min fair split of `budget` among `caps` keys: nobody gets
+    more than its cap, and whatever capped keys leave is shared out again."""
+    if budget == float("inf"): return dict(caps)
+    out, left = {}, dict(caps)
+    while left:
+        share = budget / sum(weights[k] for k in left)
+        done = {k: c for k, c in left.items() if c <= share * weights[k]}
+        if not done:
+            out.update((k, share * weights[k]) for k in left)
+            break
+        for k, c in done.items():
+            out[k] = c; budget -= c; del left[k]
+    return out
+
+def _bw_fill(c, now):
+    c["tokens"] = min(c["tokens"] + c["rate"] * (now - c["t"]), max(c["rate"] * 0.5, BW_MIN_BURST))
+    c["t"] = now
+
+def _bw_refresh(now):
+    """Measure each connection's rate over the last window and give out new
+    shares. Called with _bw_cond held."""
+    inf = float("inf")
+    caps, weights = {}, {}
+    for k, c in _bw_conns.items():
+        span = max(now - c["win_t"], 1e-3)
+        c["bps"] = c["bps"] * 0.5 + c["win_bytes"] / span * 0.5 if c["bps"] else c["win_bytes"] / span
+        want = inf if c["win_held"] or c["held"] else max(2 * c["bps"], BW_IDLE_FLOOR)
+        caps[k] = min(BW_SESSION or inf, want)
+        weights[k] = c["weight"]
+        c["win_t"], c["win_bytes"], c["win_held"] = now, 0, False
+    by_user = {}
+    for k, c in _bw_conns.items(): by_user.setdefault(c["user"], []).append(k)
+    for keys in by_user.values():
+        caps.update(_waterfill(BW_USER or inf, {k: caps[k] for k in keys}, weights))
+    for k, rate in _waterfill(BW_HOST or inf, caps, weights).items():
+        _bw_fill(_bw_conns[k], now)
+        _bw_conns[k]["rate"] = rate   # finite: at least one of the three limits is set
+
+def _bw_open(key, sid, user, send):
+    """Register a bridge; `send(msg)` forwards a released request to x11vnc."""
+    global _bw_started
+    now = time.monotonic()
+    with _bw_cond:
+        _bw_conns[key] = {"sid":sid, "user":user, "weight":BW_WEIGHTS.get(user, 1.0), "send":send,
+                          "rate":float(BW_IDLE_FLOOR), "tokens":float(BW_MIN_BURST), "t":now,
+                          "bps":0.0, "win_t":now, "win_bytes":0, "win_held":False,
+                          "held":None, "held_count":0, "merged":0, "bytes":0, "since":now}
+        _bw_refresh(now)
+        if not _bw_started:
+            _bw_started = True
+            threading.Thread(target=_bw_loop, daemon=True, name="shaper").start()
+        _bw_cond.notify()
+
+def _bw_close(key):
+    with _bw_cond: _bw_conns.pop(key, None)
+
+def _bw_sent(key, n):
+    """Charge `n` bytes that just went out to the viewer."""
+    with _bw_cond:
+        c = _bw_conns.get(key)
+        if c is None: return
+        _bw_fill(c, time.monotonic())
+        c["tokens"] -= n; c["win_bytes"] += n; c["bytes"] += n
+
+def _bw_request(key, msg):
+    """False if this FramebufferUpdateRequest has to wait; it's then held,
+    merged with any request already waiting (union of the two rectangles,
+    full rather than incremental if either asks for it)."""
+    with _bw_cond:
+        c = _bw_conns.get(key)
+        if c is None: return True
+        _bw_fill(c, time.monotonic())
+        if c["held"] is None and c["tokens"] >= 0: return True
+        c["win_held"] = True
+        if c["held"] is None:
+            c["held"] = msg; c["held_count"] += 1
+        else:
+            _, inc, x, y, w, h = struct.unpack(">BBHHHH", c["held"])
+            _, inc2, x2, y2, w2, h2 = struct.unpack(">BBHHHH", msg)
+            nx, ny = min(x, x2), min(y, y2)
+            c["held"] = struct.pack(">BBHHHH", 3, inc & inc2, nx, ny,
+                                    max(x + w, x2 + w2) - nx, max(y + h, y2 + h2) - ny)
+            c["merged"] += 1
+        _bw_cond.notify()
+        return False
+
+def _bw_loop():
+    """Recompute shares and release held requests once their debt is paid."""
+    next_refresh = 0.0
+    while True:
+        release = []
+        with _bw_cond:
+            now = time.monotonic()
+            if now >= next_refresh:
+                _bw_refresh(now); next_refresh = now + BW_REFRESH
+            wait = BW_REFRESH if _bw_conns else None
+            for c in _bw_conns.values():
+                if c["held"] is None: continue
+                _bw_fill(c, now)
+                if c["tokens"] >= 0:
+                    release.append((c["send"], c["held"])); c["held"] = None
+                else: wait = min(wait, -c["tokens"] / c["rate"])
+            if not release: _bw_cond.wait(wait)
+        for send, msg in release:
+            try: send(msg)
+            except OSError: pass
+
+def _bw_view(viewer=None):
+    """Limits and current rates; other users' names only for admins."""
+    admin = viewer in ADMIN_USERS
+    mbit = lambda b: round(b / 125_000, 3) if b else None
+    with _bw_cond:
+        conns = [{"session":c["sid"], "user":c["user"] if admin or c["user"] == viewer else None,
+                  "weight":c["weight"], "share_mbit":mbit(c["rate"]), "rate_mbit":mbit(c["bps"]) or 0.0,
+                  "bytes":c["bytes"], "waiting":c["held"] is not None, "held":c["held_count"],
+                  "merged":c["merged"], "since":round(time.monotonic() - c["since"], 1)}
+                 for c in _bw_conns.values()]
+    users = {}
+    for c in conns:
+        if c["user"]: users[c["user"]] = round(users.get(c["user"], 0) + c["rate_mbit"], 3)
+    return {"enabled":_bw_on(), "limits_mbit":{"session":mbit(BW_SESSION), "user":mbit(BW_USER), "host":mbit(BW_HOST)},
+            "weights":BW_WEIGHTS, "host_rate_mbit":round(sum(c["rate_mbit"] for c in conns), 3),
+            "users":users, "connections":conns}
+
+# ═══════════════════════════════════════════════════════════
+# METRICS HISTORY
+# ═══════════════════════════════════════════════════════════
+# Once a second the sampler records the stack (CPU, RSS and threads of
+# Xvfb + Chromium + x11vnc, the same for this server, resolution, viewers,
+# bridge bytes/s) and each session's bridge bytes/s. Every series is one
+# float32 array per field per level, used as a ring indexed by
+# time // step: no timestamps are stored, and a second the sampler missed
+# reads back as a gap. The 1 m and 1 h levels get the mean of the samples
+# in each step. Arrays are allocated once and an evicted session's are
+# reused, so the store never grows past _metrics_size().
+STACK_FIELDS = ("cpu_pct", "rss_mb", "threads", "server_cpu_pct", "server_rss_mb",
+                "width", "height", "viewers", "down_bps", "up_bps")
+SESSION_FIELDS = ("down_bps", "up_bps", "connections")
+_NAN = float("nan")
+
+class _Series:
+    """Fixed-memory multi-resolution time series, see above."""
+    def __init__(self, fields):
+        self.fields = fields
+        self.rings = [[array("f", [_NAN]) * slots for _ in fields] for _, _, slots in METRIC_LEVELS]
+        self.sums = [array("d", bytes(8 * len(fields))) for _ in METRIC_LEVELS]
+        self.reset()
+
+    def reset(self):
+        for cols in self.rings:
+            for col in cols:
+                for i in range(len(col)): col[i] = _NAN
+        self.last = [-1] * len(METRIC_LEVELS)    # newest bucket written, per level
+        self.open = [-1] * len(METRIC_LEVELS)    # bucket being averaged, per level
+        self.count = [0] * len(METRIC_LEVELS)
+
+    def _write(self, lvl, b, values):
+        cols, slots = self.rings[lvl], METRIC_LEVELS[lvl][2]
+        for g in range(max(self.last[lvl] + 1, b - slots + 1), b):   # buckets skipped since the last write
+            for col in cols: col[g % slots] = _NAN
+        for col, v in zip(cols, values): col[b % slots] = v
+        self.last[lvl] = max(self.last[lvl], b)
+
+    def add(self, t, values):
+        for lvl, (_, step, _) in enumerate(METRIC_LEVELS):
+            b = int(t // step)
+            if lvl == 0: self._write(0, b, values); continue
+            sums = self.sums[lvl]
+            if b != self.open[lvl]:
+                if self.count[lvl]:
+                    n = self.count[lvl]
+                    self._write(lvl, self.open[lvl], (s / n for s in sums))
+                for i in range(len(sums)): sums[i] = 0.0
+                self.open[lvl], self.count[lvl] = b, 0
+            for i, v in enumerate(values): sums[i] += v
+            self.count[lvl] += 1
+
+    def query(self, lvl, t0, t1, fields):
+        """Bucket start times and per-field values (None for gaps) in [t0, t1]."""
+        _, step, slots = METRIC_LEVELS[lvl]
+        cols = [self.rings[lvl][self.fields.index(f)] for f in fields]
+        t, out = [], [[] for _ in fields]
+        for b in range(max(int(t0 // step), self.last[lvl] - slots + 1, 0), min(int(t1 // step), self.last[lvl]) + 1):
+            vals = [col[b % slots] for col in cols]
+            if all(v != v for v in vals): continue
+            t.append(b * step)
+            for o, v in zip(out, vals): o.append(None if v != v else round(v, 3))
+        return t, dict(zip(fields, out))
+
+    def nbytes(self):
+        return sum(a.itemsize * len(a) for cols in self.rings for a in cols) + \
+               sum(a.itemsize * len(a) for a in self.sums)
+
+_metrics_lock = threading.Lock()
+_metrics_stack = _Series(STACK_FIELDS) if METRICS else None
+_metrics_sessions = OrderedDict()   # sid -> _Series, least recently active first
+_bridge_io = {}   # bridge thread ident -> [sid, bytes down, bytes up]; one writer per count
+_metrics_started = False
+
+def _proc_stats(pids, prev):
+    """(CPU seconds since the last call, RSS bytes, threads) over `pids`,
+    one /proc/<pid>/stat read each. `prev` holds each pid's CPU ticks; a
+    pid seen for the first time counts from now."""
+    cpu, rss, threads = 0, 0, 0
+    for p in pids:
+        try:
+            with open(f"/proc/{p}/stat", "rb") as f: st = f.read()
+            fields = st[st.rindex(b")") + 2:].split()
+            ticks = int(fields[11]) + int(fields[12])
+            cpu += ticks - prev.get(p, ticks); prev[p] = ticks
+            threads += int(fields[17]); rss += int(fields[21]) * _PAGE
+        except (OSError, ValueError, IndexError): pass
+    return cpu / _CLK_TCK, rss, threads
+
+def _start_metrics():
+    global _metrics_started
+    if _metrics_started or not METRICS: return
+    _metrics_started = True
+    def _loop():
+        pids, pids_at, cpu_prev, srv_prev, io_prev = [], 0.0, {}, {}, {}
+        t_prev = due = time.time()
+        while True:
+            due += 1
+            time.sleep(max(0.0, due - time.time()))
+            now = time.time()
+            if now - due > 5: due = now   # suspended or starved: don't replay the missed seconds
+            if time.monotonic() - pids_at > 10:   # Chromium's process tree changes slowly
+                pids, pids_at = _stack_pids(), time.monotonic()
+                for p in set(cpu_prev) - set(pids): del cpu_prev[p]
+            span, t_prev = max(now - t_prev, 1e-3), now
+            cpu, rss, threads = _proc_stats(pids, cpu_prev)
+            s_cpu, s_rss, _ = _proc_stats((os.getpid(),), srv_prev)
+            links = [(k, c[0], c[1], c[2]) for k, c in list(_bridge_io.items())] + \
+                    [(k, p["sid"], p["s2c"], p["c2s"]) for k, p in list(_rtc_peers.items())]
+            per_sid = {}
+            for k, sid, down, up in links:
+                d0, u0 = io_prev.get(k, (down, up))
+                a = per_sid.setdefault(sid, [0, 0, 0])
+                a[0] += down - d0; a[1] += up - u0; a[2] += 1
+            io_prev = {k: (down, up) for k, _, down, up in links}
+            down, up = sum(a[0] for a in per_sid.values()), sum(a[1] for a in per_sid.values())
+            with _metrics_lock:
+                _metrics_stack.add(now, (100 * cpu / span, rss / 1e6, threads, 100 * s_cpu / span, s_rss / 1e6,
+                                         CURRENT_W, CURRENT_H, len(links) + len(_video_viewers),
+                                         down / span, up / span))
+                for sid in per_sid:
+                    if sid in _metrics_sessions: _metrics_sessions.move_to_end(sid)
+                    elif len(_metrics_sessions) < METRICS_SESSIONS: _metrics_sessions[sid] = _Series(SESSION_FIELDS)
+                    else:
+                        _, series = _metrics_sessions.popitem(last=False)
+                        series.reset(); _metrics_sessions[sid] = series
+                for sid, series in _metrics_sessions.items():   # idle sessions record zeros
+                    a = per_sid.get(sid, (0, 0, 0))
+                    series.add(now, (a[0] / span, a[1] / span, a[2]))
+    threading.Thread(target=_loop, daemon=True, name="metrics").start()
+
+def _metrics_size():
+    """Bytes the store occupies once every session slot is in use."""
+    per_slot = lambda fields: sum(slots for _, _, slots in METRIC_LEVELS) * 4 * len(fields) \
+                              + len(METRIC_LEVELS) * 8 * len(fields)
+    return per_slot(STACK_FIELDS) + METRICS_SESSIONS * per_slot(SESSION_FIELDS)
+
+# ═══════════════════════════════════════════════════════════
+# CLUSTER (router / node agent)
+# ═══════════════════════════════════════════════════════════
+# Nodes POST a signed capacity report to the router every NODE_HEARTBEAT
+# seconds. The router places each new login on the least-loaded live node
+# (session slots first, then CPU, then free RAM) and pins it there: the
+# node id rides in the signed session cookie, so placement survives a
+# router restart. Router -> node requests carry the user and session id
+# instead of a node login, signed with NODE_SECRET together with the method,
+# path and a hash of the body; a node accepts each signature once.
+_nodes = {}          # node id -> last capacity report + "seen" (monotonic)
+_placements = {}     # session id -> {"node", "seen", "open"}
+_admit_line = OrderedDict()   # session id -> last poll, waiting for a free node slot
+_nodes_lock = threading.Lock()
+_open_bridges = {}   # node side: thread ident -> session id of each open /ws
+_ROUTER_DROP_HEADERS = {"connection","keep-alive","transfer-encoding","te","trailer","upgrade",
+                        "proxy-authenticate","proxy-authorization","set-cookie","content-length"}
+_ROUTER_PASS_HEADERS = {"content-type","content-length","content-range","accept","if-none-match",
+                        "if-modified-since","range","if-range","last-event-id"}
+_EMPTY_SHA256 = hashlib.sha256(b"").hexdigest()
+_seen_sigs = OrderedDict()   # node side: signature -> time, for the last 30 s
+
+def _node_sign(*parts):
+    return hmac.new(NODE_SECRET.encode(), "|".join(parts).encode(), hashlib.sha256).hexdigest()
+
+def _request_target():
+    """Decoded path plus raw query string, as both router and node sign it."""
+    q = request.query_string.decode("latin-1")
+    return request.path + ("?" + q if q else "")
+
+def _is_upload():
+    return request.method == "PUT" and request.path.startswith("/api/files/uploads/")
+
+def _spool(stream):
+    """(file, sha256 hex) of a body copied to a temporary file, in memory up to 1 MB."""
+    f, h = tempfile.SpooledTemporaryFile(1 << 20), hashlib.sha256()
+    for chunk in iter(lambda: stream.read(1 << 20), b""):
+        h.update(chunk); f.write(chunk)
+    f.seek(0)
+    return f, h.hexdigest()
+
+def _node_headers(method, target, digest=_EMPTY_SHA256):
+    """Router side: headers that stand for this session's login on a node for
+    one request only: method, path and body hash are all signed."""
+    ts, user, sid = str(time.time()), session.get("username", ""), session.get("sid", "")
+    return {"X-QS-Time":ts, "X-QS-User":user, "X-QS-Session":sid,
+            "X-QS-Signature":_node_sign(ts, method, target, user, sid, digest)}
+
+def _node_get(node, target):
+    """Router side: a node's JSON answer to a signed GET for this session, or None."""
+    u = urlparse(node["url"])
+    conn = http.client.HTTPConnection(u.hostname, u.port or 80, timeout=5)
+    try:
+        conn.request("GET", target, headers=_node_headers("GET", target))
+        r = conn.getresponse()
+        return json.loads(r.read()) if r.status == 200 else None
+    except (OSError, ValueError): return None
+    finally: conn.close()
+
+def _router_identity():
+    """Node side: (user, sid) from valid router headers, else None. An upload
+    chunk is spooled while it is hashed and handed back as request.stream."""
+    if MODE != "node" or not NODE_SECRET: return None
+    h = request.headers
+    ts, sig = h.get("X-QS-Time", ""), h.get("X-QS-Signature", "")
+    user, sid = h.get("X-QS-User", ""), h.get("X-QS-Session", "")
+    if not sig: return None
+    try:
+        now = time.time()
+        if abs(now - float(ts)) > 30: return None
+    except ValueError: return None
+    if _is_upload():
+        request.max_content_length = UPLOAD_CHUNK_MAX
+        request.stream, digest = _spool(request.stream)
+    else: digest = hashlib.sha256(request.get_data()).hexdigest()
+    if not hmac.compare_digest(sig, _node_sign(ts, request.method, _request_target(), user, sid, digest)):
+        return None
+    with _nodes_lock:
+        while _seen_sigs and next(iter(_seen_sigs.values())) < now - 30: _seen_sigs.popitem(last=False)
+        if sig in _seen_sigs: return None   # replayed
+        _seen_sigs[sig] = now
+    return user, sid
+
+def _node_capacity():
+    mem = _meminfo()
+    return {"id":NODE_ID, "url":NODE_URL, "slots":NODE_SLOTS,
+            "sessions":len(set(_open_bridges.values())), "stack_ok":STACK_OK,
+            "admit":_admit_reason() is None,
+            "cpu_cores":CPU_CORES, "cpu_load":round(os.getloadavg()[0] / CPU_CORES, 3),
+            "mem_free":mem.get("MemAvailable", 0), "mem_total":mem.get("MemTotal", 0)}
+
+def _start_node_agent():
+    def _loop():
+        failing = False
+        while True:
+            body = json.dumps(_node_capacity()).encode()
+            ts = str(time.time())
+            req = urllib.request.Request(ROUTER_URL + "/api/node/heartbeat", data=body, headers={
+                "Content-Type":"application/json", "X-QS-Time":ts,
+                "X-QS-Signature":_node_sign(ts, body.decode())})
+            try:
+                urllib.request.urlopen(req, timeout=5).close()
+                if failing: _log(f"reporting to router {ROUTER_URL} again", component="node")
+                failing = False
+            except OSError as e:
+                if not failing: _log(f"router {ROUTER_URL} unreachable: {e}", "WARN", "node")
+                failing = True
+            time.sleep(NODE_HEARTBEAT)
+    threading.Thread(target=_loop, daemon=True, name="node-agent").start()
+
+def _live_nodes():
+    cutoff = time.monotonic() - 3 * NODE_HEARTBEAT
+    return {k: n for k, n in _nodes.items() if n["seen"] >= cutoff}
+
+def _node_load(nid, node):
+    placed = sum(1 for p in _placements.values() if p["node"] == nid)
+    return max(placed, node.get("sessions", 0))
+
+def _node_for_session():
+    """Router side: the node pinned to this session, placing it first if
+    it has none or its node died. None when every node is full or down."""
+    sid = session.get("sid")
+    now = time.monotonic()
+    with _nodes_lock:
+        for k in [k for k, p in _placements.items() if not p["open"] and now - p["seen"] > PLACEMENT_IDLE]:
+            del _placements[k]
+        live = _live_nodes()
+        nid = session.get("node") or _placements.get(sid, {}).get("node")
+        if nid not in live:
+            free = [(_node_load(k, n) / max(1, n["slots"]), n["cpu_load"], -n["mem_free"], k)
+                    for k, n in live.items()
+                    if n.get("stack_ok") and n.get("admit", True) and _node_load(k, n) < n["slots"]]
+            # First come, first served: a session is placed only once the
+            # slots free right now reach its place in the line.
+            for k in [k for k, t in _admit_line.items() if now - t > 6 * NODE_HEARTBEAT]:
+                del _admit_line[k]
+            if sid not in _admit_line and len(_admit_line) >= ADMIT_QUEUE: return None
+            _admit_line[sid] = now
+            slots = sum(live[k]["slots"] - _node_load(k, live[k]) for *_, k in free)
+            if list(_admit_line).index(sid) >= slots: return None
+            del _admit_line[sid]
+            if nid: _log(f"node {nid} gone, moving session", "WARN", "router", sid)
+            nid = min(free)[3]
+            session["node"] = nid
+            _log(f"placed on node {nid}", component="router", session=sid)
+        p = _placements.setdefault(sid, {"node":nid, "seen":now, "open":0})
+        p.update(node=nid, seen=now)
+        return live[nid]
+
+def _line_position(sid):
+    """1-based place of a session waiting for a node, or None."""
+    with _nodes_lock:
+        return list(_admit_line).index(sid) + 1 if sid in _admit_line else None
+
+def _no_node():
+    pos = _line_position(session.get("sid"))
+    resp = jsonify({"error":"No node has a free session slot" if pos else "Too many sessions waiting",
+                    "position":pos, "waiting":len(_admit_line)})
+    resp.status_code = 503; resp.headers["Retry-After"] = str(NODE_HEARTBEAT)
+    return resp
+
+def _proxy_to_node():
+    """Router side before_request: forward /api/* and /novnc/* for logged-in
+    users to their node, streaming the response (SSE included)."""
+    p = request.path
+    if not (p.startswith("/novnc/") or p.startswith("/api/")): return None
+    if p.startswith(("/api/admin/", "/api/node", "/api/admission")) or not session.get("authenticated"): return None
+    node = _node_for_session()
+    if not node: return _no_node()
+    u = urlparse(node["url"])
+    conn = http.client.HTTPConnection(u.hostname, u.port or 80, timeout=60)
+    headers = {k: v for k, v in request.headers.items() if k.lower() in _ROUTER_PASS_HEADERS}
+    if _is_upload():
+        # Upload chunks can be far over MAX_BODY: spooled up to the node's own
+        # cap and hashed on the way, since the signature covers the body.
+        request.max_content_length = UPLOAD_CHUNK_MAX
+        data, digest = _spool(request.stream)
+    else:
+        data = request.get_data()
+        digest = hashlib.sha256(data).hexdigest()
+    headers.update(_node_headers(request.method, _request_target(), digest))
+    q = request.query_string.decode("latin-1")
+    try:
+        conn.request(request.method, quote(p) + ("?" + q if q else ""), body=data or None, headers=headers)
+        up = conn.getresponse()
+    except OSError as e:
+        conn.close()
+        _log(f"node {node['id']} request failed: {e}", "WARN", "router", session.get("sid"))
+        return jsonify({"error":"Node unreachable"}), 502
+    def body():
+        try:
+            while True:
+                chunk = up.read1(65536)
+                if not chunk: break
+                yield chunk
+        except OSError: pass
+        finally: conn.close()
+    out = Response(body(), status=up.status,
+                   headers=[(k, v) for k, v in up.getheaders() if k.lower() not in _ROUTER_DROP_HEADERS])
+    if up.getheader("Content-Length"): out.headers["Content-Length"] = up.getheader("Content-Length")
+    return out
+
+def _router_ws(ws, sid):
+    """Router side /ws: relay frames to the session's node, one thread per
+    direction, both blocking — no polling between the two sockets."""
+    import simple_websocket
+    node = _node_for_session()
+    if not node:
+        try: ws.close()
+        except Exception: pass
+        return
+    q = request.query_string.decode("latin-1")
+    url = node["url"].replace("http", "ws", 1) + quote(request.path) + ("?" + q if q else "")
+    try: up = simple_websocket.Client.connect(url, headers=_node_headers("GET", _request_target()))
+    except Exception as e:
+        _log(f"node {node['id']} /ws failed: {e}", "ERROR", "router", sid)
+        try: ws.close()
+        except Exception: pass
+        return
+    with _nodes_lock: _placements[sid]["open"] += 1
+    def downstream():
+        try:
+            while True:
+                m = up.receive()
+                if m is None: break
+                ws.send(m)
+        except Exception: pass
+        finally:
+            try: ws.close()
+            except Exception: pass
+    threading.Thread(target=downstream, daemon=True, name="router-ws").start()
+    try:
+        while True:
+            m = ws.receive()
+            if m is None: break
+            up.send(m)
+    except Exception: pass
+    finally:
+        try: up.close()
+        except Exception: pass
+        with _nodes_lock:
+            p = _placements.get(sid)
+            if p: p["open"] -= 1; p["seen"] = time.monotonic()
+
+# ═══════════════════════════════════════════════════════════
+# FILE WATCHING
+# ═══════════════════════════════════════════════════════════
+_IN_CREATE, _IN_DELETE, _IN_CLOSE_WRITE = 0x100, 0x200, 0x008
+_IN_MOVED_FROM, _IN_MOVED_TO = 0x040, 0x080
+_libc = None
+
+def _inotify_fd(directory):
+    """inotify descriptor watching `directory` for files appearing,
+    disappearing or finishing a write; None where inotify is unavailable."""
+    global _libc
+    try:
+        if _libc is None: _libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        fd = _libc.inotify_init1(0o2000000)  # IN_CLOEXEC
+        if fd < 0: return None
+        mask = _IN_CREATE | _IN_DELETE | _IN_CLOSE_WRITE | _IN_MOVED_FROM | _IN_MOVED_TO
+        if _libc.inotify_add_watch(fd, str(directory).encode(), mask) < 0:
+            os.close(fd); return None
+        return fd
+    except (OSError, AttributeError):
+        return None
+
+def _watch_dir(directory, callback, name="watcher", poll=2.0):
+    """Call callback(filename) from a daemon thread whenever a file in
+    `directory` changes. Uses inotify; falls back to comparing stat()
+    signatures every `poll` seconds, which still never re-reads contents."""
+    directory = Path(directory)
+    def _inotify_loop(fd):
+        while True:
+            try: buf = os.read(fd, 65536)
+            except OSError: time.sleep(poll); continue
+            i, seen = 0, set()
+            while i + 16 <= len(buf):
+                _, _, _, n = struct.unpack_from("iIII", buf, i)
+                fname = buf[i + 16:i + 16 + n].split(b"\0", 1)[0].decode(errors="replace")
+                i += 16 + n
+                if fname and fname not in seen:
+                    seen.add(fname)
+                    try: callback(fname)
+                    except Exception as e: _log(f"{name}: {e}", "WARN", "watch")
+    def _poll_loop():
+        def sig():
+            out = {}
+            try:
+                for e in os.scandir(directory):
+                    try: st = e.stat(); out[e.name] = (st.st_ino, st.st_size, st.st_mtime_ns)
+                    except OSError: pass
+            except OSError: pass
+            return out
+        last = sig()
+        while True:
+            time.sleep(poll)
+            cur = sig()
+            for fname in set(last) | set(cur):
+                if last.get(fname) != cur.get(fname):
+                    try: callback(fname)
+                    except Exception as e: _log(f"{name}: {e}", "WARN", "watch")
+            last = cur
+    fd = _inotify_fd(directory)
+    if fd is not None: threading.Thread(target=_inotify_loop, args=(fd,), daemon=True, name=name).start()
+    else: threading.Thread(target=_poll_loop, daemon=True, name=name).start()
+    return fd is not None
 
 # ═══════════════════════════════════════════════════════════
 # AUTH
 # ═══════════════════════════════════════════════════════════
 def _hash(pw): return hashlib.sha256(pw.encode()).hexdigest()
-def _load_auth():
-    global _auth_cache, _auth_cache_ts
-    if time.monotonic() - _auth_cache_ts < 30: return
-    c = {}
-    if AUTH_FILE.exists():
-        for line in AUTH_FILE.read_text().splitlines():
-            if ":" in line:
-                u, p = line.strip().split(":", 1)
-                c[u.strip()] = p.strip()
-    _auth_cache, _auth_cache_ts = c, time.monotonic()
 
-def check_auth(u, p):
+# auth.txt lines are "user:secret" where secret is one of
+#   scrypt$N$r$p$<salt b64>$<key b64>   (memory-hard, preferred)
+#   <64 hex chars>                       (legacy unsalted SHA-256)
+#   anything else                        (plaintext)
+# The file is parsed once into _auth_users and re-parsed only when the
+# file watcher reports a change.
+_auth_users = {}
+_auth_loaded = False
+_auth_reload_lock = threading.Lock()
+_SCRYPT_DEFAULT = (1 << 14, 8, 1)   # N, r, p -> 16 MiB per verification
+_DUMMY_SCRYPT = None
+
+def _scrypt_hash(pw, n=_SCRYPT_DEFAULT[0], r=_SCRYPT_DEFAULT[1], p=_SCRYPT_DEFAULT[2]):
+    salt = secrets.token_bytes(16)
+    key = hashlib.scrypt(pw.encode(), salt=salt, n=n, r=r, p=p, maxmem=256 * 1024 * 1024, dklen=32)
+    return "scrypt${}${}${}${}${}".format(n, r, p, base64.b64encode(salt).decode(), base64.b64encode(key).decode())
+
+def _reload_auth():
+    global _auth_users, _auth_loaded
+    with _auth_reload_lock:
+        t0 = time.monotonic()
+        c = {}
+        try:
+            with open(AUTH_FILE) as f:
+                for line in f:
+                    if ":" in line:
+                        u, p = line.strip().split(":", 1)
+                        c[u.strip()] = p.strip()
+        except FileNotFoundError: c = None
+        except OSError as e:
+            _log(f"auth.txt unreadable, keeping previous users: {e}", "WARN", "auth"); return
+        _auth_users, _auth_loaded = c, True
+        if c is not None:
+            _log(f"auth.txt loaded: {len(c)} users ({(time.monotonic()-t0)*1000:.1f}ms)", component="auth")
+
+def _start_auth_watcher():
+    _reload_auth()
+    _auth_pool.submit(_dummy_scrypt)
+    _watch_dir(AUTH_FILE.parent, lambda name: name == AUTH_FILE.name and _reload_auth(), "auth-watch")
+
+def _dummy_scrypt():
+    """A scrypt entry no password matches. Built on the pool: warmed at
+    startup, or by the first verification that needs it."""
+    global _DUMMY_SCRYPT
+    if _DUMMY_SCRYPT is None: _DUMMY_SCRYPT = _scrypt_hash(secrets.token_hex(8))
+    return _DUMMY_SCRYPT
+
+def _verify_secret(stored, p):
+    """Compare a password against one stored secret (None for an unknown
+    user). Runs on the pool. Unknown users and legacy entries pay for one
+    scrypt as well, so timing reveals neither which users exist nor how
+    they are stored."""
+    if stored is None or not stored.startswith("scrypt$"):
+        _verify_secret(_dummy_scrypt(), p)
+        if stored is None: return False
+    else:
+        try:
+            _, n, r, par, salt, key = stored.split("$")
+            n, r, par = int(n), int(r), int(par)
+            want = base64.b64decode(key)
+            got = hashlib.scrypt(p.encode(), salt=base64.b64decode(salt), n=n, r=r, p=par,
+                                 maxmem=256 * 1024 * 1024, dklen=len(want))
+            return hmac.compare_digest(got, want)
+        except (ValueError, TypeError) as e:
+            _log(f"Bad scrypt entry in auth.txt: {e}", "WARN", "auth"); return False
+    return hmac.compare_digest(stored, _hash(p)) or hmac.compare_digest(stored, p)
+
+# Verification runs on a small worker pool so a login burst costs at most
+# AUTH_WORKERS cores; hashlib.scrypt releases the GIL, so the /ws bridge
+# threads keep running. Beyond AUTH_WORKERS + AUTH_QUEUE outstanding
+# checks, logins are refused with 503 instead of queueing without bound.
+_auth_pool = ThreadPoolExecutor(max_workers=AUTH_WORKERS, thread_name_prefix="auth")
+_auth_slots = threading.BoundedSemaphore(AUTH_WORKERS + AUTH_QUEUE)
+_auth_ok_cache = OrderedDict()   # user -> (stored secret, HMAC of password, expiry)
+_auth_ok_lock = threading.Lock()
+
+def _auth_mac(p): return hmac.new(SECRET_KEY.encode(), p.encode(), hashlib.sha256).digest()
+
+def _verify_login(u, p):
+    """True/False, or None when the verification queue is full."""
     if not u or not p: return False
     u, p = u.strip()[:64], p.strip()[:128]
-    if not AUTH_FILE.exists():
+    if not _auth_loaded: _reload_auth()
+    users = _auth_users
+    if users is None:
         return hmac.compare_digest(u,"admin") and hmac.compare_digest(p,"admin")
-    _load_auth()
-    s = _auth_cache.get(u)
-    if not s: hmac.compare_digest(p,"x"); return False
-    return hmac.compare_digest(s, _hash(p)) or hmac.compare_digest(s, p)
+    stored = users.get(u)
+    if stored:
+        with _auth_ok_lock: hit = _auth_ok_cache.get(u)
+        # Only a match short-circuits; a miss still pays the full KDF cost.
+        if hit and hit[0] == stored and hit[2] > time.monotonic() \
+                and hmac.compare_digest(hit[1], _auth_mac(p)):
+            return True
+    if not _auth_slots.acquire(blocking=False): return None
+    try:
+        fut = _auth_pool.submit(_verify_secret, stored or None, p)
+    except RuntimeError:
+        _auth_slots.release(); return None
+    fut.add_done_callback(lambda _: _auth_slots.release())
+    ok = fut.result() and bool(stored)
+    if ok:
+        with _auth_ok_lock:
+            _auth_ok_cache[u] = (stored, _auth_mac(p), time.monotonic() + AUTH_CACHE_TTL)
+            _auth_ok_cache.move_to_end(u)
+            while len(_auth_ok_cache) > 4096: _auth_ok_cache.popitem(last=False)
+    return ok
+
+def check_auth(u, p):
+    return bool(_verify_login(u, p))
 
 def _real_ip(): return request.remote_addr or "0.0.0.0"
-def _rate_limited(ip):
+
+# Login rate limiting: token buckets keyed by client IP and by username,
+# held in sharded LRU maps with a fixed total capacity. A burst of
+# MAX_ATTEMPTS failures empties an IP bucket, which refills over
+# ATTEMPT_WINDOW seconds. The username bucket only applies to IPs that
+# have failed themselves, so guessing from many addresses can't lock the
+# account's owner out. Memory stays bounded under many source addresses
+# because the least recently failing keys are evicted first.
+_rate_shards = [(threading.Lock(), OrderedDict()) for _ in range(RATE_SHARDS)]
+
+def _bucket(key, burst, window, cost):
+    """Refill the bucket for `key`, subtract `cost`, return tokens left.
+    A peek (cost 0) never inserts; a bucket that has refilled completely is
+    dropped, since a missing entry means the same thing."""
+    lock, buckets = _rate_shards[hash(key) % RATE_SHARDS]
     now = time.monotonic()
-    with _attempts_lock:
-        a = [t for t in _login_attempts.get(ip,[]) if now - t < ATTEMPT_WINDOW]
-        _login_attempts[ip] = a
-        return len(a) >= MAX_ATTEMPTS
-def _record(ip):
-    with _attempts_lock: _login_attempts.setdefault(ip,[]).append(time.monotonic())
+    with lock:
+        b = buckets.get(key)
+        tokens = burst if b is None else min(burst, b[0] + (now - b[1]) * burst / window)
+        if not cost:
+            if b is not None and tokens >= burst: del buckets[key]
+            return tokens
+        tokens -= cost
+        buckets[key] = (tokens, now)
+        buckets.move_to_end(key)
+        if len(buckets) > RATE_CAPACITY // RATE_SHARDS: buckets.popitem(last=False)
+        return tokens
+
+def _rate_limited(ip, user=None):
+    """Seconds until this IP (and username) may try again; 0 if it may now."""
+    ip_left = _bucket("i:" + ip, MAX_ATTEMPTS, ATTEMPT_WINDOW, 0)
+    if ip_left < 1: return (1 - ip_left) * ATTEMPT_WINDOW / MAX_ATTEMPTS
+    if not user or ip_left >= MAX_ATTEMPTS: return 0   # no failures from this IP
+    user_left = _bucket("u:" + user, USER_MAX_ATTEMPTS, ATTEMPT_WINDOW, 0)
+    return (1 - user_left) * ATTEMPT_WINDOW / USER_MAX_ATTEMPTS if user_left < 1 else 0
+
+def _record(ip, user=None):
+    _bucket("i:" + ip, MAX_ATTEMPTS, ATTEMPT_WINDOW, 1)
+    if user: _bucket("u:" + user, USER_MAX_ATTEMPTS, ATTEMPT_WINDOW, 1)
+
+def _rate_tracked():
+    return sum(len(b) for _, b in _rate_shards)
+
 def _get_client_host():
     try: return urlparse(request.base_url).hostname or "127.0.0.1"
     except: return (request.host or "127.0.0.1").split(":")[0]
@@ -812,6 +3753,31 @@ def login_required(fn):
         return fn(*a, **kw)
     return w
 
+def admin_required(fn):
+    @wraps(fn)
+    @login_required
+    def w(*a, **kw):
+        if session.get("username") not in ADMIN_USERS: return jsonify({"error":"Forbidden"}), 403
+        return fn(*a, **kw)
+    return w
+
+def _accept_router():
+    """Node side: a request the router signed counts as that user's login."""
+    ident = _router_identity()
+    global _profile_owner
+    if ident:
+        session.update(authenticated=True, username=ident[0], sid=ident[1])
+        _profile_owner = ident[0]
+app.before_request(_accept_router)
+
+def _tag_thread():
+    if session.get("sid"): _thread_sessions[threading.get_ident()] = session["sid"]
+def _untag_thread(_exc=None):
+    _thread_sessions.pop(threading.get_ident(), None)
+app.before_request(_tag_thread)
+app.teardown_request(_untag_thread)
+if MODE == "router": app.before_request(_proxy_to_node)
+
 LOGIN_HTML = r"""<!DOCTYPE html>
 <html lang="en"><head><meta charset="UTF-8">
 <meta name="viewport" content="width=device-width,initial-scale=1">
@@ -852,6 +3818,32 @@ input:focus{border-color:var(--acc)}
   </div>
 </div></body></html>"""
 
+WAIT_HTML = r"""<!DOCTYPE html>
+<html lang="en"><head><meta charset="UTF-8">
+<meta name="viewport" content="width=device-width,initial-scale=1">
+<title>QuantumSurf — Waiting</title>
+<style>
+body{background:#0a0e14;font-family:'Courier New',monospace;min-height:100vh;display:flex;align-items:center;justify-content:center;margin:0}
+.card{background:#111820;border:1px solid #00e88f;padding:44px 36px;width:min(420px,92vw);text-align:center;color:#d0ffe8}
+.logo{font-size:24px;font-weight:900;color:#00e88f;letter-spacing:4px;margin-bottom:18px}
+#pos{font-size:40px;color:#00e88f;margin:12px 0}.sub{color:#3a6a50;font-size:11px;letter-spacing:1px}
+a{color:#00cfff;font-size:11px}
+</style></head><body><div class="card">
+<div class="logo">QUANTUMSURF</div>
+<div class="sub">ALL BROWSERS ARE BUSY — YOU ARE IN LINE</div>
+<div id="pos">{{ '#' ~ position if position else 'FULL' }}</div>
+<div class="sub" id="msg">{{ 'This page opens your browser as soon as one is free.' if position else 'The waiting line is full. Retrying…' }}</div>
+<p><a href="/logout">logout</a></p></div>
+<script>
+(function(){var wait={{ retry }}*1000;
+  function poll(){fetch('/api/admission',{credentials:'same-origin'}).then(function(r){return r.json()})
+    .then(function(d){if(d.admitted){location.reload();return;}
+      document.getElementById('pos').textContent=d.position?'#'+d.position:'FULL';
+      document.getElementById('msg').textContent=d.position?(d.waiting+' waiting. This page opens your browser as soon as one is free.'):'The waiting line is full. Retrying…';
+      setTimeout(poll,(d.retry_after||5)*1000);}).catch(function(){setTimeout(poll,wait);});}
+  setTimeout(poll,wait);})();
+</script></body></html>"""
+
 APP_HTML = r"""<!DOCTYPE html>
 <html lang="en"><head><meta charset="UTF-8">
 <meta name="viewport" content="width=device-width,initial-scale=1">
@@ -860,6 +3852,7 @@ APP_HTML = r"""<!DOCTYPE html>
 *{margin:0;padding:0;box-sizing:border-box}
 html,body{width:100%;height:100%;overflow:hidden;background:#000;font-family:'Courier New',monospace}
 #frame{position:fixed;top:0;left:0;width:100%;height:100%;border:none;display:block;background:#000}
+#video{position:fixed;top:0;left:0;width:100%;height:100%;display:none;background:#000;object-fit:contain;outline:none;cursor:default}
 .ctrl{position:fixed;z-index:9999;opacity:0;transition:opacity .4s;pointer-events:none}
 .ctrl.show{opacity:1;pointer-events:auto}
 #logout-btn{top:6px;right:6px;background:rgba(13,17,23,.9);border:1px solid #ff4455;color:#ff4455;font-size:10px;letter-spacing:1px;padding:4px 10px;cursor:pointer;font-family:inherit}
@@ -887,6 +3880,7 @@ html,body{width:100%;height:100%;overflow:hidden;background:#000;font-family:'Co
 #settings .stack-log{background:#080c10;border:1px solid #1a2a1e;padding:8px;margin-top:8px;font-size:9px;line-height:1.6;max-height:150px;overflow-y:auto;color:#3a6a50;white-space:pre-wrap;word-break:break-all}
 #settings .stack-log .err{color:#ff4455}
 #settings .stack-log .ok{color:#00e88f}
+#settings .stack-log a{color:#00e88f;text-decoration:none}
 #status-msg{position:fixed;bottom:8px;left:50%;transform:translateX(-50%);z-index:9999;background:rgba(13,17,23,.9);border:1px solid #1a2a1e;color:#3a6a50;font-size:10px;padding:4px 14px;opacity:0;transition:opacity .4s;pointer-events:none;font-family:inherit}
 #status-msg.show{opacity:1}
 #fallback{display:none;position:fixed;inset:0;background:#0a0e14;flex-direction:column;align-items:center;justify-content:center;gap:12px;color:#3a6a50;font-size:12px;text-align:center;padding:20px;z-index:9998}
@@ -898,6 +3892,7 @@ html,body{width:100%;height:100%;overflow:hidden;background:#000;font-family:'Co
 #fallback .log{background:#080c10;border:1px solid #1a2a1e;padding:10px;font-size:9px;max-width:500px;max-height:200px;overflow-y:auto;text-align:left;line-height:1.6;white-space:pre-wrap;word-break:break-all;color:#3a6a50}
 </style></head><body>
 <iframe id="frame" src="{{ novnc_url }}" allow="clipboard-read; clipboard-write; fullscreen"></iframe>
+<canvas id="video" tabindex="0"></canvas>
 <button id="settings-btn" class="ctrl" onclick="toggleSettings()">⚙ RES</button>
 <button id="logout-btn" class="ctrl" onclick="if(confirm('Logout?'))location.href='/logout'">⏻ EXIT</button>
 <div id="settings">
@@ -910,6 +3905,19 @@ html,body{width:100%;height:100%;overflow:hidden;background:#000;font-family:'Co
     <div><input type="number" id="res-h" min="600" max="2160" placeholder="Height"></div>
   </div>
   <button onclick="applyManual()">▶ APPLY RESOLUTION</button>
+  <label>Colour Depth</label>
+  <div class="presets">
+    <button onclick="applyDepth(24)">24-bit</button>
+    <button onclick="applyDepth(16)">16-bit</button>
+    <button onclick="applyDepth(8)">8-bit</button>
+  </div>
+  <label>Stream Mode</label>
+  <div class="presets">
+    <button onclick="setVideoPref('auto')">Auto</button>
+    <button onclick="setVideoPref('rfb')">RFB</button>
+    <button onclick="setVideoPref('video')">Video</button>
+  </div>
+  <div class="info" id="video-info"></div>
   <label>Presets</label>
   <div class="presets">
     <button onclick="applyPreset(1920,1080)">1080p</button>
@@ -917,6 +3925,10 @@ html,body{width:100%;height:100%;overflow:hidden;background:#000;font-family:'Co
     <button onclick="applyPreset(2560,1440)">1440p</button>
     <button onclick="applyPreset(1280,720)">720p</button>
   </div>
+  <label>Files</label>
+  <input type="file" id="up-file" multiple style="display:none" onchange="uploadFiles(this.files);this.value=''">
+  <button onclick="document.getElementById('up-file').click()">⇪ UPLOAD TO BROWSER</button>
+  <div class="stack-log" id="files">No files</div>
   <label>Stack Status</label>
   <button class="retry" onclick="retryStack()">⟳ RESTART STACK</button>
   <div class="stack-log" id="stack-log">Loading...</div>
@@ -949,20 +3961,57 @@ html,body{width:100%;height:100%;overflow:hidden;background:#000;font-family:'Co
     'Viewport: '+s.viewportW+'x'+s.viewportH+'<br>Available: '+s.availW+'x'+s.availH;}
   updateScreenInfo();
   function refreshCurRes(){fetch('/api/get_resolution',{credentials:'same-origin'}).then(function(r){return r.json()})
-    .then(function(d){document.getElementById('cur-res').textContent='Current: '+d.width+'x'+d.height;
+    .then(function(d){document.getElementById('cur-res').textContent='Current: '+d.width+'x'+d.height+' · '+d.depth+'-bit';
     document.getElementById('res-w').value=d.width;document.getElementById('res-h').value=d.height;}).catch(function(){});}
   refreshCurRes();
-  function refreshStackLog(){fetch('/api/stack_status',{credentials:'same-origin'}).then(function(r){return r.json()})
-    .then(function(d){var el=document.getElementById('stack-log'),html='';
-    d.log.forEach(function(line){var cls=line.indexOf('[ERROR]')>=0?'err':(line.indexOf('[WARN]')>=0?'':'ok');
-    html+='<span class="'+cls+'">'+line+'</span>\n';});el.innerHTML=html;el.scrollTop=el.scrollHeight;
-    var fl=document.getElementById('fallback-log');if(fl)fl.innerHTML=html;
-    var fm=document.getElementById('fallback-msg');
-    if(fm)fm.textContent=d.stack_ok?'Stack running. If blank, try retry.':'Stack NOT running. Click retry.';}).catch(function(){});}
+  function logSpan(line){var cls=line.indexOf('[ERROR]')>=0?'err':(line.indexOf('[WARN]')>=0?'':'ok'),
+    sp=document.createElement('span');sp.className=cls;sp.textContent=line+'\n';return sp;}
+  function setStackOk(ok){var fm=document.getElementById('fallback-msg');
+    if(fm)fm.textContent=ok?'Stack running. If blank, try retry.':'Stack NOT running. Click retry.';}
+  function renderLog(lines){['stack-log','fallback-log'].forEach(function(id){var el=document.getElementById(id);if(!el)return;
+    el.textContent='';lines.forEach(function(l){el.appendChild(logSpan(l));});el.scrollTop=el.scrollHeight;});}
+  function appendLog(line){['stack-log','fallback-log'].forEach(function(id){var el=document.getElementById(id);if(!el)return;
+    if(el.textContent==='Loading...')el.textContent='';el.appendChild(logSpan(line));
+    while(el.childNodes.length>100)el.removeChild(el.firstChild);el.scrollTop=el.scrollHeight;});}
+  function refreshStackLog(){if(live)return;fetch('/api/stack_status',{credentials:'same-origin'}).then(function(r){return r.json()})
+    .then(function(d){renderLog(d.log);setStackOk(d.stack_ok);}).catch(function(){});}
+  // Live updates: the server pushes stack deltas, log lines and resize progress.
+  var live=false,pendingReload=false;
+  if(window.EventSource){var es=new EventSource('/api/events');
+    es.addEventListener('open',function(){live=true;});
+    es.addEventListener('error',function(){live=false;});
+    es.addEventListener('log',function(e){appendLog(JSON.parse(e.data).line);});
+    es.addEventListener('resync',function(){renderLog([]);});
+    es.addEventListener('stack',function(e){var d=JSON.parse(e.data);
+      if('stack_ok' in d)setStackOk(d.stack_ok);
+      if('width' in d||'height' in d)refreshCurRes();});
+    es.addEventListener('progress',function(e){var d=JSON.parse(e.data);
+      if(d.step==='done'){showStatus('✓ '+d.width+'x'+d.height+' ready',3000);
+        if(pendingReload){pendingReload=false;if(pageReload)location.reload();else frame.src=frame.src;}}
+      else if(d.step==='failed')showStatus('✗ Stack failed at '+d.width+'x'+d.height,5000);
+      else showStatus('⟳ '+d.step+' ('+d.width+'x'+d.height+')',8000);});
+    es.addEventListener('video',function(e){videoInfo(JSON.parse(e.data));});
+    es.addEventListener('download',function(e){var d=JSON.parse(e.data);
+      showStatus('⤓ '+d.name+' downloaded — ⚙ RES → Files',8000);if(settings.classList.contains('open'))refreshFiles();});
+    es.addEventListener('op',function(e){var d=JSON.parse(e.data);
+      if(d.status==='waiting')showStatus('⏳ Queued — host busy: '+d.reason,30000);});}
+  // A depth change also changes the noVNC URL (quality/compression), so it reloads the page.
+  var pageReload=false;
+  function reloadFrameSoon(){if(live)pendingReload=true;
+    else setTimeout(function(){if(pageReload)location.reload();else frame.src=frame.src;},3000);}
+  window.applyDepth=function(d){showStatus('Switching to '+d+'-bit...');
+    fetch('/api/set_resolution',{method:'POST',headers:{'Content-Type':'application/json'},
+    body:JSON.stringify({depth:d}),credentials:'same-origin'}).then(function(r){return r.json()})
+    .then(function(r){if(r.status==='error'){showStatus('✗ '+r.error,5000);return;}
+      if(r.status==='waiting')showStatus('⏳ '+r.error+' — queued #'+r.position,30000);
+      else showStatus(r.changed?'✓ '+d+'-bit — restarting':'✓ already '+d+'-bit',5000);
+      if(r.changed){pageReload=true;reloadFrameSoon();}}).catch(function(e){showStatus('✗ '+e,5000);});};
   window.retryStack=function(){showStatus('Restarting stack...',8000);
     fetch('/api/restart_stack',{method:'POST',credentials:'same-origin'}).then(function(r){return r.json()})
-    .then(function(d){showStatus(d.status==='ok'?'✓ Restarted — reloading...':'✗ '+d.error,5000);
-    refreshStackLog();setTimeout(function(){frame.src=frame.src;},3000);}).catch(function(e){showStatus('✗ '+e,5000);});};
+    .then(function(d){if(d.status==='waiting'){showStatus('⏳ '+d.error+' — queued #'+d.position,30000);
+      reloadFrameSoon();return;}
+    showStatus(d.status==='ok'?'✓ Restarted — reloading...':'✗ '+d.error,5000);
+    refreshStackLog();reloadFrameSoon();}).catch(function(e){showStatus('✗ '+e,5000);});};
   window.autoDetect=function(){var s=getScreenInfo();showStatus('Auto: '+s.viewportW+'x'+s.viewportH);applyResolution(s.viewportW,s.viewportH);};
   window.applyManual=function(){applyResolution(parseInt(document.getElementById('res-w').value)||1920,parseInt(document.getElementById('res-h').value)||1080);};
   window.applyPreset=function(w,h){document.getElementById('res-w').value=w;document.getElementById('res-h').value=h;applyResolution(w,h);};
@@ -970,11 +4019,96 @@ html,body{width:100%;height:100%;overflow:hidden;background:#000;font-family:'Co
     fetch('/api/set_resolution',{method:'POST',headers:{'Content-Type':'application/json'},
     body:JSON.stringify({width:w,height:h}),credentials:'same-origin'}).then(function(r){return r.json()})
     .then(function(d){if(d.status==='ok'){showStatus('✓ '+d.width+'x'+d.height,5000);refreshCurRes();
-    setTimeout(function(){frame.src=frame.src;},3000);}else showStatus('✗ '+(d.error||'error'),5000);}).catch(function(e){showStatus('✗ '+e,5000);});}
+    if(d.changed)reloadFrameSoon();}else if(d.status==='waiting'){showStatus('⏳ '+d.error+' — queued #'+d.position,30000);
+    reloadFrameSoon();}else showStatus('✗ '+(d.error||'error'),5000);}).catch(function(e){showStatus('✗ '+e,5000);});}
   window.toggleSettings=function(){settings.classList.toggle('open');
-    if(settings.classList.contains('open')){updateScreenInfo();refreshCurRes();refreshStackLog();}};
+    if(settings.classList.contains('open')){updateScreenInfo();refreshCurRes();refreshStackLog();refreshFiles();}};
+  // Files: Chromium's downloads can be fetched here (resumable); uploads go up
+  // in 8 MB chunks and appear in Chromium's file picker under Uploads.
+  function esc(s){var d=document.createElement('div');d.textContent=s;return d.innerHTML;}
+  function refreshFiles(){fetch('/api/files',{credentials:'same-origin'}).then(function(r){return r.json()}).then(function(d){
+    var el=document.getElementById('files'),h='';
+    d.downloads.forEach(function(f){h+='⤓ <a href="/api/files/downloads/'+encodeURIComponent(f.name)+'">'+esc(f.name)+'</a> '+(f.size>>10)+' KB\n';});
+    d.uploads.forEach(function(f){h+='⇪ '+esc(f.name)+' '+(f.size>>10)+' KB\n';});
+    el.innerHTML=h||'No files';}).catch(function(){});}
+  window.uploadFiles=function(files){var list=Array.prototype.slice.call(files),CH=8<<20;
+    function next(){var f=list.shift();if(!f){refreshFiles();return;}send(f,0);}
+    function send(f,off){var end=Math.min(off+CH,f.size);
+      showStatus('⇪ '+f.name+' '+(f.size?Math.floor(off*100/f.size):100)+'%',30000);
+      fetch('/api/files/uploads/'+encodeURIComponent(f.name),{method:'PUT',credentials:'same-origin',body:f.slice(off,end),
+        headers:f.size?{'Content-Range':'bytes '+off+'-'+(end-1)+'/'+f.size}:{}})
+      .then(function(r){return r.json().then(function(d){return [r.status,d];});}).then(function(x){var st=x[0],d=x[1];
+        if(d.done){showStatus('✓ '+f.name+' uploaded',5000);next();}
+        else if(st===200||st===409)send(f,d.received);
+        else{showStatus('✗ '+f.name+': '+(d.error||st),8000);next();}})
+      .catch(function(){setTimeout(function(){send(f,off);},2000);});}
+    next();};
   frame.addEventListener('load',function(){loaded=true;});
   frame.addEventListener('error',function(){if(!loaded){fallback.style.display='flex';refreshStackLog();}});
+  // Latency probe: first key/button after idle -> noVNC's websocket send (n-th
+  // message of the connection) -> next message back -> next animation frame.
+  // The server joins these with its bridge timings for message n.
+  var probe=null,probeOut=[];
+  frame.addEventListener('load',function(){var w;try{w=frame.contentWindow;if(!w.WebSocket||w.__qsProbe)return;}catch(e){return;}
+    w.__qsProbe=1;var sock=null,n=0,send=w.WebSocket.prototype.send;
+    w.WebSocket.prototype.send=function(d){if(this!==sock){sock=this;n=0;probe=null;
+        this.addEventListener('message',function(){var p=probe;if(!p||!p.send||p.recv)return;p.recv=performance.now();
+          w.requestAnimationFrame(function(){var t=performance.now();
+            probeOut.push({n:p.n,input:p.send-p.ev,rtt:p.recv-p.send,paint:t-p.recv});if(probe===p)probe=null;});});}
+      n++;if(probe&&!probe.send){probe.send=performance.now();probe.n=n;}
+      return send.call(this,d);};
+    ['keydown','mousedown','wheel','touchstart'].forEach(function(t){
+      w.document.addEventListener(t,function(){if(!probe)probe={ev:performance.now()};},true);});});
+  // Video mode: while most of the screen is changing (video, animation,
+  // scrolling) the server recommends it; noVNC is unloaded and a WebCodecs
+  // decoder draws the encoded stream instead. Input goes back on the same
+  // socket as {"p":[x,y,buttons]} and {"k":[keysym,down]}.
+  var vcan=document.getElementById('video'),vctx=vcan.getContext('2d'),vws=null,vdec=null,
+      vpref='auto',vrec='rfb',vok=false,novncSrc=frame.getAttribute('src');
+  function wantVideo(){return vok&&!!window.VideoDecoder&&(vpref==='video'||(vpref==='auto'&&vrec==='video'));}
+  function applyVideo(){var on=wantVideo();if(on&&!vws)startVideo();else if(!on&&vws)stopVideo();
+    document.getElementById('video-info').textContent='Now: '+(on?'video':'RFB')+(vpref==='auto'?' (auto)':'')+
+      (window.VideoDecoder?'':' — no WebCodecs in this browser')+(vok?'':' — video unavailable on server');}
+  function startVideo(){var key=false,ws=vws=new WebSocket((location.protocol==='https:'?'wss://':'ws://')+location.host+'/ws/video?codec=h264');
+    ws.binaryType='arraybuffer';
+    ws.onmessage=function(e){
+      if(typeof e.data==='string'){var c=JSON.parse(e.data);
+        if(c.error){showStatus('✗ '+c.error,5000);vok=false;stopVideo();return;}
+        vcan.width=c.width;vcan.height=c.height;
+        vdec=new VideoDecoder({output:function(f){vctx.drawImage(f,0,0);f.close();},error:function(){key=false;}});
+        vdec.configure({codec:c.codec,optimizeForLatency:true});
+        frame.src='about:blank';vcan.style.display='block';vcan.focus();return;}
+      var u=new Uint8Array(e.data);if(!vdec||vdec.state!=='configured')return;
+      if(u[0])key=true;else if(vdec.decodeQueueSize>2)key=false;  // behind: skip to the next key frame
+      if(key)vdec.decode(new EncodedVideoChunk({type:u[0]?'key':'delta',timestamp:performance.now()*1000,data:u.subarray(1)}));};
+    ws.onclose=function(){if(vws!==ws)return;vws=null;if(vdec&&vdec.state!=='closed')vdec.close();vdec=null;
+      if(wantVideo())setTimeout(applyVideo,1000);else restoreFrame();};}
+  function stopVideo(){var ws=vws;vws=null;if(ws)ws.close();if(vdec&&vdec.state!=='closed')vdec.close();vdec=null;restoreFrame();}
+  function restoreFrame(){vcan.style.display='none';if(frame.getAttribute('src')!==novncSrc)frame.src=novncSrc;}
+  function vsend(o){if(vws&&vws.readyState===1)vws.send(JSON.stringify(o));}
+  function vpos(e){var r=vcan.getBoundingClientRect(),s=Math.min(r.width/vcan.width,r.height/vcan.height);
+    return [Math.round((e.clientX-r.left-(r.width-vcan.width*s)/2)/s),Math.round((e.clientY-r.top-(r.height-vcan.height*s)/2)/s)];}
+  var vmask=0,vmove=null,VB=[1,2,4];
+  vcan.addEventListener('mousemove',function(e){if(!vmove)requestAnimationFrame(function(){vsend({p:vmove.concat(vmask)});vmove=null;});vmove=vpos(e);});
+  vcan.addEventListener('mousedown',function(e){vmask|=VB[e.button]||0;vsend({p:vpos(e).concat(vmask)});vcan.focus();e.preventDefault();});
+  window.addEventListener('mouseup',function(e){if(!vws)return;vmask&=~(VB[e.button]||0);vsend({p:vpos(e).concat(vmask)});});
+  vcan.addEventListener('contextmenu',function(e){e.preventDefault();});
+  vcan.addEventListener('wheel',function(e){var p=vpos(e);vsend({p:p.concat(vmask|(e.deltaY<0?8:16))});vsend({p:p.concat(vmask)});
+    e.preventDefault();},{passive:false});
+  var KS={Backspace:0xff08,Tab:0xff09,Enter:0xff0d,Escape:0xff1b,Delete:0xffff,Home:0xff50,ArrowLeft:0xff51,ArrowUp:0xff52,
+    ArrowRight:0xff53,ArrowDown:0xff54,PageUp:0xff55,PageDown:0xff56,End:0xff57,Insert:0xff63,Shift:0xffe1,Control:0xffe3,
+    Alt:0xffe9,Meta:0xffe7,CapsLock:0xffe5};
+  function keysym(e){if(KS[e.key])return KS[e.key];if(/^F\d\d?$/.test(e.key))return 0xffbd+(+e.key.slice(1));
+    if(e.key.length===1||e.key.length===2&&e.key.codePointAt(0)>0xffff){var c=e.key.codePointAt(0);return c<0x100?c:0x1000000+c;}return 0;}
+  ['keydown','keyup'].forEach(function(t){vcan.addEventListener(t,function(e){var k=keysym(e);
+    if(k){vsend({k:[k,t==='keydown'?1:0]});e.preventDefault();}});});
+  window.setVideoPref=function(p){fetch('/api/video',{method:'POST',credentials:'same-origin',
+    headers:{'Content-Type':'application/json'},body:JSON.stringify({pref:p})}).then(function(r){return r.json()}).then(videoInfo);};
+  function videoInfo(d){if(d.pref)vpref=d.pref;vrec=d.recommended;vok=d.available;applyVideo();}
+  fetch('/api/video',{credentials:'same-origin'}).then(function(r){return r.json()}).then(videoInfo).catch(function(){});
+  setInterval(function(){if(!probeOut.length)return;
+    fetch('/api/latency',{method:'POST',headers:{'Content-Type':'application/json'},
+      body:JSON.stringify({samples:probeOut.splice(0,200)})}).catch(function(){});},5000);
   setTimeout(function(){if(!loaded){try{var x=frame.contentWindow.location.href;}catch(e){loaded=true;return;}
     fallback.style.display='flex';refreshStackLog();}},10000);
   window.addEventListener('resize',updateScreenInfo);
@@ -985,6 +4119,13 @@ html,body{width:100%;height:100%;overflow:hidden;background:#000;font-family:'Co
 @app.route("/")
 @login_required
 def index():
+    depth = CURRENT_DEPTH
+    if MODE == "router":
+        node = _node_for_session()
+        if not node:
+            return render_template_string(WAIT_HTML, position=_line_position(session.get("sid")),
+                                          retry=NODE_HEARTBEAT), 503, {"Retry-After":str(NODE_HEARTBEAT)}
+        depth = (_node_get(node, "/api/get_resolution") or {}).get("depth", 24)   # the node's screen, not ours
     # noVNC silently PREFIXES a relative `path` value with the directory
     # it's served from (here, /novnc/), so path=ws was actually being
     # requested as /novnc/ws — which doesn't exist. Passing a full
@@ -1001,6 +4142,7 @@ def index():
         "reconnect_delay": "2000",
         "bell": "off",
         "path": ws_abs_url,
+        **NOVNC_DEPTH_ARGS.get(depth, {}),
     })
     novnc_url = f"/novnc/{NOVNC_ENTRY}?{query}"
     return render_template_string(APP_HTML, novnc_url=novnc_url, novnc_port=NOVNC_PORT)
@@ -1015,27 +4157,43 @@ def login_page():
 
 @app.route("/login", methods=["POST"])
 def login_post():
+    global _profile_owner
     if request.content_length and request.content_length > MAX_BODY: abort(413)
     ip = _real_ip()
-    if _rate_limited(ip):
+    user = request.form.get("username","").strip()[:64]
+    wait = _rate_limited(ip, user)
+    if wait:
         csrf = secrets.token_hex(16); session["csrf"] = csrf
-        return render_template_string(LOGIN_HTML, error="Too many attempts. Wait 60s.", csrf=csrf), 429
+        wait = math.ceil(wait)
+        resp = make_response(render_template_string(LOGIN_HTML, error=f"Too many attempts. Wait {wait}s.", csrf=csrf), 429)
+        resp.headers["Retry-After"] = str(wait)
+        return resp
     fc = request.form.get("csrf_token","")
     if not fc or fc != session.get("csrf"):
         csrf = secrets.token_hex(16); session["csrf"] = csrf
         return render_template_string(LOGIN_HTML, error="Invalid request.", csrf=csrf), 400
     u = html.escape(request.form.get("username","").strip())
     p = request.form.get("password","").strip()
-    if check_auth(u, p):
+    ok = _verify_login(u, p)
+    if ok is None:
+        csrf = secrets.token_hex(16); session["csrf"] = csrf
+        resp = make_response(render_template_string(LOGIN_HTML, error="Server busy. Try again shortly.", csrf=csrf), 503)
+        resp.headers["Retry-After"] = "2"
+        return resp
+    if ok:
         session.clear(); session.permanent = True
         session["authenticated"] = True; session["username"] = u
+        session["sid"] = secrets.token_hex(4)
+        _profile_owner = u
         return redirect(url_for("index"))
-    _record(ip)
+    _record(ip, user)
     csrf = secrets.token_hex(16); session["csrf"] = csrf
     return render_template_string(LOGIN_HTML, error="Invalid credentials.", csrf=csrf), 401
 
 @app.route("/logout")
 def logout():
+    if MODE == "router":
+        with _nodes_lock: _placements.pop(session.get("sid"), None)
     session.clear()
     return redirect(url_for("login_page"))
 
@@ -1046,6 +4204,10 @@ def novnc_static(filename):
     old built-in web server, which used to also listen on 0.0.0.0:6080."""
     if not NOVNC_WEB_ROOT:
         abort(404)
+    if filename == NOVNC_ENTRY and _rtc_available():
+        page = (Path(NOVNC_WEB_ROOT) / filename).read_text(encoding="utf-8")
+        shim = RTC_SHIM % json.dumps([{"urls":u} for u in RTC_ICE])
+        return page.replace("<head>", "<head>" + shim, 1), {"Cache-Control":"no-cache"}
     return send_from_directory(NOVNC_WEB_ROOT, filename)
 
 @sock.route("/ws")
@@ -1060,86 +4222,475 @@ def ws_vnc_bridge(ws):
         try: ws.close()
         except Exception: pass
         return
+    sid = session.get("sid")
+    if MODE == "router": return _router_ws(ws, sid)
 
     try:
         vnc_sock = socket.create_connection(("127.0.0.1", VNC_PORT), timeout=5)
-        vnc_sock.setblocking(False)
+        vnc_sock.settimeout(None)
+        vnc_sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
     except Exception as e:
-        _log(f"ws_vnc_bridge: cannot reach 127.0.0.1:{VNC_PORT}: {e}", "ERROR")
+        _log(f"cannot reach 127.0.0.1:{VNC_PORT}: {e}", "ERROR", "bridge", sid)
         try: ws.close()
         except Exception: pass
         return
 
-    _log(f"ws_vnc_bridge: connected to 127.0.0.1:{VNC_PORT}, bridging")
+    _log(f"connected to 127.0.0.1:{VNC_PORT}, bridging", component="bridge", session=sid)
+    trace = _trace_open(sid, session.get("username"))
+    _open_bridges[threading.get_ident()] = sid
+    probe = _lat_session(sid); probe["conn"].clear()
+    awaiting, awaiting_lock = [], threading.Lock()   # input messages waiting for the next update
+    me, up_lock = threading.get_ident(), threading.Lock()   # held requests are released from the shaper
+    def upstream(msg):
+        with up_lock: vnc_sock.sendall(msg)
+    shaped = _bw_on()
+    if shaped: _bw_open(me, sid, session.get("username"), upstream)
+    io = _bridge_io[me] = [sid, 0, 0]
 
-    # Single-threaded, select()-based multiplexer — avoids any concurrency
-    # issues from calling ws.send()/ws.receive() on two different threads.
+    # One blocking thread per direction: a byte is forwarded the moment it
+    # arrives instead of on the next 20 ms poll. Only this thread receives
+    # from the websocket and only downstream() sends on it.
+    def downstream():
+        nonlocal awaiting
+        try:
+            while True:
+                data = vnc_sock.recv(262144)
+                if not data:
+                    _log("VNC side closed connection", "WARN", "bridge", sid)
+                    break
+                t_vnc = time.monotonic()
+                with awaiting_lock: waiting, awaiting = awaiting, []
+                ws.send(data)
+                t_out = time.monotonic()
+                io[1] += len(data)
+                if shaped: _bw_sent(me, len(data))
+                for n, t_in, t_sent in waiting:
+                    if t_vnc - t_in < 5: _lat_bridge(probe, n, t_in, t_sent, t_vnc, t_out)
+                _trace_rec(trace, TRACE_S2C, data)
+        except (OSError, ConnectionClosed): pass
+        finally:
+            try: ws.close()
+            except Exception: pass
+    threading.Thread(target=downstream, daemon=True, name=f"bridge-{sid}").start()
+    n, stream = 0, _RfbClientStream()
     try:
-        import select as _select
         while True:
-            readable, _, _ = _select.select([vnc_sock], [], [], 0.02)
-            if vnc_sock in readable:
-                try:
-                    data = vnc_sock.recv(65536)
-                except BlockingIOError:
-                    data = None
-                if data == b"":
-                    _log("ws_vnc_bridge: VNC side closed connection", "WARN")
-                    break
-                if data:
-                    ws.send(data)
-
-            msg = ws.receive(timeout=0.02)
-            if msg is not None:
-                if isinstance(msg, str):
-                    msg = msg.encode("utf-8", "ignore")
-                vnc_sock.sendall(msg)
+            msg = ws.receive()
+            if msg is None: break
+            t_in = time.monotonic(); n += 1
+            if isinstance(msg, str):
+                msg = msg.encode("utf-8", "ignore")
+            unknown = stream.unknown
+            parts = stream.feed(msg)
+            out = [m for t, m in parts if not (shaped and t == 3) or _bw_request(me, m)]
+            if out: upstream(out[0] if len(out) == 1 else b"".join(out))
+            io[2] += len(msg)
+            if unknown is None and stream.unknown is not None:
+                _log(f"unknown RFB client message type {stream.unknown}; passing the rest through unparsed",
+                     "WARN", "bridge", sid)
+            if any(t in (4, 5) for t, _ in parts):   # KeyEvent / PointerEvent
+                with awaiting_lock:
+                    if len(awaiting) < 64: awaiting.append((n, t_in, time.monotonic()))
+            _trace_rec(trace, TRACE_C2S, msg)
+    except ConnectionClosed: pass
     except Exception as e:
-        _log(f"ws_vnc_bridge: bridge error: {e}", "ERROR")
+        _log(f"bridge error: {e}", "ERROR", "bridge", sid)
     finally:
+        try: vnc_sock.shutdown(socket.SHUT_RDWR)
+        except OSError: pass
         try: vnc_sock.close()
         except Exception: pass
-        _log("ws_vnc_bridge: connection closed")
+        _trace_close(trace)
+        if shaped: _bw_close(me)
+        _bridge_io.pop(me, None)
+        _open_bridges.pop(me, None)
+        _log("connection closed", component="bridge", session=sid)
+
+@app.route("/api/files")
+@login_required
+def list_files():
+    dl, up = _transfer_dirs()
+    return jsonify({"downloads":_transfer_list(dl), "uploads":_transfer_list(up),
+                    "used":_transfer_usage(), "limit":TRANSFER_MAX_BYTES, "chunk_max":UPLOAD_CHUNK_MAX})
+
+@app.route("/api/files/<kind>/<name>", methods=["GET", "DELETE"])
+@login_required
+def get_file(kind, name):
+    if kind not in ("downloads", "uploads") or not (name := _transfer_name(name)): abort(404)
+    path = _transfer_dirs()[kind == "uploads"] / name
+    if not path.is_file(): abort(404)
+    if request.method == "DELETE":
+        path.unlink(missing_ok=True)
+        return jsonify({"status":"ok"})
+    return _file_response(str(path))
+
+@app.route("/api/files/uploads/<name>", methods=["PUT"])
+@login_required
+def upload_file(name):
+    """One chunk per request: Content-Range: bytes START-END/TOTAL (or none for
+    a whole file in one go). "bytes */TOTAL" with an empty body asks how much
+    has arrived; a chunk at the wrong offset gets 409 with the same answer."""
+    if not (name := _transfer_name(name)): return jsonify({"error":"bad file name"}), 400
+    up = _transfer_dirs()[1]
+    part, size_file = up / f".{name}.part", up / f".{name}.size"   # size is fixed by the first chunk
+    have = part.stat().st_size if part.exists() else 0
+    cr = request.headers.get("Content-Range")
+    m = re.fullmatch(r"bytes (?:(\d+)-(\d+)|\*)/(\d+)", cr.strip()) if cr else None
+    if cr and not m: return jsonify({"error":"bad Content-Range"}), 400
+    if m and m.group(1) is None: return jsonify({"received":have, "size":int(m.group(3)), "done":False})
+    length = request.content_length
+    if length is None: return jsonify({"error":"Content-Length required"}), 411
+    if m:
+        start, total = int(m.group(1)), int(m.group(3))
+        if int(m.group(2)) - start + 1 != length: return jsonify({"error":"Content-Range does not match body"}), 400
+    else:
+        start, total, have = 0, length, 0
+    if length > UPLOAD_CHUNK_MAX: return jsonify({"error":f"chunk over {UPLOAD_CHUNK_MAX} bytes"}), 413
+    if start != have: return jsonify({"received":have, "size":total, "done":False}), 409
+    if start + length > total: return jsonify({"error":"chunk past end of file"}), 400
+    if start == 0:
+        if _transfer_usage() - have + total > TRANSFER_MAX_BYTES:   # `have` is about to be truncated
+            return jsonify({"error":"transfer quota exceeded", "limit":TRANSFER_MAX_BYTES}), 413
+        size_file.write_text(str(total))
+    else:
+        try: fixed = int(size_file.read_text())
+        except (OSError, ValueError): fixed = None
+        if fixed != total:
+            return jsonify({"error":"size differs from the upload's first chunk", "received":have, "size":fixed}), 409
+    request.max_content_length = UPLOAD_CHUNK_MAX
+    with open(part, "ab" if start else "wb") as f:
+        shutil.copyfileobj(request.stream, f, 1 << 20)
+        have = f.tell()
+    if have < start + length: return jsonify({"received":have, "size":total, "done":False}), 400
+    if have == total:
+        os.replace(part, up / name)
+        size_file.unlink(missing_ok=True)
+        _log(f"upload {name} ({total} bytes)", component="transfer", session=session.get("sid"))
+    return jsonify({"received":have, "size":total, "done":have == total})
+
+@sock.route("/ws/video")
+def ws_video(ws):
+    """Video mode: encoded frames down, input events up. The first message is
+    a JSON decoder config; each frame is one binary message, a key-frame flag
+    byte followed by the encoded frame."""
+    if not session.get("authenticated"):
+        try: ws.close()
+        except Exception: pass
+        return
+    sid = session.get("sid")
+    if MODE == "router": return _router_ws(ws, sid)
+    codec = request.args.get("codec", "h264")
+    if codec not in VIDEO_CODECS or not _video_available():
+        ws.send(json.dumps({"error":"video mode unavailable (needs ffmpeg)"})); ws.close(); return
+    w, h = CURRENT_W & ~1, CURRENT_H & ~1
+    try: rfb = _rfb_input()
+    except (OSError, ConnectionError) as e:
+        _log(f"video input channel: {e}", "ERROR", "video", sid)
+        ws.close(); return
+    env = os.environ.copy(); env["DISPLAY"] = XVFB_DISPLAY
+    p = subprocess.Popen(_video_cmd(codec, w, h), stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                         stderr=subprocess.DEVNULL, env=env)
+    try: fcntl.fcntl(p.stdout.fileno(), 1031, 1 << 20)   # F_SETPIPE_SZ: room for a whole key frame
+    except OSError: pass
+    me = threading.get_ident()
+    stats = _video_viewers[me] = {"sid":sid, "codec":codec, "frames":0, "bytes":0, "since":time.monotonic()}
+    _log(f"video {codec} {w}x{h}@{VIDEO_FPS} (ffmpeg PID {p.pid})", component="video", session=sid)
+    ws.send(json.dumps({"codec":VIDEO_CODECS[codec]["codec"], "width":w, "height":h}))
+    def downstream():
+        try:
+            for key, frame in (_h264_frames if codec == "h264" else _ivf_frames)(p.stdout):
+                ws.send(b"\x01" + frame if key else b"\x00" + frame)
+                stats["frames"] += 1; stats["bytes"] += len(frame)
+        except (OSError, ConnectionClosed): pass
+        finally:
+            try: ws.close()
+            except Exception: pass
+    threading.Thread(target=downstream, daemon=True, name=f"video-{sid}").start()
+    try:
+        while True:
+            msg = ws.receive()
+            if msg is None: break
+            try: ev = json.loads(msg)
+            except (TypeError, ValueError): continue
+            if "p" in ev:
+                x, y, mask = (int(v) for v in ev["p"])
+                rfb.sendall(struct.pack(">BBHH", 5, mask & 0xff, max(0, min(x, w - 1)), max(0, min(y, h - 1))))
+            elif "k" in ev:
+                keysym, down = (int(v) for v in ev["k"])
+                rfb.sendall(struct.pack(">BBxxI", 4, 1 if down else 0, keysym & 0xffffffff))
+    except (OSError, ConnectionClosed, ValueError, TypeError): pass
+    finally:
+        _video_viewers.pop(me, None)
+        p.kill(); p.wait()
+        try: rfb.close()
+        except OSError: pass
+        _log(f"video closed after {stats['frames']} frames", component="video", session=sid)
+
+@app.route("/api/video", methods=["GET", "POST"])
+@login_required
+def api_video():
+    """GET: recommended mode, change rate, viewers. POST {"pref":"auto|rfb|video"}
+    stores this session's choice."""
+    if request.method == "POST":
+        data = request.get_json(silent=True)
+        pref = data.get("pref") if isinstance(data, dict) else None
+        if pref not in _VIDEO_PREFS: return jsonify({"error":f"pref must be one of {', '.join(_VIDEO_PREFS)}"}), 400
+        session["video"] = pref
+    return jsonify(dict(_video_view(), pref=session.get("video", "auto")))
+
+@app.route("/api/rtc", methods=["GET", "POST"])
+@login_required
+def api_rtc():
+    """POST: the browser's complete SDP offer, answered with ours. GET:
+    whether the WebRTC transport is on, and this session's peer connections."""
+    sid = session.get("sid")
+    if request.method == "GET": return jsonify(_rtc_view(sid))
+    if not _rtc_available():
+        return jsonify({"error":"WebRTC transport is off (QS_WEBRTC=0 or aiortc not installed)"}), 501
+    offer = request.get_json(silent=True)
+    if not isinstance(offer, dict) or offer.get("type") != "offer" or not isinstance(offer.get("sdp"), str):
+        return jsonify({"error":"expected {\"sdp\":..., \"type\":\"offer\"}"}), 400
+    try: answer = _rtc_run(_rtc_answer(offer, sid))
+    except Exception as e:
+        _log(f"webrtc offer failed: {e}", "WARN", "webrtc", sid)
+        return jsonify({"error":f"Could not answer offer: {e}"}), 400
+    _lat_session(sid)["conn"].clear()   # bridge timings of an earlier /ws no longer apply
+    _log("webrtc peer connection answered", component="webrtc", session=sid)
+    return jsonify(answer)
+
+@app.route("/api/metrics")
+@login_required
+def api_metrics():
+    """History of the stack, or of one session's bridge with ?session=<sid>
+    (your own, or any for admins). ?from=&to= in unix seconds, or ?last=
+    seconds (default 600); ?res=1s|1m|1h, default the finest level that
+    still covers `from`; ?fields= comma-separated."""
+    if not METRICS: return jsonify({"error":"Metrics history is off (QS_METRICS=0)"}), 404
+    now, user = time.time(), session.get("username")
+    try:
+        t1 = float(request.args.get("to", now))
+        t0 = float(request.args["from"]) if "from" in request.args else t1 - float(request.args.get("last", 600))
+        if not (math.isfinite(t0) and math.isfinite(t1)): raise ValueError
+    except ValueError: return jsonify({"error":"from, to and last must be numbers"}), 400
+    names = [n for n, _, _ in METRIC_LEVELS]
+    res = request.args.get("res") or next((n for n, step, slots in METRIC_LEVELS if now - t0 <= step * slots), names[-1])
+    if res not in names: return jsonify({"error":f"res must be one of {', '.join(names)}"}), 400
+    sid = request.args.get("session")
+    if sid and sid != session.get("sid") and user not in ADMIN_USERS:
+        return jsonify({"error":"Admins only"}), 403
+    with _metrics_lock:
+        series = _metrics_sessions.get(sid) if sid else _metrics_stack
+        if series is None: return jsonify({"error":"No history for that session"}), 404
+        fields = [f for f in request.args.get("fields", "").split(",") if f] or list(series.fields)
+        bad = [f for f in fields if f not in series.fields]
+        if bad: return jsonify({"error":f"Unknown fields {bad}; have {list(series.fields)}"}), 400
+        t, values = series.query(names.index(res), t0, t1, fields)
+        tracked = [s for s in _metrics_sessions if user in ADMIN_USERS or s == session.get("sid")]
+    return jsonify({"series":"session" if sid else "stack", "session":sid, "res":res,
+                    "step":METRIC_LEVELS[names.index(res)][1], "from":t0, "to":t1, "t":t, "values":values,
+                    "sessions":tracked, "store_bytes":_metrics_size()})
+
+@app.route("/api/latency", methods=["GET", "POST"])
+@login_required
+def api_latency():
+    """POST: browser-side samples for this session. GET: p50/p95/p99 (ms) per
+    stage for this session, or every session with ?all=1 (admins)."""
+    sid = session.get("sid")
+    if request.method == "POST":
+        data = request.get_json(silent=True)
+        samples = data.get("samples") if isinstance(data, dict) else None
+        if not isinstance(samples, list): return jsonify({"error":"expected {\"samples\":[...]}"}), 400
+        s = _lat_session(sid)
+        for sample in samples[:200]:
+            if isinstance(sample, dict): _lat_client(s, sample)
+        return jsonify({"status":"ok"})
+    if request.args.get("all") and session.get("username") in ADMIN_USERS:
+        with _latency_lock: sessions = list(_latency.items())
+        return jsonify({"sessions":{k: _lat_view(v) for k, v in sessions}})
+    return jsonify({"session":sid, "stages":_lat_view(_lat_session(sid))})
 
 @app.route("/api/get_resolution")
 @login_required
 def api_get_resolution():
-    return jsonify({"width":CURRENT_W,"height":CURRENT_H,"min_w":MIN_W,"min_h":MIN_H,"max_w":MAX_W,"max_h":MAX_H})
+    return jsonify({"width":CURRENT_W,"height":CURRENT_H,"depth":CURRENT_DEPTH,"depths":DEPTHS,
+                    "min_w":MIN_W,"min_h":MIN_H,"max_w":MAX_W,"max_h":MAX_H})
 
 @app.route("/api/set_resolution", methods=["POST"])
 @login_required
 def api_set_resolution():
     data = request.get_json(silent=True) or {}
-    try: w = int(data.get("width", CURRENT_W)); h = int(data.get("height", CURRENT_H))
+    target = _op_target()
+    try:
+        w = int(data.get("width", CURRENT_W)); h = int(data.get("height", CURRENT_H))
+        d = int(data.get("depth", target[2]))
     except: return jsonify({"status":"error","error":"Invalid"}), 400
+    if d not in DEPTHS: return jsonify({"status":"error","error":f"depth must be one of {DEPTHS}"}), 400
     w = max(MIN_W, min(w, MAX_W)); h = max(MIN_H, min(h, MAX_H))
-    if w == CURRENT_W and h == CURRENT_H:
-        return jsonify({"status":"ok","width":w,"height":h,"changed":False})
-    threading.Thread(target=lambda: _restart_stack(w, h), daemon=True).start()
-    return jsonify({"status":"ok","width":w,"height":h,"changed":True})
+    if (w, h, d) == target:
+        return jsonify({"status":"ok","width":w,"height":h,"depth":d,"changed":False})
+    op = _submit_stack_op("resize", w, h, d)
+    return (_admission_refused(op, {"width":w,"height":h,"depth":d,"changed":True}) or
+            jsonify({"status":"ok","width":w,"height":h,"depth":d,"changed":True,"op":op["id"]}))
 
 @app.route("/api/stack_status")
 @login_required
 def api_stack_status():
+    """?since=<seq> returns only entries newer than the cursor; optional
+    ?level=WARN, ?component=bridge, ?session=<sid> filters."""
     alive = {k: (v.poll() is None) for k, v in PROCS.items()}
-    with _stack_log_lock: log_copy = list(_stack_log[-30:])
+    try: since = int(request.args["since"]) if "since" in request.args else None
+    except ValueError: since = None
+    try: limit = max(1, min(int(request.args.get("limit", 30)), LOG_CAPACITY))
+    except ValueError: limit = 30
+    recs, cursor = _log_read(since, limit, request.args.get("level"),
+                             request.args.get("component"), request.args.get("session"))
     return jsonify({"stack_ok":STACK_OK,"processes":alive,
         "resolution":f"{CURRENT_W}x{CURRENT_H}","chromium_bin":CHROME_BIN,
-        "arch":ARCH_LABEL,"log":log_copy})
+        "arch":ARCH_LABEL,"proxy":_proxy_view() if _proxy_url else None,
+        "bandwidth":_bw_view(session.get("username")),
+        "log":[_log_line(r) for r in recs],
+        "entries":[_log_dict(r) for r in recs],"cursor":cursor})
+
+@app.route("/api/events")
+@login_required
+def api_events():
+    """Server-Sent Events: stack state deltas, log lines and resize
+    progress, pushed as they happen instead of being polled."""
+    sub = _Subscriber()
+    backlog, _ = _log_read(None, 30)
+    with _subscribers_lock: _subscribers.add(sub)
+    _start_stack_watcher()
+    def gen():
+        try:
+            yield "retry: 2000\n\n"
+            yield _sse("stack", _stack_state())
+            for rec in backlog: yield _sse("log", _log_dict(rec))
+            while not sub.dropped:
+                try: yield sub.q.get(timeout=15)
+                except queue.Empty: yield ": keepalive\n\n"
+            yield _sse("resync", {})
+        finally:
+            with _subscribers_lock: _subscribers.discard(sub)
+    return Response(gen(), mimetype="text/event-stream",
+                    headers={"Cache-Control":"no-cache","X-Accel-Buffering":"no"})
+
+def _admission_refused(op, body):
+    """503 + Retry-After for an op held back by admission control; the op
+    stays queued and starts by itself once the host has room."""
+    reason, position = _admit_reason(), _op_position(op)
+    if not reason or not position or op["status"] not in ("queued", "waiting"): return None
+    resp = jsonify(dict(body, status="waiting", error=f"Host busy: {reason}", op=op["id"], position=position))
+    resp.status_code = 503; resp.headers["Retry-After"] = str(ADMIT_INTERVAL * 2)
+    return resp
 
 @app.route("/api/restart_stack", methods=["POST"])
 @login_required
 def api_restart_stack():
-    threading.Thread(target=lambda: _restart_stack(CURRENT_W, CURRENT_H), daemon=True).start()
-    return jsonify({"status":"ok","message":"Stack restart initiated"})
+    op = _submit_stack_op("restart")
+    return (_admission_refused(op, {}) or
+            jsonify({"status":"ok","message":"Stack restart initiated","op":op["id"]}))
+
+@app.route("/api/placement")
+@login_required
+def api_placement():
+    return jsonify(_placement_view())
+
+@app.route("/api/admission")
+@login_required
+def api_admission():
+    """Host pressure and limits; in router mode also this session's place
+    in the line for a node (and admission to one once a slot frees up)."""
+    if MODE == "router":
+        node = _node_for_session()
+        return jsonify({"admitted":node is not None, "position":_line_position(session.get("sid")),
+                        "waiting":len(_admit_line), "retry_after":NODE_HEARTBEAT})
+    return jsonify(_admission_view())
+
+@app.route("/api/stack_op/<op_id>")
+@login_required
+def api_stack_op(op_id):
+    op = _ops.get(op_id)
+    if not op: return jsonify({"error":"Unknown operation"}), 404
+    return jsonify(_op_view(op))
+
+@app.route("/api/admin/threads")
+@admin_required
+def api_admin_threads():
+    return Response(_thread_dump(), mimetype="text/plain", headers={"Cache-Control":"no-store"})
+
+@app.route("/api/admin/profile")
+@admin_required
+def api_admin_profile():
+    """Wall-clock profile of all threads as collapsed stacks
+    ("thread[session];file:func;... count"), ready for flamegraph.pl or
+    speedscope. ?seconds=<1..60>&hz=<1..1000>; one profile at a time."""
+    try:
+        seconds = max(1.0, min(float(request.args.get("seconds", 10)), PROFILE_MAX_S))
+        hz = max(1, min(int(request.args.get("hz", 100)), PROFILE_MAX_HZ))
+    except ValueError: return jsonify({"error":"Invalid seconds/hz"}), 400
+    if not _profile_lock.acquire(blocking=False):
+        return jsonify({"error":"A profile is already running"}), 409
+    try:
+        _log(f"profiling {seconds:g}s at {hz} Hz for {session.get('username')}", component="diag")
+        counts, samples, cpu = _profile(seconds, hz)
+    finally: _profile_lock.release()
+    body = "".join(f"{k} {v}\n" for k, v in sorted(counts.items(), key=lambda kv: -kv[1]))
+    return Response(body, mimetype="text/plain", headers={
+        "Cache-Control":"no-store", "X-Profile-Samples":str(samples),
+        "X-Profile-Overhead":f"{cpu * 100 / seconds:.2f}%"})
+
+@app.route("/api/snapshot")
+@login_required
+def api_snapshot():
+    """Cheap thumbnail of the remote screen for dashboards — no RFB stream.
+    ?w=<max width, 64..640>&fmt=png|webp. Honours If-None-Match."""
+    try: max_w = max(64, min(int(request.args.get("w", 320)), SNAPSHOT_MAX_W))
+    except ValueError: max_w = 320
+    fmt = "webp" if request.args.get("fmt") == "webp" else "png"
+    snap = _get_snapshot(max_w, fmt)
+    if not snap:
+        return jsonify({"error":"Framebuffer not available"}), 503
+    if request.if_none_match.contains(snap["etag"]):
+        resp = Response(status=304)
+    else:
+        resp = Response(snap["body"], mimetype=snap["mime"])
+    resp.set_etag(snap["etag"])
+    resp.headers["Cache-Control"] = f"private, max-age={int(SNAPSHOT_TTL)}"
+    return resp
 
 @app.route("/health")
 @login_required
 def health():
     alive = {k: (v.poll() is None) for k, v in PROCS.items()}
     return jsonify({"processes":alive,"chromium_bin":CHROME_BIN,
-        "resolution":f"{CURRENT_W}x{CURRENT_H}","arch":ARCH_LABEL,
-        "container":IN_CONTAINER,"stack_ok":STACK_OK})
+        "resolution":f"{CURRENT_W}x{CURRENT_H}","depth":CURRENT_DEPTH,"chrome_preset":CHROME_PRESET,"arch":ARCH_LABEL,
+        "container":IN_CONTAINER,"stack_ok":STACK_OK,"mode":MODE})
+
+@app.route("/api/node/heartbeat", methods=["POST"])
+def api_node_heartbeat():
+    """Router side: signed capacity report from a node agent."""
+    if MODE != "router": abort(404)
+    ts, body = request.headers.get("X-QS-Time", ""), request.get_data(as_text=True)
+    try: fresh = abs(time.time() - float(ts)) <= 30
+    except ValueError: fresh = False
+    if not fresh or not hmac.compare_digest(request.headers.get("X-QS-Signature", ""), _node_sign(ts, body)):
+        return jsonify({"error":"Bad signature"}), 403
+    try: report = json.loads(body); nid = str(report["id"])
+    except (ValueError, KeyError, TypeError): return jsonify({"error":"Bad report"}), 400
+    with _nodes_lock:
+        if nid not in _live_nodes(): _log(f"node {nid} up at {report.get('url')}", component="router")
+        _nodes[nid] = dict(report, seen=time.monotonic())
+    return jsonify({"status":"ok"})
+
+@app.route("/api/nodes")
+@admin_required
+def api_nodes():
+    with _nodes_lock:
+        live = _live_nodes()
+        nodes = [dict({k: v for k, v in n.items() if k != "seen"}, load=_node_load(nid, n),
+                      age=round(time.monotonic() - n["seen"], 1)) for nid, n in live.items()]
+        placed = len(_placements)
+    return jsonify({"mode":MODE, "nodes":nodes, "placements":placed})
 
 # ═══════════════════════════════════════════════════════════
 # CLEANUP
@@ -1147,11 +4698,20 @@ def health():
 def _cleanup(*_):
     global _resizer_running
     _resizer_running = False
+    if ADOPT and PROCS:
+        # Leave the stack to the next server; the profile is saved when it stops.
+        print(colored("\n[*] Shutting down — stack left running for the next server","yellow"))
+        _save_stack_state()
+        _log_flush()
+        sys.exit(0)
     print(colored("\n[*] Shutting down...","yellow"))
     for name in ["chromium","x11vnc","xvfb"]:
         _kill_proc(name)
+    _profile_save()
+    _release_placement()
     # Clean up X files on exit too
     _cleanup_x_stale_files()
+    _log_flush()
     sys.exit(0)
 
 signal.signal(signal.SIGINT, _cleanup)
@@ -1160,15 +4720,40 @@ signal.signal(signal.SIGTERM, _cleanup)
 # ═══════════════════════════════════════════════════════════
 # BOOT
 # ═══════════════════════════════════════════════════════════
-CHROME_BIN = _ensure_chromium()
+# QS_NO_BOOT=1: import for tooling (bench.py) without installing or starting anything.
+NO_BOOT = os.environ.get("QS_NO_BOOT", "0") == "1"
+if MODE not in ("standalone", "router", "node"):
+    print(colored(f"[!] Unknown QS_MODE={MODE!r} (standalone, router or node).", "red")); sys.exit(1)
+if CHROME_PRESET not in CHROME_PRESETS:
+    print(colored(f"[!] Unknown QS_CHROME_PRESET={CHROME_PRESET!r} ({', '.join(CHROME_PRESETS)}).", "red")); sys.exit(1)
+if MODE != "standalone" and not NODE_SECRET:
+    print(colored(f"[!] QS_MODE={MODE} needs QS_NODE_SECRET (the same on router and nodes).", "red")); sys.exit(1)
+CHROME_BIN = None if NO_BOOT or MODE == "router" else _ensure_chromium()
+
+if not NO_BOOT:
+    _start_auth_watcher()
+    _start_admission()
+    if MODE != "router":
+        _start_placement()
+        _start_video_monitor()
+        _start_metrics()
 
 if CHROME_BIN:
+    if CHROME_PREWARM: threading.Thread(target=_prewarm_chromium, daemon=True, name="prewarm").start()
     _install_fonts()
     _check_and_install_libs(CHROME_BIN)
 
 STACK_OK = False
-if CHROME_BIN:
-    STACK_OK = _start_full_stack(CURRENT_W, CURRENT_H)
+if NO_BOOT:
+    pass
+elif CHROME_BIN:
+    _start_cache_proxy()
+    if not _adopt_stack(): STACK_OK = _start_full_stack(CURRENT_W, CURRENT_H)
+    if MODE == "node":
+        if ROUTER_URL: _start_node_agent()
+        else: _log("node mode without QS_ROUTER_URL — not reporting to a router", "WARN", "node")
+elif MODE == "router":
+    _log("router mode: no local stack, sessions go to nodes", component="router")
 else:
     _log("No Chromium — stack not started", "ERROR")
 
@@ -1176,6 +4761,7 @@ else:
 # MAIN
 # ═══════════════════════════════════════════════════════════
 if __name__ == "__main__":
+    _log_flush()
     os.system('cls' if os.name == 'nt' else 'clear')
     banner = pyfiglet.figlet_format("QuantumSurf", font="slant")
     print(colored(banner, "cyan"))
@@ -1187,19 +4773,22 @@ if __name__ == "__main__":
     print(colored(f"  Architecture : {ARCH_LABEL} ({ARCH or 'UNSUPPORTED'})", "white"))
     print(colored(f"  Chromium     : {CHROME_BIN or 'NOT FOUND'}", "green" if CHROME_BIN else "red"))
     print(colored(f"  Resolution   : {CURRENT_W}x{CURRENT_H} (auto-adjustable)", "green"))
+    print(colored(f"  Preset       : {CHROME_PRESET} (QS_CHROME_PRESET)", "white"))
     print(colored(f"  x11vnc       : 127.0.0.1:{VNC_PORT} (loopback only)", "green"))
     print(colored(f"  VNC bridge   : served via Flask at /ws (auth-gated, no separate port)", "green"))
     print(colored(f"  Flask        : 0.0.0.0:{FLASK_PORT} (the only network-exposed port)", "green"))
     print(colored(f"  Container    : {'YES' if IN_CONTAINER else 'No'}", "yellow" if IN_CONTAINER else "white"))
+    if MODE != "standalone":
+        print(colored(f"  Mode         : {MODE}" + (f" → {ROUTER_URL} as {NODE_ID}" if MODE == "node" else ""), "yellow"))
     print(colored(f"  Stack OK     : {'YES ✓' if STACK_OK else 'NO ✗'}", "green" if STACK_OK else "red"))
     print(colored("=" * 60, "cyan"))
     print()
     print(colored(f"  → Login:    http://0.0.0.0:{FLASK_PORT}", "green", attrs=["bold"]))
     print(colored(f"  → Default:  admin / admin (or auth.txt)", "magenta"))
     print()
-    if not CHROME_BIN:
+    if not CHROME_BIN and MODE != "router":
         print(colored("[!] FATAL: Could not find or install Chromium!","red"))
         sys.exit(1)
-    if not STACK_OK:
+    if not STACK_OK and MODE != "router":
         print(colored("[!] Stack incomplete — use ⚙ RES → RESTART STACK in GUI","yellow"))
     app.run(host="0.0.0.0", port=FLASK_PORT, threaded=True)
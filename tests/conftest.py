@@ -0,0 +1,16 @@
+"""Tests import main.py with QS_NO_BOOT=1, like bench.py: nothing is
+installed or started."""
+import os, sys
+import pytest
+
+os.environ.setdefault("QS_NO_BOOT", "1")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import main as qs
+
+@pytest.fixture
+def client():
+    """A test client whose session is logged in as an admin."""
+    c = qs.app.test_client()
+    with c.session_transaction() as s:
+        s.update(authenticated=True, username="admin", sid="t0000001")
+    return c
@@ -0,0 +1,71 @@
+import json, socket, subprocess, sys, threading
+
+import pytest
+
+import main as qs
+
+@pytest.fixture
+def rfb_port():
+    """A listener that greets like x11vnc."""
+    srv = socket.create_server(("127.0.0.1", 0))
+    def serve():
+        while True:
+            try: c, _ = srv.accept()
+            except OSError: return
+            c.sendall(b"RFB 003.008\n"); c.close()
+    threading.Thread(target=serve, daemon=True).start()
+    yield srv.getsockname()[1]
+    srv.close()
+
+@pytest.fixture
+def stack(monkeypatch, tmp_path, rfb_port):
+    """Three long-lived processes standing in for Xvfb, x11vnc and Chromium,
+    saved to a state file as an exiting server would."""
+    monkeypatch.setattr(qs, "ADOPT", True)
+    monkeypatch.setattr(qs, "STATE_FILE", tmp_path / "stack.json")
+    monkeypatch.setattr(qs, "VNC_PORT", rfb_port)
+    monkeypatch.setattr(qs, "_wait_for_display", lambda d, timeout=None: True)
+    for name in ("_place_stack", "_apply_affinity", "_start_resizer_thread"):
+        monkeypatch.setattr(qs, name, lambda: None)
+    monkeypatch.setattr(qs, "_start_novnc", lambda: True)
+    for name in ("CURRENT_W", "CURRENT_H", "CURRENT_DEPTH", "STACK_OK", "STACK_TIMINGS",
+                 "CHROME_PROFILE", "CHROME_LAUNCH", "_profile_owner", "_profile_loaded_for"):
+        monkeypatch.setattr(qs, name, getattr(qs, name))
+    procs = {n: subprocess.Popen([sys.executable, "-c", "import time; time.sleep(60)"])
+             for n in ("xvfb", "x11vnc", "chromium")}
+    monkeypatch.setattr(qs, "PROCS", dict(procs))
+    qs.CURRENT_W, qs.CURRENT_H, qs.CURRENT_DEPTH = 1024, 768, 16
+    qs._save_stack_state()
+    qs.PROCS.clear()   # the old server is gone
+    qs.CURRENT_W, qs.CURRENT_H, qs.CURRENT_DEPTH = 1280, 720, 24
+    yield procs
+    for p in procs.values(): p.kill(); p.wait()
+
+def test_running_stack_is_adopted(stack):
+    assert qs._adopt_stack()
+    assert {n: p.pid for n, p in qs.PROCS.items()} == {n: p.pid for n, p in stack.items()}
+    assert (qs.CURRENT_W, qs.CURRENT_H, qs.CURRENT_DEPTH) == (1024, 768, 16)
+    assert qs.CHROME_LAUNCH["adopted"] and "adopt" in qs.STACK_TIMINGS
+    assert json.loads(qs.STATE_FILE.read_text())["procs"]["x11vnc"]["pid"] == stack["x11vnc"].pid
+
+def test_reused_pid_is_not_adopted(stack):
+    state = json.loads(qs.STATE_FILE.read_text())
+    state["procs"]["chromium"]["start"] -= 1   # same PID, different process
+    qs.STATE_FILE.write_text(json.dumps(state))
+    assert not qs._adopt_stack()
+    assert stack["chromium"].poll() is None                       # not ours to stop
+    assert stack["xvfb"].wait(5) is not None and stack["x11vnc"].wait(5) is not None
+    assert not qs.PROCS and not qs.STATE_FILE.exists()
+
+def test_silent_vnc_server_means_a_fresh_start(stack, monkeypatch):
+    monkeypatch.setattr(qs, "_rfb_answers", lambda port: False)
+    assert not qs._adopt_stack()
+    assert all(p.wait(5) is not None for p in stack.values())
+    assert (qs.CURRENT_W, qs.CURRENT_H) == (1280, 720)
+
+def test_adopted_process_notices_its_exit(stack):
+    p = stack["xvfb"]
+    a = qs._AdoptedProc(p.pid, qs._proc_start(p.pid))
+    assert a.poll() is None
+    a.terminate(); p.wait(5)
+    assert a.poll() == -1
@@ -0,0 +1,66 @@
+import hashlib
+
+import pytest
+
+import main as qs
+
+@pytest.fixture
+def auth(monkeypatch, tmp_path):
+    """auth.txt under tmp_path, cheap scrypt parameters, and a count of
+    scrypt calls. Returns a writer for the file."""
+    f = tmp_path / "auth.txt"
+    monkeypatch.setattr(qs, "AUTH_FILE", f)
+    monkeypatch.setattr(qs, "_auth_loaded", False)
+    monkeypatch.setattr(qs, "_auth_users", {})
+    monkeypatch.setattr(qs, "_auth_ok_cache", qs.OrderedDict())
+    monkeypatch.setattr(qs, "_DUMMY_SCRYPT", qs._scrypt_hash("dummy", n=1024))
+    calls = []
+    real = hashlib.scrypt
+    monkeypatch.setattr(qs.hashlib, "scrypt", lambda *a, **k: calls.append(1) or real(*a, **k))
+    def write(text):
+        f.write_text(text); qs._reload_auth()
+    write.calls = calls
+    return write
+
+def test_each_stored_form_verifies(auth):
+    auth(f"new:{qs._scrypt_hash('pw1', n=1024)}\nold:{qs._hash('pw2')}\nplain:pw3\n")
+    assert qs._verify_login("new", "pw1") is True
+    assert qs._verify_login("old", "pw2") is True
+    assert qs._verify_login("plain", "pw3") is True
+    assert qs._verify_login("new", "pw2") is False
+    assert qs._verify_login("nobody", "pw1") is False
+
+def test_every_check_pays_one_scrypt(auth):
+    auth(f"new:{qs._scrypt_hash('pw1', n=1024)}\nold:{qs._hash('pw2')}\n")
+    for u, p in [("new", "bad"), ("old", "pw2"), ("old", "bad"), ("nobody", "x")]:
+        del auth.calls[:]
+        qs._verify_login(u, p)
+        assert len(auth.calls) == 1, u
+
+def test_verified_password_is_cached_but_a_miss_is_not(auth):
+    auth(f"new:{qs._scrypt_hash('pw1', n=1024)}\n")
+    qs._verify_login("new", "pw1"); del auth.calls[:]
+    assert qs._verify_login("new", "pw1") is True and not auth.calls
+    assert qs._verify_login("new", "bad") is False and auth.calls
+    auth(f"new:{qs._scrypt_hash('pw9', n=1024)}\n")   # changed entry invalidates the cache
+    assert qs._verify_login("new", "pw1") is False
+
+def test_reload_follows_the_file(auth):
+    auth("a:1\n")
+    assert qs._verify_login("a", "1")
+    auth("b:2\n")
+    assert not qs._verify_login("a", "1") and qs._verify_login("b", "2")
+    qs.AUTH_FILE.unlink(); qs._reload_auth()   # no file: the admin/admin default
+    assert qs._verify_login("admin", "admin")
+
+def test_unreadable_file_keeps_the_users(auth, monkeypatch, tmp_path):
+    auth("a:1\n")
+    monkeypatch.setattr(qs, "AUTH_FILE", tmp_path)   # a directory: IsADirectoryError
+    qs._reload_auth()
+    assert qs._verify_login("a", "1")
+
+def test_full_queue_answers_none(auth, monkeypatch):
+    auth("a:1\n")
+    monkeypatch.setattr(qs, "_auth_slots", qs.threading.BoundedSemaphore(1))
+    qs._auth_slots.acquire()
+    assert qs._verify_login("a", "1") is None
@@ -0,0 +1,47 @@
+import struct
+
+import pytest
+
+import main as qs
+
+INF = float("inf")
+
+def test_equal_weights_split_evenly():
+    assert qs._waterfill(90, {"a": INF, "b": INF, "c": INF}, {"a": 1, "b": 1, "c": 1}) == \
+        pytest.approx({"a": 30, "b": 30, "c": 30})
+
+def test_what_a_capped_key_leaves_is_shared_again():
+    out = qs._waterfill(90, {"a": 10, "b": INF, "c": 100}, {"a": 1, "b": 1, "c": 1})
+    assert out == pytest.approx({"a": 10, "b": 40, "c": 40})
+
+def test_weights_scale_shares():
+    out = qs._waterfill(90, {"a": INF, "b": INF}, {"a": 2, "b": 1})
+    assert out == pytest.approx({"a": 60, "b": 30})
+    out = qs._waterfill(90, {"a": 20, "b": INF, "c": INF}, {"a": 4, "b": 1, "c": 2})
+    assert out == pytest.approx({"a": 20, "b": 70 / 3, "c": 140 / 3})
+
+def test_budget_above_demand_gives_every_cap():
+    assert qs._waterfill(100, {"a": 10, "b": 20}, {"a": 1, "b": 1}) == {"a": 10, "b": 20}
+    assert qs._waterfill(INF, {"a": INF, "b": 5}, {"a": 1, "b": 9}) == {"a": INF, "b": 5}
+
+def _fbur(incremental, x, y, w, h):
+    return struct.pack(">BBHHHH", 3, incremental, x, y, w, h)
+
+@pytest.fixture
+def conn(monkeypatch):
+    """One shaped connection with no tokens left and no refill."""
+    c = {"rate": 0.0, "tokens": -1.0, "t": 0.0, "held": None, "held_count": 0,
+         "merged": 0, "win_held": False}
+    monkeypatch.setattr(qs, "_bw_conns", {"k": c})
+    return c
+
+def test_request_over_share_is_held_and_merged(conn):
+    assert not qs._bw_request("k", _fbur(1, 0, 0, 100, 100))
+    assert not qs._bw_request("k", _fbur(0, 50, 200, 100, 10))
+    assert conn["held"] == _fbur(0, 0, 0, 150, 210)   # union, full if either is
+    assert (conn["held_count"], conn["merged"], conn["win_held"]) == (1, 1, True)
+
+def test_request_within_share_goes_through(conn):
+    conn["tokens"] = 10.0
+    assert qs._bw_request("k", _fbur(1, 0, 0, 10, 10))
+    assert qs._bw_request("unshaped", _fbur(1, 0, 0, 10, 10))
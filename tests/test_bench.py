@@ -0,0 +1,32 @@
+import json, os, subprocess, sys
+
+import bench
+
+BENCH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "bench.py")
+
+def test_compare_flags_regressions_past_threshold_and_noise():
+    base = {"login_p95_ms": 20.0, "bridge_rtt_p50_ms": 0.3, "login_per_s": 50.0,
+            "bridge_throughput_mbps": 1000.0, "novnc_page_bytes": 100_000, "note": "x"}
+    cur = {"login_p95_ms": 30.0,             # 50% slower
+           "bridge_rtt_p50_ms": 0.6,         # doubled, but under the 1 ms noise floor
+           "login_per_s": 45.0,              # 10% fewer: within threshold
+           "bridge_throughput_mbps": 500.0,  # higher is better: halved
+           "novnc_page_bytes": 90_000, "note": "y"}
+    out = bench.compare(cur, base, 0.2)
+    assert [r["metric"] for r in out] == ["login_p95_ms", "bridge_throughput_mbps"]
+    assert out[0]["change_pct"] == 50.0
+
+def _run(*args):
+    r = subprocess.run([sys.executable, BENCH, "suite", "--parts", "bridge,login", "--logins", "3",
+                        "--samples", "5", "--updates", "2", *args], capture_output=True, text=True, timeout=120)
+    return r.returncode, json.loads(r.stdout)   # stdout is one JSON document; logs go to stderr
+
+def test_suite_runs_and_compares_to_a_saved_baseline(tmp_path):
+    base = tmp_path / "base.json"
+    code, out = _run("--save-baseline", str(base))
+    assert code == 0 and out["benchmark"] == "suite" and not out["skipped"]
+    assert {"bridge_rtt_p50_ms", "bridge_throughput_mbps", "login_per_s"} <= set(out["metrics"])
+    assert json.loads(base.read_text()) == out["metrics"]
+    base.write_text(json.dumps({"login_per_s": out["metrics"]["login_per_s"] * 100}))   # only the metric under test
+    code, out = _run("--baseline", str(base))
+    assert code == 1 and [r["metric"] for r in out["regressions"]] == ["login_per_s"]
@@ -0,0 +1,54 @@
+import struct
+
+import main as qs
+
+HANDSHAKE = b"RFB 003.008\n" + b"\x01" + b"\x01"   # version, security None, ClientInit shared
+FBUR = struct.pack(">BBHHHH", 3, 1, 0, 0, 1280, 720)
+KEY = struct.pack(">BBxxI", 4, 1, 0x61)
+POINTER = struct.pack(">BBHH", 5, 0, 10, 20)
+ENCODINGS = struct.pack(">BxH3i", 2, 3, 7, 0, -223)
+CUT = struct.pack(">BxxxI", 6, 5) + b"hello"
+
+def _types(parts):
+    return [t for t, _ in parts]
+
+def _connected():
+    s = qs._RfbClientStream()
+    assert _types(s.feed(HANDSHAKE)) == [None, None, None]
+    return s
+
+def test_handshake_is_passed_through_unparsed():
+    s = qs._RfbClientStream()
+    parts = s.feed(HANDSHAKE + FBUR)
+    assert parts == [(None, HANDSHAKE[:12]), (None, b"\x01"), (None, b"\x01"), (3, FBUR)]
+
+def test_vnc_auth_response_is_skipped():
+    s = qs._RfbClientStream()
+    parts = s.feed(b"RFB 003.008\n" + b"\x02" + b"r" * 16 + b"\x01" + KEY)
+    assert _types(parts) == [None, None, None, None, 4]
+
+def test_batched_frame_is_cut_into_messages():
+    s = _connected()
+    parts = s.feed(KEY + FBUR + POINTER + ENCODINGS + CUT)
+    assert parts == [(4, KEY), (3, FBUR), (5, POINTER), (2, ENCODINGS), (6, CUT)]
+
+def test_message_split_across_frames_waits_for_the_rest():
+    s = _connected()
+    assert s.feed(KEY + FBUR[:4]) == [(4, KEY)]
+    assert s.feed(FBUR[4:] + ENCODINGS[:2]) == [(3, FBUR)]   # type known, length not yet
+    assert s.feed(ENCODINGS[2:]) == [(2, ENCODINGS)]
+
+def test_extended_clipboard_has_negative_length():
+    s = _connected()
+    ext = struct.pack(">Bxxxi", 6, -4) + b"\x00\x00\x00\x01"
+    assert s.feed(ext + KEY) == [(6, ext), (4, KEY)]
+
+def test_unknown_type_passes_the_rest_through():
+    s = _connected()
+    assert s.feed(KEY + b"\x7f\x01\x02") == [(4, KEY), (None, b"\x7f\x01\x02")]
+    assert s.unknown == 0x7f
+    assert s.feed(FBUR) == [(None, FBUR)]
+
+def test_rfb_33_client_is_not_parsed():
+    s = qs._RfbClientStream()
+    assert s.feed(b"RFB 003.003\n" + b"\x01" + FBUR) == [(None, b"RFB 003.003\n"), (None, b"\x01" + FBUR)]
@@ -0,0 +1,69 @@
+import shutil
+
+import pytest
+
+import main as qs
+
+def _flag(args, name):
+    return [a.split("=", 1)[1] for a in args if a.startswith(name + "=")]
+
+@pytest.mark.parametrize("name", sorted(qs.CHROME_PRESETS))
+def test_each_preset_passes_one_disable_features_flag(name):
+    args = qs._chrome_preset_args(name)
+    assert len(_flag(args, "--disable-features")) == 1   # Chromium honours only the last one
+    assert int(_flag(args, "--disk-cache-size")[0]) == qs.CHROME_PRESETS[name]["disk_cache_mb"] << 20
+
+def test_density_trades_isolation_and_gl_for_memory():
+    args = qs._chrome_preset_args("density")
+    assert "--disable-site-isolation-trials" in args and "--disable-3d-apis" in args
+    assert {"IsolateOrigins", "site-per-process", "Translate"} <= set(_flag(args, "--disable-features")[0].split(","))
+    assert _flag(args, "--renderer-process-limit") == ["2"]
+
+def test_fidelity_keeps_webgl_and_no_renderer_limit():
+    args = qs._chrome_preset_args("fidelity")
+    assert "--enable-unsafe-swiftshader" in args and not _flag(args, "--renderer-process-limit")
+    assert "--disable-site-isolation-trials" not in args
+
+class _Proc:
+    pid, returncode = 4242, None
+    def __init__(self, alive=True): self.alive = alive
+    def poll(self): return None if self.alive else 1
+
+@pytest.fixture
+def launch(monkeypatch, tmp_path):
+    """_launch_chromium with the process, window wait and profile I/O faked.
+    Returns the list of spawned argument lists."""
+    spawned = []
+    monkeypatch.setattr(qs, "CHROME_BIN", "/usr/bin/chromium")
+    monkeypatch.setattr(qs, "PROFILE_SNAPSHOTS", False)
+    monkeypatch.setattr(qs, "TRANSFER_ROOT", tmp_path)
+    monkeypatch.setattr(qs, "_watch_dir", lambda *a, **k: None)
+    monkeypatch.setattr(qs, "_transfer_watched", set())
+    monkeypatch.setattr(qs, "_spawn", lambda name, args, env: spawned.append(args) or _Proc())
+    monkeypatch.setattr(qs, "_wait_chromium_window", lambda p: 0.4321)
+    monkeypatch.setattr(qs, "_force_resize_window", lambda w, h: None)
+    monkeypatch.setattr(qs, "_proxy_url", None)
+    monkeypatch.setattr(qs, "PROCS", {})
+    monkeypatch.setattr(qs, "CHROME_LAUNCH", {})
+    monkeypatch.setattr(qs, "CHROME_PROFILE", None)
+    yield spawned
+    shutil.rmtree(qs.CHROME_PROFILE, ignore_errors=True)
+
+def test_launch_uses_the_preset_and_records_time_to_window(launch):
+    assert qs._launch_chromium(1280, 720, "density")
+    args = launch[0]
+    assert args[-1] == "about:blank" and "--window-size=1280,720" in args
+    assert _flag(args, "--renderer-process-limit") == ["2"]
+    assert qs.CHROME_LAUNCH == {"preset": "density", "mapped_s": 0.432}
+    assert qs.PROCS["chromium"].pid == 4242
+
+def test_default_preset_comes_from_the_environment(launch, monkeypatch):
+    monkeypatch.setattr(qs, "CHROME_PRESET", "fidelity")
+    assert qs._launch_chromium(800, 600)
+    assert qs.CHROME_LAUNCH["preset"] == "fidelity"
+
+def test_window_wait_without_xdotool(monkeypatch):
+    monkeypatch.setattr(qs, "_ensure_xdotool", lambda: False)
+    monkeypatch.setattr(qs.time, "sleep", lambda s: None)
+    assert qs._wait_chromium_window(_Proc()) is not None
+    assert qs._wait_chromium_window(_Proc(alive=False)) is None
@@ -0,0 +1,167 @@
+import json, os, socket, subprocess, sys, time, http.client
+import pytest
+from flask import Flask
+from flask.sessions import SecureCookieSessionInterface
+import main as qs
+
+@pytest.fixture
+def node(monkeypatch):
+    monkeypatch.setattr(qs, "MODE", "node")
+    monkeypatch.setattr(qs, "NODE_SECRET", "s3cret")
+    qs._seen_sigs.clear()
+    return qs.app.test_client()
+
+def _signed(path, method="GET", data=b""):
+    with qs.app.test_request_context(path, method=method, data=data):
+        qs.session.update(username="alice", sid="s1")
+        return qs._node_headers(method, qs._request_target(), qs.hashlib.sha256(data).hexdigest())
+
+def test_node_accepts_a_signed_request_once(node):
+    h = _signed("/api/get_resolution")
+    assert node.get("/api/get_resolution", headers=h).status_code == 200
+    replay = qs.app.test_client()   # no session cookie from the first request
+    assert replay.get("/api/get_resolution", headers=h).status_code == 302
+
+def test_signature_is_bound_to_method_and_path(node):
+    h = _signed("/api/get_resolution")
+    assert node.post("/api/set_resolution", headers=h, json={"width":1280,"height":720}).status_code == 401
+    assert node.get("/api/get_resolution?x=1", headers=h).status_code == 302
+
+def test_signature_is_bound_to_the_body(node):
+    h = _signed("/api/set_resolution", "POST", b'{"width":1280,"height":720}')
+    h["Content-Type"] = "application/json"
+    r = node.post("/api/set_resolution", headers=h, data=b'{"width":3840,"height":2160}')
+    assert r.status_code == 401
+
+def test_stale_or_unsigned_headers_are_ignored(node):
+    h = _signed("/api/get_resolution")
+    h["X-QS-Time"] = str(float(h["X-QS-Time"]) - 60)
+    assert node.get("/api/get_resolution", headers=h).status_code == 302
+    assert node.get("/api/get_resolution").status_code == 302
+
+def test_signed_upload_chunk_over_max_body(node, monkeypatch, tmp_path):
+    monkeypatch.setattr(qs, "TRANSFER_ROOT", tmp_path)
+    blob = bytes(range(256)) * 400   # over MAX_BODY
+    h = _signed("/api/files/uploads/a.bin", "PUT", blob)
+    r = node.put("/api/files/uploads/a.bin", headers=h, data=blob)
+    assert r.status_code == 200 and r.json["done"]
+    h = _signed("/api/files/uploads/b.bin", "PUT", blob)
+    assert qs.app.test_client().put("/api/files/uploads/b.bin", headers=h, data=blob[::-1]).status_code == 302
+
+# One router and two QS_NO_BOOT nodes as real processes on localhost, with a
+# fast heartbeat so a killed node is declared dead within a couple of seconds.
+
+HEARTBEAT = 0.5
+_RUN = ("import logging, os, main\n"
+        "logging.getLogger('werkzeug').setLevel(logging.ERROR)\n"
+        "main.app.secret_key = os.environ['T_SECRET_KEY']\n"
+        f"main.NODE_HEARTBEAT = {HEARTBEAT}\n"
+        "if main.MODE == 'node': main.STACK_OK = True; main._start_node_agent()\n"
+        "main.app.run(host='127.0.0.1', port=main.FLASK_PORT, threaded=True)")
+
+def _port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0)); return s.getsockname()[1]
+
+def _wait(pred, timeout=15):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if pred(): return True
+        time.sleep(0.05)
+    return False
+
+class _Cluster:
+    def __init__(self, tmp):
+        self.key, self.tmp, self.procs = os.urandom(16).hex(), tmp, {}
+        self.router = _port()
+        self.spawn("router", self.router)
+
+    def spawn(self, name, port, **env):
+        env = dict(os.environ, QS_NO_BOOT="1", QS_NODE_SECRET="s3cret", QS_PORT=str(port),
+                   T_SECRET_KEY=self.key, QS_MODE="router" if name == "router" else "node",
+                   QS_ROUTER_URL=f"http://127.0.0.1:{self.router}", QS_NODE_ID=name,
+                   QS_DISPLAY=str(port % 1000 + 2000), QS_TRANSFER_DIR=str(self.tmp / name), **env)
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        self.procs[name] = subprocess.Popen([sys.executable, "-c", _RUN], cwd=root, env=env,
+                                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    def kill(self, name):
+        p = self.procs.pop(name); p.kill(); p.wait()
+
+    def client(self, user, sid):
+        app = Flask("t"); app.secret_key = self.key
+        cookie = SecureCookieSessionInterface().get_signing_serializer(app).dumps(
+            {"authenticated":True, "username":user, "sid":sid})
+        return _Client(self.router, cookie)
+
+    def nodes(self):
+        s, body = self.client("admin", "observer").get("/api/nodes")
+        return {n["id"]: n["load"] for n in body["nodes"]} if s == 200 else {}
+
+class _Client:
+    def __init__(self, port, cookie): self.port, self.cookie = port, cookie
+
+    def get(self, path): return self.request("GET", path)
+
+    def request(self, method, path, body=None, headers=None, raw=False):
+        c = http.client.HTTPConnection("127.0.0.1", self.port, timeout=10)
+        try:
+            c.request(method, path, body, dict(headers or {}, Cookie=f"session={self.cookie}"))
+            r = c.getresponse(); body = r.read()
+        except OSError: return None, None
+        finally: c.close()
+        for v in r.headers.get_all("Set-Cookie") or []:
+            if v.startswith("session="): self.cookie = v.split(";")[0][8:]
+        if raw: return r.status, body
+        try: return r.status, json.loads(body)
+        except ValueError: return r.status, None
+
+@pytest.fixture(scope="module")
+def cluster(tmp_path_factory):
+    c = _Cluster(tmp_path_factory.mktemp("cluster"))
+    for name in ("n1", "n2"): c.spawn(name, _port(), QS_NODE_SLOTS="2")
+    try:
+        assert _wait(lambda: set(c.nodes()) == {"n1", "n2"}), "nodes never reported"
+        yield c
+    finally:
+        for name in list(c.procs): c.kill(name)
+
+def test_cluster_places_queues_and_moves_sessions(cluster):
+    a, b = cluster.client("alice", "a1"), cluster.client("bob", "b1")
+    assert a.get("/api/get_resolution")[0] == 200
+    assert b.get("/api/get_resolution")[0] == 200
+    loads = cluster.nodes()
+    assert loads == {"n1":1, "n2":1}   # spread: the least-loaded node wins
+
+    # n1 dies: the session placed there moves to n2 on its next request.
+    cluster.kill("n1")
+    assert _wait(lambda: set(cluster.nodes()) == {"n2"})
+    for c in (a, b): assert c.get("/api/get_resolution")[0] == 200
+    assert cluster.nodes() == {"n2":2}
+
+    # n2 is full now: new sessions wait in line, first come first served.
+    c, d = cluster.client("carol", "c1"), cluster.client("dave", "d1")
+    s, body = c.get("/api/get_resolution")
+    assert (s, body["position"]) == (503, 1)
+    s, body = d.get("/api/get_resolution")
+    assert (s, body["position"], body["waiting"]) == (503, 2, 2)
+    assert c.get("/api/get_resolution")[1]["position"] == 1
+
+    # A node with room comes back: carol, then dave, get its slots.
+    cluster.spawn("n1", _port(), QS_NODE_SLOTS="1")
+    assert _wait(lambda: "n1" in cluster.nodes())
+    assert c.get("/api/get_resolution")[0] == 200
+    s, body = d.get("/api/get_resolution")
+    assert (s, body["position"]) == (503, 1)
+
+def test_cluster_carries_chunked_uploads_and_ranges(cluster):
+    a = cluster.client("alice", "a1")
+    blob = os.urandom(100_000)   # chunks over the router's MAX_BODY
+    s, body = a.request("PUT", "/api/files/uploads/x.bin", blob[:50_000],
+                        {"Content-Range":"bytes 0-49999/100000"})
+    assert (s, body["received"]) == (200, 50_000)
+    s, body = a.request("PUT", "/api/files/uploads/x.bin", blob[50_000:],
+                        {"Content-Range":"bytes 50000-99999/100000"})
+    assert (s, body["done"]) == (200, True)
+    assert a.request("GET", "/api/files/uploads/x.bin", headers={"Range":"bytes=10-19"}, raw=True) \
+        == (206, blob[10:20])
@@ -0,0 +1,44 @@
+import threading
+
+import pytest
+
+import main as qs
+
+@pytest.fixture
+def spinner():
+    """A thread named "spinner" serving session s9, busy in spin()."""
+    stop = threading.Event()
+    def spin():
+        qs._thread_sessions[threading.get_ident()] = "s9"
+        while not stop.is_set(): sum(range(1000))
+        qs._thread_sessions.pop(threading.get_ident(), None)
+    t = threading.Thread(target=spin, name="spinner"); t.start()
+    yield t
+    stop.set(); t.join()
+
+def test_thread_dump_names_threads_and_sessions(spinner, client):
+    r = client.get("/api/admin/threads")
+    assert r.status_code == 200 and r.headers["Cache-Control"] == "no-store"
+    assert "spinner[s9]" in r.get_data(as_text=True)
+
+def test_profile_collapses_stacks(spinner):
+    counts, samples, cpu = qs._profile(0.3, 50)
+    assert 5 <= samples <= 20
+    mine = [k for k in counts if k.startswith("spinner[s9];")]
+    assert mine and all("test_diag.py:spin" in k for k in mine)
+    assert not any(k.split(";")[-1] == "main.py:_profile" for k in counts)   # not itself
+
+def test_profile_endpoint(client):
+    r = client.get("/api/admin/profile?seconds=1&hz=20")
+    assert r.status_code == 200 and int(r.headers["X-Profile-Samples"]) >= 15
+    assert r.headers["X-Profile-Overhead"].endswith("%")
+    assert client.get("/api/admin/profile?hz=x").status_code == 400
+
+def test_one_profile_at_a_time(client):
+    with qs._profile_lock:
+        assert client.get("/api/admin/profile?seconds=1").status_code == 409
+
+def test_admins_only(client):
+    with client.session_transaction() as s: s["username"] = "guest"
+    assert client.get("/api/admin/threads").status_code == 403
+    assert client.get("/api/admin/profile").status_code == 403
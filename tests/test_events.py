@@ -0,0 +1,49 @@
+import json
+
+import pytest
+
+import main as qs
+
+@pytest.fixture
+def subs(monkeypatch):
+    monkeypatch.setattr(qs, "_subscribers", set())
+    monkeypatch.setattr(qs, "_watcher_running", True)   # no stack poller thread
+    return qs._subscribers
+
+def _events(chunks):
+    out = []
+    for c in chunks:
+        lines = dict(l.split(": ", 1) for l in c.strip().split("\n") if ": " in l)
+        if "event" in lines: out.append((lines["event"], json.loads(lines["data"])))
+    return out
+
+def test_publish_fans_out(subs):
+    a, b = qs._Subscriber(), qs._Subscriber()
+    subs.update((a, b))
+    qs._publish("op", {"id": "x"})
+    assert a.q.get_nowait() == b.q.get_nowait() == 'event: op\ndata: {"id":"x"}\n\n'
+
+def test_slow_subscriber_is_cut_loose(subs):
+    slow, fast = qs._Subscriber(), qs._Subscriber()
+    subs.update((slow, fast))
+    for i in range(257):
+        qs._publish("log", {"i": i})
+        while not fast.q.empty(): fast.q.get_nowait()
+    assert slow.dropped and slow not in subs
+    assert not fast.dropped and fast in subs
+
+def test_stream_sends_snapshot_then_pushes(subs, client):
+    r = client.get("/api/events", buffered=False)
+    assert r.mimetype == "text/event-stream"
+    it = (c.decode() for c in r.response)
+    assert next(it).startswith("retry:")
+    event, state = _events([next(it)])[0]
+    assert event == "stack" and {"stack_ok", "width", "height", "depth"} <= set(state)
+    assert len(subs) == 1
+    qs._publish("op", {"id": "y"})
+    while True:   # the log backlog comes first
+        got = _events([next(it)])
+        if got and got[0][0] == "op": break
+    assert got == [("op", {"id": "y"})]
+    r.close()
+    assert not subs
@@ -0,0 +1,36 @@
+import pytest
+
+import main as qs
+
+@pytest.fixture
+def lat(monkeypatch):
+    monkeypatch.setattr(qs, "_latency", qs.OrderedDict())
+    return qs._lat_session("t0000001")
+
+@pytest.mark.parametrize("body", ["[]", "1", "null", '{"samples": {}}', '{"samples": "x"}', "{}", "not json"])
+def test_malformed_post_is_400(lat, client, body):
+    r = client.post("/api/latency", data=body, content_type="application/json")
+    assert r.status_code == 400
+
+def test_client_sample_joins_the_bridge_timing(lat, client):
+    qs._lat_bridge(lat, 7, 10.0, 10.001, 10.011, 10.012)   # 12 ms in the bridge and x11vnc
+    samples = [{"n": 7, "input": 2, "rtt": 30, "paint": 5},
+               {"n": 8, "input": 2, "rtt": 30, "paint": 5},     # no bridge timing for message 8
+               {"n": 9, "input": -1, "rtt": 30, "paint": 5},    # out of range
+               {"n": "x"}, "not a dict"]
+    assert client.post("/api/latency", json={"samples": samples}).json == {"status": "ok"}
+    stages = client.get("/api/latency").json["stages"]
+    assert {k: v["count"] for k, v in stages.items()} == \
+        {"input": 2, "bridge_in": 1, "vnc": 1, "bridge_out": 1, "network": 1, "paint": 2, "total": 2}
+    assert stages["network"]["p50"] == _upper(30 - 12)   # reported as the bucket's upper bound
+    assert stages["vnc"]["p50"] == _upper(10)
+
+def _upper(ms):
+    return round(min(b for b in qs._LAT_BOUNDS if b >= ms), 2)
+
+def test_percentiles_come_from_the_buckets(lat):
+    for ms in [1] * 50 + [100] * 45 + [1000] * 5:
+        qs._lat_add(lat, "total", ms)
+    view = qs._lat_view(lat)["total"]
+    assert view["count"] == 100
+    assert view["p50"] < 1.25 and 100 <= view["p95"] < 125 and 1000 <= view["p99"] < 1250
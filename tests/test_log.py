@@ -0,0 +1,83 @@
+import dis, itertools, queue, sys, threading
+
+import pytest
+
+import main as qs
+
+@pytest.fixture
+def ring(monkeypatch):
+    """An empty log ring of 64 slots."""
+    def use(capacity):
+        monkeypatch.setattr(qs, "LOG_CAPACITY", capacity)
+        monkeypatch.setattr(qs, "_log_ring", [None] * capacity)
+    use(64)
+    monkeypatch.setattr(qs, "_log_seq", itertools.count(1))
+    monkeypatch.setattr(qs, "_log_head", 0)
+    monkeypatch.setattr(qs, "_console_q", queue.Queue(maxsize=1))
+    return use
+
+def _msgs(recs):
+    return [r[5] for r in recs]
+
+def test_newest_page_then_cursor(ring):
+    for i in range(10): qs._log(str(i))
+    recs, cursor = qs._log_read(None, 3)
+    assert (_msgs(recs), cursor) == (["7", "8", "9"], 10)
+    qs._log("10"); qs._log("11")
+    assert qs._log_read(cursor, 30) == (qs._log_read(None, 2)[0], 12)
+    assert qs._log_read(12, 30) == ([], 12)
+
+def test_filters(ring):
+    qs._log("a", "WARN", "bridge", "s1"); qs._log("b", "INFO", "bridge", "s2"); qs._log("c", "ERROR", "ops")
+    assert _msgs(qs._log_read(None, 30, min_level="WARN")[0]) == ["a", "c"]
+    assert _msgs(qs._log_read(None, 30, component="bridge", session="s2")[0]) == ["b"]
+
+def test_overwritten_records_are_gone(ring):
+    for i in range(70): qs._log(str(i))
+    recs, _ = qs._log_read(0, 100)
+    assert _msgs(recs)[0] == "6" and len(recs) == 64
+
+def test_concurrent_writers_never_lose_records(ring):
+    threads, per = 8, 500
+    ring(threads * per)
+    old = sys.getswitchinterval(); sys.setswitchinterval(1e-6)
+    seen, cursor, done = [], 0, threading.Event()
+    def write(t):
+        for i in range(per): qs._log(f"{t}:{i}")
+    try:
+        ws = [threading.Thread(target=write, args=(t,)) for t in range(threads)]
+        for w in ws: w.start()
+        while not done.is_set():
+            if not any(w.is_alive() for w in ws): done.set()
+            recs, cursor = qs._log_read(cursor, 200)
+            seen += [r[0] for r in recs]
+    finally:
+        sys.setswitchinterval(old)
+    recs, cursor = qs._log_read(cursor, threads * per)
+    seen += [r[0] for r in recs]
+    assert qs._log_head == threads * per
+    assert seen == list(range(1, threads * per + 1))
+
+def test_head_never_moves_backward(ring):
+    # Stop the seq-1 writer just before it stores the head, let a seq-2
+    # writer run, then let the first one finish.
+    stores = {i.offset for i in dis.get_instructions(qs._log)
+              if i.opname == "STORE_GLOBAL" and i.argval == "_log_head"}
+    paused, resume = threading.Event(), threading.Event()
+    def tracer(frame, event, arg):
+        if frame.f_code is not qs._log.__code__: return None
+        frame.f_trace_opcodes = True
+        def at(frame, event, arg):
+            if event == "opcode" and frame.f_lasti in stores:
+                paused.set(); resume.wait(5)
+            return at
+        return at
+    def first():
+        sys.settrace(tracer); qs._log("1"); sys.settrace(None)
+    a = threading.Thread(target=first); a.start()
+    assert paused.wait(5)
+    b = threading.Thread(target=qs._log, args=("2",)); b.start()
+    b.join(0.2)
+    resume.set(); a.join(); b.join()
+    assert qs._log_head == 2
+    assert _msgs(qs._log_read(None, 30)[0]) == ["1", "2"]
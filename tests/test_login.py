@@ -0,0 +1,54 @@
+import pytest
+
+import main as qs
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Empty rate-limit maps and a monotonic clock the test moves by hand."""
+    for _, b in qs._rate_shards: b.clear()
+    now = [1000.0]
+    monkeypatch.setattr(qs.time, "monotonic", lambda: now[0])
+    yield now
+    for _, b in qs._rate_shards: b.clear()
+
+REFILL = qs.ATTEMPT_WINDOW / qs.MAX_ATTEMPTS   # seconds per IP token
+
+def test_ip_burst_then_refill(clock):
+    for _ in range(qs.MAX_ATTEMPTS - 1): qs._record("10.0.0.1")
+    assert qs._rate_limited("10.0.0.1") == 0
+    qs._record("10.0.0.1")
+    assert qs._rate_limited("10.0.0.1") == pytest.approx(REFILL)
+    clock[0] += REFILL / 2
+    assert qs._rate_limited("10.0.0.1") == pytest.approx(REFILL / 2)
+    clock[0] += REFILL / 2
+    assert qs._rate_limited("10.0.0.1") == 0
+    assert qs._rate_limited("10.0.0.2") == 0
+
+def test_username_bucket_only_gates_failing_ips(clock):
+    for i in range(qs.USER_MAX_ATTEMPTS): qs._record(f"10.1.{i}.1", "admin")
+    assert qs._rate_limited("10.2.0.1", "admin") == 0      # the owner, no failures of their own
+    assert qs._rate_limited("10.1.0.1", "admin") == pytest.approx(qs.ATTEMPT_WINDOW / qs.USER_MAX_ATTEMPTS)
+    assert qs._rate_limited("10.1.0.1", "someone") == 0
+
+def test_peek_never_inserts_and_full_buckets_are_dropped(clock):
+    assert qs._rate_limited("10.0.0.1", "admin") == 0
+    assert qs._rate_tracked() == 0
+    qs._record("10.0.0.1", "admin")
+    assert qs._rate_tracked() == 2
+    clock[0] += qs.ATTEMPT_WINDOW
+    qs._rate_limited("10.0.0.1", "admin")
+    assert qs._rate_tracked() == 1   # the username bucket is only peeked once the IP is clean
+
+def test_capacity_evicts_least_recent(clock, monkeypatch):
+    monkeypatch.setattr(qs, "RATE_CAPACITY", qs.RATE_SHARDS * 2)
+    for i in range(200): qs._record(f"10.3.{i // 256}.{i % 256}")
+    assert qs._rate_tracked() <= qs.RATE_SHARDS * 3
+
+def test_login_429_carries_the_real_wait(clock):
+    c = qs.app.test_client()
+    for _ in range(qs.MAX_ATTEMPTS): qs._record("127.0.0.1")
+    clock[0] += REFILL / 2
+    r = c.post("/login", data={"username": "admin", "password": "x"})
+    assert r.status_code == 429
+    assert r.headers["Retry-After"] == str(round(REFILL / 2))
+    assert f"Wait {r.headers['Retry-After']}s" in r.get_data(as_text=True)
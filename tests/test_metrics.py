@@ -0,0 +1,63 @@
+import math
+
+import pytest
+
+import main as qs
+
+@pytest.fixture
+def levels(monkeypatch):
+    """Two small levels: 4 one-second slots, 3 four-second slots."""
+    monkeypatch.setattr(qs, "METRIC_LEVELS", (("1s", 1, 4), ("4s", 4, 3)))
+
+def test_ring_keeps_the_newest_slots(levels):
+    s = qs._Series(("a",))
+    for t in range(10): s.add(t, (t,))
+    assert s.query(0, 0, 100, ["a"]) == ([6, 7, 8, 9], {"a": [6, 7, 8, 9]})
+
+def test_skipped_buckets_do_not_show_stale_values(levels):
+    s = qs._Series(("a",))
+    for t in range(4): s.add(t, (t,))
+    s.add(6, (6,))   # slots for 4 and 5 still hold 0 and 1
+    assert s.query(0, 0, 100, ["a"]) == ([3, 6], {"a": [3, 6]})
+    s.add(100, (100,))   # further than a whole ring
+    assert s.query(0, 0, 1000, ["a"]) == ([100], {"a": [100]})
+
+def test_coarse_level_averages_closed_buckets(levels):
+    s = qs._Series(("a", "b"))
+    for t in range(4): s.add(t, (t, 10))
+    assert s.query(1, 0, 100, ["a"]) == ([], {"a": []})   # bucket still open
+    s.add(4, (0, 0))
+    assert s.query(1, 0, 100, ["a", "b"]) == ([0], {"a": [1.5], "b": [10]})
+    for t in range(5, 20): s.add(t, (t, 0))
+    assert s.query(1, 0, 100, ["a"])[0] == [4, 8, 12]   # ring of 3; 16 still open
+
+def test_query_window_and_partial_gaps(levels):
+    s = qs._Series(("a", "b"))
+    s.add(1, (1, math.nan)); s.add(2, (2, 2)); s.add(3, (3, 3))
+    assert s.query(0, 2, 2.9, ["a", "b"]) == ([2], {"a": [2], "b": [2]})
+    assert s.query(0, 1.5, 2, ["a"])[0] == [1, 2]   # buckets overlapping the window
+    assert s.query(0, 0, 1, ["b", "a"]) == ([1], {"b": [None], "a": [1]})
+
+def test_reset_forgets_everything(levels):
+    s = qs._Series(("a",))
+    for t in range(6): s.add(t, (t,))
+    s.reset()
+    assert s.query(0, 0, 100, ["a"]) == ([], {"a": []})
+    assert s.nbytes() == 4 * (4 + 3) + 8 * 2
+
+@pytest.fixture
+def stack_series(monkeypatch):
+    s = qs._Series(qs.STACK_FIELDS)
+    monkeypatch.setattr(qs, "METRICS", True)
+    monkeypatch.setattr(qs, "_metrics_stack", s)
+    return s
+
+@pytest.mark.parametrize("query", ["from=nan", "to=inf", "last=-inf", "from=x", "res=2s", "fields=nope"])
+def test_bad_queries_are_400(stack_series, client, query):
+    assert client.get("/api/metrics?" + query).status_code == 400
+
+def test_metrics_serves_the_stack_series(stack_series, client):
+    stack_series.add(1000, [5] * len(qs.STACK_FIELDS))
+    r = client.get("/api/metrics?from=990&to=1010&res=1s&fields=cpu_pct")
+    assert (r.json["t"], r.json["values"]) == ([1000], {"cpu_pct": [5]})
+    assert client.get("/api/metrics?session=other").status_code in (403, 404)
@@ -0,0 +1,22 @@
+import main as qs
+
+def test_cpulist_ranges_and_singles():
+    assert qs._cpulist("0-3,8,10-11\n") == [0, 1, 2, 3, 8, 10, 11]
+    assert qs._cpulist("") == []
+
+def test_pick_cpus_prefers_unclaimed_cores_on_one_node(monkeypatch):
+    monkeypatch.setattr(qs, "_core_busy", {})
+    topo = {0:[0, 1, 2, 3], 1:[4, 5, 6, 7]}
+    assert qs._pick_cpus(topo, [], 2) == (0, [0, 1])
+    assert qs._pick_cpus(topo, [{"cpus":[0, 1]}], 2) == (1, [4, 5])   # the emptier node
+    assert qs._pick_cpus(topo, [{"cpus":[0, 1]}, {"cpus":[4, 5]}], 2) == (0, [2, 3])
+
+def test_pick_cpus_skips_busy_cores(monkeypatch):
+    monkeypatch.setattr(qs, "_core_busy", {0:90.0, 1:80.0})
+    assert qs._pick_cpus({0:[0, 1, 2, 3]}, [], 2) == (0, [2, 3])
+
+def test_prefix_does_not_reread_sysfs(monkeypatch):
+    monkeypatch.setattr(qs, "_placement", {"cpus":[2, 3], "node":0})
+    monkeypatch.setattr(qs, "_numa_topology", lambda: (_ for _ in ()).throw(AssertionError("sysfs read")))
+    prefix = qs._placement_prefix()
+    assert not prefix or "2,3" in " ".join(prefix)
@@ -0,0 +1,59 @@
+import os
+
+import pytest
+
+import main as qs
+
+@pytest.fixture
+def profile(monkeypatch, tmp_path):
+    """A store under tmp_path and a small Chromium-like profile to save."""
+    monkeypatch.setattr(qs, "PROFILE_STORE", tmp_path / "store")
+    src = tmp_path / "src"
+    for rel, data in {"Default/Cookies": b"c" * 100, "Default/Preferences": b"{}",
+                      "Default/Copy": b"c" * 100, "Local State": b"{}",
+                      "Default/Cache/data_0": b"x" * 1000, "SingletonLock": b""}.items():
+        (src / rel).parent.mkdir(parents=True, exist_ok=True)
+        (src / rel).write_bytes(data)
+    os.chmod(src / "Default/Cookies", 0o600)
+    os.utime(src / "Default/Cookies", ns=(1_000_000_000, 1_000_000_000))
+    return src
+
+def _objects(user):
+    return sorted(os.listdir(qs.PROFILE_STORE / qs._profile_key(user) / "objects"))
+
+def test_restore_gives_back_files_modes_and_mtimes(profile, tmp_path):
+    s = qs._profile_snapshot(profile, "alice")
+    assert s["files"] == 4 and len(_objects("alice")) == 2   # Cookies and Copy share an object
+    dst = tmp_path / "dst"
+    assert qs._profile_restore("alice", dst)["files"] == 4
+    assert (dst / "Default/Cookies").read_bytes() == b"c" * 100
+    st = os.stat(dst / "Default/Cookies")
+    assert (st.st_mode & 0o777, st.st_mtime_ns) == (0o600, 1_000_000_000)
+    assert not (dst / "Default/Cache").exists() and not (dst / "SingletonLock").exists()
+
+def test_unchanged_files_are_not_read_again(profile):
+    qs._profile_snapshot(profile, "alice")
+    assert qs._profile_snapshot(profile, "alice")["read_bytes"] == 0
+    (profile / "Default/Preferences").write_bytes(b'{"a":1}')
+    os.utime(profile / "Default/Preferences", ns=(2_000_000_000, 2_000_000_000))
+    assert qs._profile_snapshot(profile, "alice")["read_bytes"] == 7
+
+def test_unreferenced_objects_are_pruned(profile):
+    qs._profile_snapshot(profile, "alice")
+    before = _objects("alice")
+    (profile / "Default/Cookies").unlink(); (profile / "Default/Copy").unlink()
+    qs._profile_snapshot(profile, "alice")
+    assert len(_objects("alice")) == len(before) - 1
+
+def test_over_the_limit_keeps_the_previous_snapshot(profile, monkeypatch, tmp_path):
+    qs._profile_snapshot(profile, "alice")
+    (profile / "Default/Big").write_bytes(os.urandom(4096))
+    monkeypatch.setattr(qs, "PROFILE_MAX_BYTES", 1024)
+    assert qs._profile_snapshot(profile, "alice") is None
+    dst = tmp_path / "dst"
+    qs._profile_restore("alice", dst)
+    assert not (dst / "Default/Big").exists() and (dst / "Default/Cookies").exists()
+
+def test_users_are_kept_apart(profile, tmp_path):
+    qs._profile_snapshot(profile, "alice")
+    assert qs._profile_restore("bob", tmp_path / "dst") is None
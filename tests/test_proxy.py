@@ -0,0 +1,78 @@
+import http.client, http.server, threading, time
+import pytest
+import main as qs
+
+class _Origin(http.server.BaseHTTPRequestHandler):
+    """Stand-in origin: each path answers with one caching policy."""
+    protocol_version = "HTTP/1.1"
+    POLICIES = {
+        "/static":  [("Cache-Control", "max-age=60"), ("ETag", '"v1"')],
+        "/etag":    [("Cache-Control", "no-cache"), ("ETag", '"v1"')],
+        "/cookie":  [("Cache-Control", "max-age=60"), ("Set-Cookie", "id=1")],
+        "/private": [("Cache-Control", "private, max-age=60")],
+    }
+    hits = []
+
+    def do_GET(self):
+        self.hits.append((self.path, self.headers.get("If-None-Match")))
+        if self.path == "/etag" and self.headers.get("If-None-Match") == '"v1"':
+            self.send_response(304); self.send_header("ETag", '"v1"'); self.end_headers(); return
+        body = f"body of {self.path}".encode()
+        self.send_response(200)
+        for k, v in self.POLICIES[self.path]: self.send_header(k, v)
+        self.send_header("Content-Length", str(len(body))); self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *a): pass
+
+def _serve(handler):
+    srv = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    srv.daemon_threads = True
+    threading.Thread(target=srv.serve_forever, args=(0.05,), daemon=True).start()
+    return srv
+
+@pytest.fixture
+def proxy(monkeypatch, tmp_path):
+    monkeypatch.setattr(qs, "PROXY_CACHE_DIR", tmp_path)
+    qs._proxy_index.clear(); qs._proxy_bytes = 0
+    _Origin.hits = []
+    origin, px = _serve(_Origin), _serve(qs._ProxyHandler)
+    base = f"http://127.0.0.1:{origin.server_address[1]}"
+    def get(path):
+        c = http.client.HTTPConnection("127.0.0.1", px.server_address[1], timeout=5)
+        c.request("GET", base + path)
+        r = c.getresponse(); body = r.read(); c.close()
+        return r.status, body
+    yield get
+    origin.shutdown(); px.shutdown()
+
+def _stored(n=1):
+    """Wait for the proxy thread to publish the entry it just relayed."""
+    deadline = time.monotonic() + 5
+    while len(qs._proxy_index) < n and time.monotonic() < deadline: time.sleep(0.01)
+    return len(qs._proxy_index) >= n
+
+def _delta(before, name): return qs._proxy_view()[name] - before[name]
+
+def test_fresh_response_is_served_from_cache(proxy):
+    before = qs._proxy_view()
+    assert proxy("/static") == (200, b"body of /static")
+    assert _stored()
+    assert proxy("/static") == (200, b"body of /static")
+    assert _Origin.hits == [("/static", None)]
+    assert (_delta(before, "misses"), _delta(before, "hits")) == (1, 1)
+
+def test_no_cache_response_is_revalidated_with_if_none_match(proxy):
+    before = qs._proxy_view()
+    assert proxy("/etag") == (200, b"body of /etag")
+    assert _stored()
+    assert proxy("/etag") == (200, b"body of /etag")
+    assert _Origin.hits == [("/etag", None), ("/etag", '"v1"')]
+    assert _delta(before, "revalidated") == 1
+
+@pytest.mark.parametrize("path", ["/cookie", "/private"])
+def test_personal_responses_are_not_stored(proxy, path):
+    before = qs._proxy_view()
+    proxy(path); proxy(path)
+    assert [p for p, _ in _Origin.hits] == [path, path]
+    assert _delta(before, "uncacheable") == 2 and not qs._proxy_index
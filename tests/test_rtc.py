@@ -0,0 +1,39 @@
+import pytest
+
+import main as qs
+
+OFFER = {"type": "offer", "sdp": "v=0\r\n"}
+
+@pytest.fixture
+def rtc(monkeypatch):
+    """WebRTC on, aiortc replaced by a canned answer; set ["fail"] to make it raise."""
+    answer = {"fail": None}
+    def run(coro, timeout=20):
+        if answer["fail"]: raise answer["fail"]
+        return {"type": "answer", "sdp": "v=0\r\n"}
+    monkeypatch.setattr(qs, "_rtc_available", lambda: True)
+    monkeypatch.setattr(qs, "_rtc_answer", lambda offer, sid: None)
+    monkeypatch.setattr(qs, "_rtc_run", run)
+    monkeypatch.setattr(qs, "_latency", qs.OrderedDict())
+    return answer
+
+@pytest.mark.parametrize("body", ["[]", '"offer"', "null", "{}", '{"type": "answer", "sdp": "x"}',
+                                  '{"type": "offer", "sdp": 1}', "not json"])
+def test_malformed_offer_is_400(rtc, client, body):
+    assert client.post("/api/rtc", data=body, content_type="application/json").status_code == 400
+
+def test_offer_is_answered_and_old_bridge_timings_dropped(rtc, client):
+    qs._lat_bridge(qs._lat_session("t0000001"), 1, 0, 0, 0, 0)
+    r = client.post("/api/rtc", json=OFFER)
+    assert (r.status_code, r.json["type"]) == (200, "answer")
+    assert not qs._lat_session("t0000001")["conn"]
+
+def test_failed_negotiation_is_400(rtc, client):
+    rtc["fail"] = RuntimeError("no ICE")
+    r = client.post("/api/rtc", json=OFFER)
+    assert r.status_code == 400 and "no ICE" in r.json["error"]
+
+def test_off_is_501(client, monkeypatch):
+    monkeypatch.setattr(qs, "_rtc_available", lambda: False)
+    assert client.post("/api/rtc", json=OFFER).status_code == 501
+    assert client.get("/api/rtc").json["available"] is False
@@ -0,0 +1,37 @@
+import struct
+
+import pytest
+
+import main as qs
+
+def _xwd(w, h, bpl):
+    """A 32 bpp little-endian XWD header, no colormap."""
+    return struct.pack(">25I", 100, 7, 2, 24, w, h, 0, 0, 32, 0, 32, 32, bpl, 4,
+                       0xff0000, 0xff00, 0xff, 8, 0, 0, w, h, 0, 0, 0)
+
+@pytest.fixture
+def fb(monkeypatch, tmp_path):
+    monkeypatch.setattr(qs, "FB_DIR", tmp_path)
+    monkeypatch.setattr(qs, "_fb_map", None)
+    path = tmp_path / "Xvfb_screen0"
+    path.write_bytes(_xwd(4, 2, 16) + bytes([0x10, 0x20, 0x30, 0]) * 8)
+    yield path
+    if qs._fb_map: qs._fb_map[1].close()
+
+def test_header_is_reparsed_when_xvfb_rewrites_it_in_place(fb):
+    first = qs._fb_open()
+    assert (first[2]["pixmap_width"], first[2]["pixmap_height"]) == (4, 2)
+    assert qs._fb_open() is first   # nothing changed: same mapping, no re-parse
+    with open(fb, "r+b") as f: f.write(_xwd(2, 4, 8))   # same inode and size
+    again = qs._fb_open()
+    assert again[1] is first[1]
+    assert (again[2]["pixmap_width"], again[2]["pixmap_height"], again[2]["bytes_per_line"]) == (2, 4, 8)
+
+def test_thumbnail_reads_pixels_through_the_mapping(fb):
+    w, h, rgb = qs._fb_thumbnail(16)
+    assert (w, h) == (4, 2)
+    assert rgb[1:4] == bytes([0x30, 0x20, 0x10])   # after the PNG filter byte; BGRX in memory
+
+def test_missing_framebuffer(fb):
+    fb.unlink()
+    assert qs._fb_open() is None
@@ -0,0 +1,122 @@
+import threading, time
+
+import pytest
+import main as qs
+
+@pytest.fixture
+def fake_stack(monkeypatch):
+    """_start_full_stack with every process stubbed out. `calls` records
+    (step, depth argument, CURRENT_DEPTH at the time)."""
+    calls, fail = [], set()
+    def xvfb(w, h, depth=None):
+        calls.append(("xvfb", depth, qs.CURRENT_DEPTH)); return ("xvfb", depth) not in fail
+    def chromium(w, h, preset=None):
+        calls.append(("chromium", None, qs.CURRENT_DEPTH)); return ("chromium", qs.CURRENT_DEPTH) not in fail
+    for name, fn in {"_start_xvfb":xvfb, "_launch_chromium":chromium, "_start_x11vnc":lambda: True,
+                     "_start_novnc":lambda: True, "_kill_proc":lambda name: None,
+                     "_place_stack":lambda: None, "_apply_affinity":lambda: None,
+                     "_start_resizer_thread":lambda: None, "_save_stack_state":lambda: None}.items():
+        monkeypatch.setattr(qs, name, fn)
+    monkeypatch.setattr(qs.time, "sleep", lambda s: None)
+    for name in ("STACK_OK", "STACK_TIMINGS", "CURRENT_W", "CURRENT_H"):
+        monkeypatch.setattr(qs, name, getattr(qs, name))
+    monkeypatch.setattr(qs, "CURRENT_DEPTH", 24)
+    return calls, fail
+
+def test_depth_is_published_only_after_xvfb_starts(fake_stack):
+    calls, _ = fake_stack
+    assert qs._start_full_stack(1280, 720, 16)
+    assert calls[0] == ("xvfb", 16, 24) and qs.CURRENT_DEPTH == 16
+    assert set(qs.STACK_TIMINGS) == {"xvfb", "chromium", "x11vnc", "novnc", "total"}
+
+def test_failed_xvfb_keeps_the_old_depth(fake_stack):
+    calls, fail = fake_stack
+    fail.add(("xvfb", 8))
+    assert not qs._start_full_stack(1280, 720, 8)
+    assert qs.CURRENT_DEPTH == 24
+
+def test_8bit_fallback_keeps_both_attempts_timings(fake_stack):
+    calls, fail = fake_stack
+    fail.add(("chromium", 8))
+    assert qs._start_full_stack(1280, 720, 8)
+    assert qs.CURRENT_DEPTH == 16
+    assert [c[:2] for c in calls] == [("xvfb", 8), ("chromium", None), ("xvfb", 16), ("chromium", None)]
+    assert {"xvfb@8", "chromium@8", "xvfb@16", "chromium@16"} <= set(qs.STACK_TIMINGS)
+    assert "xvfb" not in qs.STACK_TIMINGS
+
+@pytest.fixture
+def ops(monkeypatch):
+    """An empty op queue with no worker, so ops stay where they are put."""
+    monkeypatch.setattr(qs, "_ops_worker_started", True)
+    monkeypatch.setattr(qs, "_ops", qs.OrderedDict())
+    monkeypatch.setattr(qs, "_pending_op", None)
+    monkeypatch.setattr(qs, "_running_op", None)
+    busy = {"reason":None}
+    monkeypatch.setattr(qs, "_admit_reason", lambda: busy["reason"])
+    return busy
+
+def test_held_back_op_reports_its_place_in_the_queue(ops, client):
+    ops["reason"] = "memory 95% ≥ 90%"
+    r = client.post("/api/restart_stack")
+    assert (r.status_code, r.json["position"]) == (503, 1)
+    qs._running_op, qs._pending_op = qs._pending_op, None   # the worker takes it
+    r = client.post("/api/restart_stack")
+    assert (r.status_code, r.json["position"]) == (503, 2)
+    assert r.headers["Retry-After"]
+
+def test_op_outside_the_queue_has_no_position(ops):
+    op = qs._submit_stack_op("restart")
+    assert qs._op_position(op) == 1
+    qs._submit_stack_op("resize", 1280, 720)   # replaces the waiting restart
+    assert op["status"] == "superseded" and qs._op_position(op) is None
+
+def test_restart_joins_the_waiting_op(ops):
+    op = qs._submit_stack_op("resize", 1280, 720)
+    assert qs._submit_stack_op("restart") is op
+    assert qs._op_target() == (1280, 720, qs.CURRENT_DEPTH)
+
+def test_resize_to_where_the_running_op_is_heading_joins_it(ops):
+    qs._running_op = qs._submit_stack_op("resize", 1280, 720, 16); qs._pending_op = None
+    assert qs._submit_stack_op("resize", 1280, 720, 16) is qs._running_op
+    assert qs._submit_stack_op("resize", 1280, 720, 8) is qs._pending_op
+    assert qs._op_target() == (1280, 720, 8)
+
+def test_newer_resize_supersedes_the_waiting_one(ops, client):
+    first = qs._submit_stack_op("resize", 1024, 768)
+    last = qs._submit_stack_op("resize", 1280, 720)
+    assert first["superseded_by"] == last["id"] and qs._pending_op is last
+    assert client.get(f"/api/stack_op/{first['id']}").json["status"] == "superseded"
+    assert client.get("/api/stack_op/nope").status_code == 404
+
+class _Cond(threading.Condition):
+    """Notes when the worker goes back to waiting for work."""
+    idle = False
+    def wait(self, timeout=None):
+        if timeout is None: self.idle = True
+        return super().wait(timeout)
+
+def test_worker_runs_the_first_and_last_of_a_burst(ops, monkeypatch):
+    # A private condition: the worker thread outlives the test, blocked on it.
+    cond = _Cond()
+    monkeypatch.setattr(qs, "_ops_cond", cond)
+    monkeypatch.setattr(qs, "_ops_worker_started", False)
+    monkeypatch.setattr(qs, "_publish", lambda *a: None)
+    runs, release = [], threading.Event()
+    def restart(w, h, depth):
+        runs.append((w, h, depth)); release.wait(5); return True
+    monkeypatch.setattr(qs, "_restart_stack", restart)
+    first = qs._submit_stack_op("resize", 800, 600)
+    _wait(lambda: runs)
+    burst = [qs._submit_stack_op("resize", 1000 + i, 700) for i in range(3)]
+    assert [o["status"] for o in burst] == ["superseded", "superseded", "queued"]
+    cond.idle = False
+    release.set()
+    _wait(lambda: cond.idle and burst[-1]["status"] == "done")
+    assert first["status"] == "done"
+    assert runs == [(800, 600, None), (1002, 700, None)]
+
+def _wait(cond, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not cond():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
@@ -0,0 +1,61 @@
+import time
+
+import pytest
+
+import main as qs
+
+@pytest.fixture
+def trace(monkeypatch, tmp_path):
+    """Recording on, into tmp_path, with a 2x1 screen and 1 s keyframes."""
+    monkeypatch.setattr(qs, "TRACE_DIR", tmp_path)
+    monkeypatch.setattr(qs, "TRACE_KEYFRAME_S", 1)
+    monkeypatch.setattr(qs, "_fb_thumbnail", lambda max_w: (2, 1, b"\x00" + b"\x01" * 6))
+    tr = qs._trace_open("s1", "admin")
+    yield tr
+    qs._trace_close(tr)
+
+def _later(tr, s):
+    tr.t0 -= s   # the recording clock moves on by s seconds
+
+def _finish(tr):
+    qs._trace_close(tr)
+    deadline = time.monotonic() + 5
+    while not tr.f.closed:
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+def _kinds(items):
+    return [(kind, v[1] if kind == "rec" else None) for kind, _, v in items]
+
+def test_round_trip_with_keyframes(trace):
+    qs._trace_rec(trace, qs.TRACE_C2S, b"a")
+    qs._trace_rec(trace, qs.TRACE_S2C, b"bb")
+    _later(trace, 1.5)
+    qs._trace_rec(trace, qs.TRACE_C2S, b"c")
+    _finish(trace)
+    with open(trace.path, "rb") as f:
+        assert qs._trace_header(f)["session"] == "s1"
+    items = list(qs._trace_iter(trace.path))
+    assert _kinds(items) == [("key", None), ("rec", b"a"), ("rec", b"bb"), ("key", None), ("rec", b"c")]
+    assert items[0][2][:2] == (2, 1) and bytes(items[0][2][2]) == b"\x00" + b"\x01" * 6
+    assert [k for _, _, k in qs._trace_index(trace.path)].count(1) == 2
+
+def test_seek_starts_at_the_keyframe_before(trace):
+    qs._trace_rec(trace, qs.TRACE_C2S, b"a")
+    _later(trace, 1.5)
+    qs._trace_rec(trace, qs.TRACE_C2S, b"c")
+    _finish(trace)
+    assert _kinds(qs._trace_iter(trace.path, 1.6)) == [("key", None), ("rec", b"c")]
+    assert _kinds(qs._trace_iter(trace.path, 0.5))[:2] == [("key", None), ("rec", b"a")]
+
+def test_dropped_bytes_leave_a_gap_record(trace):
+    trace.dropped = 1000
+    qs._trace_rec(trace, qs.TRACE_S2C, b"x")
+    _finish(trace)
+    recs = [v for kind, _, v in qs._trace_iter(trace.path) if kind == "rec"]
+    assert recs == [(qs.TRACE_GAP, 1000), (qs.TRACE_S2C, b"x")]
+
+def test_off_without_a_directory(monkeypatch):
+    monkeypatch.setattr(qs, "TRACE_DIR", None)
+    assert qs._trace_open("s1", "admin") is None
+    qs._trace_rec(None, qs.TRACE_C2S, b"a")   # the bridge calls it regardless
@@ -0,0 +1,87 @@
+import pytest
+
+import main as qs
+
+@pytest.fixture
+def up(monkeypatch, tmp_path):
+    """Transfer directories under tmp_path, without the downloads watcher."""
+    monkeypatch.setattr(qs, "TRANSFER_ROOT", tmp_path)
+    monkeypatch.setattr(qs, "_watch_dir", lambda *a, **k: None)
+    monkeypatch.setattr(qs, "_transfer_watched", set())
+    return qs._transfer_dirs()[1]
+
+def _put(client, body, cr=None, name="f.bin"):
+    return client.put(f"/api/files/uploads/{name}", data=body,
+                      headers={"Content-Range": cr} if cr else {})
+
+def test_whole_file_without_content_range(up, client):
+    r = _put(client, b"0123456789")
+    assert r.json == {"received": 10, "size": 10, "done": True}
+    assert (up / "f.bin").read_bytes() == b"0123456789"
+
+def test_chunks_resume_from_what_arrived(up, client):
+    assert _put(client, b"0123", "bytes 0-3/10").json == {"received": 4, "size": 10, "done": False}
+    assert _put(client, b"", "bytes */10").json == {"received": 4, "size": 10, "done": False}
+    r = _put(client, b"6789", "bytes 6-9/10")
+    assert (r.status_code, r.json["received"]) == (409, 4)
+    assert _put(client, b"456789", "bytes 4-9/10").json["done"]
+    assert (up / "f.bin").read_bytes() == b"0123456789"
+    assert not list(up.glob(".f.bin*"))
+
+@pytest.mark.parametrize("cr", ["bytes 0-3", "bytes=0-3/10", "items 0-3/10", "bytes 0-9/10"])
+def test_bad_or_mismatched_content_range_is_400(up, client, cr):
+    assert _put(client, b"0123", cr).status_code == 400
+
+def test_chunk_past_the_end_is_400(up, client):
+    assert _put(client, b"0123", "bytes 0-3/2").status_code == 400
+
+def test_total_must_match_the_first_chunk(up, client):
+    _put(client, b"0123", "bytes 0-3/10")
+    r = _put(client, b"4567", "bytes 4-7/12")
+    assert (r.status_code, r.json["size"]) == (409, 10)
+
+def test_quota_and_chunk_limit_are_413(up, client, monkeypatch):
+    monkeypatch.setattr(qs, "TRANSFER_MAX_BYTES", 8)
+    assert _put(client, b"0123", "bytes 0-3/10").status_code == 413
+    monkeypatch.setattr(qs, "UPLOAD_CHUNK_MAX", 2)
+    assert _put(client, b"0123", "bytes 0-3/4").status_code == 413
+
+def test_bad_name_is_400(up, client):
+    assert _put(client, b"x", name=".hidden").status_code == 400
+
+@pytest.fixture
+def stored(up):
+    (up / "f.bin").write_bytes(b"0123456789")
+
+def _get(client, **headers):
+    return client.get("/api/files/uploads/f.bin", headers=headers)
+
+def test_full_download(stored, client):
+    r = _get(client)
+    assert (r.status_code, r.data, r.headers["Accept-Ranges"]) == (200, b"0123456789", "bytes")
+    assert r.headers["Content-Length"] == "10" and r.headers["ETag"]
+
+def test_range_is_206(stored, client):
+    r = _get(client, Range="bytes=2-5")
+    assert (r.status_code, r.data, r.headers["Content-Range"]) == (206, b"2345", "bytes 2-5/10")
+    assert _get(client, Range="bytes=-3").data == b"789"
+
+def test_unsatisfiable_range_is_416(stored, client):
+    r = _get(client, Range="bytes=20-")
+    assert (r.status_code, r.headers["Content-Range"]) == (416, "bytes */10")
+
+def test_if_range_only_honours_the_current_etag(stored, client):
+    etag = _get(client).headers["ETag"]
+    assert _get(client, Range="bytes=2-5", **{"If-Range": etag}).status_code == 206
+    r = _get(client, Range="bytes=2-5", **{"If-Range": '"stale"'})
+    assert (r.status_code, r.data) == (200, b"0123456789")
+
+def test_multiple_ranges_get_the_whole_file(stored, client):
+    assert _get(client, Range="bytes=0-1,4-5").status_code == 200
+
+def test_probe_needs_no_content_length(up, client):
+    _put(client, b"0123", "bytes 0-3/10")
+    r = client.put("/api/files/uploads/f.bin", headers={"Content-Range": "bytes */10"})
+    assert r.json == {"received": 4, "size": 10, "done": False}
+    r = client.put("/api/files/uploads/f.bin", headers={"Content-Range": "bytes 4-5/10"})
+    assert r.status_code == 411
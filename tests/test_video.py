@@ -0,0 +1,35 @@
+import main as qs
+
+AUD = b"\x00\x00\x00\x01\x09\xf0"
+IDR = b"\x00\x00\x00\x01\x65" + b"\x88" * 5000   # slice of an IDR picture
+P = b"\x00\x00\x00\x01\x41" + b"\x9a" * 300       # non-IDR slice
+SPS = b"\x00\x00\x00\x01\x67\x42\xc0\x33"
+
+def _stream():
+    return [AUD + SPS + IDR, AUD + P, AUD + P, AUD + SPS + IDR, AUD + P]
+
+def test_split_reassembles_a_frame_cut_across_reads():
+    data = b"".join(_stream())
+    pieces = [data[i:i + 4096] for i in range(0, len(data), 4096)]   # page-sized pipe reads
+    out = list(qs._h264_split(pieces))
+    assert [au for _, au in out] == _stream()
+    assert [key for key, _ in out] == [True, False, False, True, False]
+
+def test_split_separates_frames_batched_in_one_read():
+    out = list(qs._h264_split([b"".join(_stream())]))
+    assert [au for _, au in out] == _stream()
+
+def test_split_finds_a_delimiter_straddling_two_reads():
+    data = b"".join(_stream()[:2])
+    cut = len(_stream()[0]) + 2   # inside the second delimiter
+    assert [au for _, au in qs._h264_split([data[:cut], data[cut:]])] == _stream()[:2]
+
+def test_split_holds_the_last_unit_until_the_next_delimiter():
+    g = qs._h264_split(iter([AUD + P, AUD + P[:10]]))
+    assert next(g) == (False, AUD + P)
+
+def test_frames_reads_the_file_descriptor(tmp_path):
+    f = tmp_path / "x.h264"
+    f.write_bytes(b"".join(_stream()))
+    with open(f, "rb") as fh:
+        assert [au for _, au in qs._h264_frames(fh)] == _stream()